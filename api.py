@@ -1,21 +1,106 @@
+import os
 from dotenv import load_dotenv
+
+# loaded before the modules below, which read their settings at import time
+load_dotenv()
+
 from modules.TSdoc import *
 from modules.threesys import *
 from modules.responses import *
-from flask import Flask, request
+from modules.signedindex import signed_index
+from modules.storage import get_storage
+from modules.logs import configure_logging, log
+from modules.profiling import profiled
+from modules.admission import Overloaded, admission_stats, admit, lanes
+from modules.jobs import get_job_store, new_job_id, submit_generate_job
+from modules.batch import (
+    batch_documents_from_request,
+    batch_max_content_length,
+    verify_batch,
+)
+from flask import Blueprint, Flask, Request, g, request, jsonify
 from flask_cors import CORS
 
-load_dotenv()
-app = Flask(__name__)
-CORS(app, expose_headers=["Content-Disposition"])
+routes = Blueprint("threesys", __name__)
+
+
+# the request class of the app. /verify/batch takes many documents in one body and has
+# a limit of its own, BATCH_MAX_CONTENT_LENGTH
+class ThreesysRequest(Request):
+    @property
+    def max_content_length(self):
+        if self.path == "/verify/batch":
+            return batch_max_content_length
+        return super().max_content_length
+
+
+# application factory, used by gunicorn ("api:create_app()", see gunicorn.conf.py) and
+# by the development server below
+def create_app():
+    configure_logging()
+    app = Flask(__name__)
+    app.request_class = ThreesysRequest
+    # requests declaring a larger body are answered with 413 before any of it is read
+    app.config["MAX_CONTENT_LENGTH"] = int(
+        os.getenv("MAX_CONTENT_LENGTH", str(64 * 1024 * 1024))
+    )
+    CORS(
+        app,
+        expose_headers=[
+            "Content-Disposition",
+            "X-Signature-Location",
+            "X-Profile-Id",
+            "Retry-After",
+        ],
+    )
+    app.register_blueprint(routes)
 
+    # fill the in-process index of signed documents once, so that lookups of unsigned
+    # documents can skip the db. Without it every lookup simply goes to the db
+    if signed_index.enabled:
+        try:
+            signed_index.warm_load(get_storage())
+        except Exception as error:
+            log.warning(
+                "signed index warm load failed, using the db for lookups",
+                extra={"fields": {"error": str(error)}},
+            )
 
-@app.route("/")
+    return app
+
+
+@routes.route("/")
 def main():
     return default_route()
 
 
-@app.route("/generate", methods=["POST"])
+@routes.app_errorhandler(413)
+def too_large(error):
+    return input_fail(2)
+
+
+@routes.app_errorhandler(Overloaded)
+def overloaded_handler(error):
+    return overloaded(error.retry_after)
+
+
+@routes.route("/metrics")
+def metrics():
+    return metrics_response()
+
+
+@routes.route("/stats/signed-index")
+def signed_index_stats():
+    return jsonify(signed_index.stats())
+
+
+@routes.route("/stats/admission")
+def admission_stats_route():
+    return jsonify(admission_stats(lanes))
+
+
+@routes.route("/generate", methods=["POST"])
+@profiled("generate")
 def generate():
     # check request file and initialize fitz document object into memory from request if passed
     result = initialize_request(request)
@@ -25,45 +110,103 @@ def generate():
         return input_fail(0)
 
     # deconstruct result tuple
-    (document, document_name) = result
+    (document, document_name, document_raw_hash) = result
 
     # check if document is big enough for 1 inch margins
     dimensions_passed = check_document_dimensions(document)
     if not dimensions_passed:
         return input_fail(1)
 
-    # check to see if the dm location parameter is set. If not then default to bottom right
+    # check to see if the dm location parameter is set. If not then default to bottom right.
+    # "auto" signs in the first clear corner
     dm_steg_location = (
         request.form["location"] if "location" in request.form else "bottom-right"
     )
 
-    # initialize TSdoc, dm steg location is optional as it will default to bottom right.
-    # also, if the user fails to specify either top-left, top-right, bottom-left, bottom-right
-    # due to a typo, the api will default back to bottom-right
-    ts_doc = TSdoc("generate", document_name, document, dm_steg_location)
-
-    # return str(ts_doc.__dict__)
-    return generate_decision(ts_doc)
-
-
-@app.route("/verify", methods=["POST"])
+    # with ?async=1 the document is signed by a background worker. The client gets a job
+    # id right away and polls /jobs/<id> for the outcome
+    if request.args.get("async") == "1":
+        job_id = new_job_id()
+        file = request.files["file"]
+        file.stream.seek(0)
+        file.save(get_job_store().upload_path(job_id))
+        submit_generate_job(job_id, document_name, dm_steg_location, document_raw_hash)
+        return job_accepted(job_id)
+
+    # the document waits for a slot of its lane, chosen by its size and page count, or
+    # is answered with 503 when the lane is full (see modules/admission.py)
+    with admit("generate", request.content_length, document.page_count):
+        # initialize TSdoc, dm steg location is optional as it will default to bottom right.
+        # also, if the user fails to specify either top-left, top-right, bottom-left, bottom-right
+        # due to a typo, the api will default back to bottom-right
+        ts_doc = TSdoc(
+            "generate", document_name, document, dm_steg_location, document_raw_hash
+        )
+        # tags a requested profile with the document, see modules/profiling.py
+        g.ts_doc = ts_doc
+
+        # return str(ts_doc.__dict__)
+        return generate_decision(ts_doc)
+
+
+@routes.route("/verify", methods=["POST"])
+@profiled("verify")
 def verify():
-    # check request file and initialize fitz document object into memory from request if passed
-    result = initialize_request(request)
+    # check request file and spool it to disk, hashing it on the way
+    result = spool_request(request)
 
     # check if document is PDF
     if not result:
         return input_fail(0)
 
     # deconstruct result tuple
-    (document, document_name) = result
+    (path, document_name, document_raw_hash) = result
+
+    # an upload identical to a /generate download is answered from its hash
+    ts_doc = verify_by_raw_hash(document_name, document_raw_hash)
+    if ts_doc is not None:
+        os.remove(path)
+        g.ts_doc = ts_doc
+        return verify_decision(ts_doc)
+
+    # initialize fitz document object from the spooled upload
+    document = open_spooled_document(path)
+
+    # initialize TSdoc once the document is admitted to its lane
+    with admit("verify", request.content_length, document.page_count):
+        ts_doc = TSdoc("verify", document_name, document, raw_hash=document_raw_hash)
+        g.ts_doc = ts_doc
+
+        # return str(ts_doc.__dict__)
+        return verify_decision(ts_doc)
+
+
+@routes.route("/verify/batch", methods=["POST"])
+def verify_batch_route():
+    # check that there is anything to verify, bad files are reported one by one
+    if not request.files:
+        return input_fail(0)
+
+    # documents are verified in parallel and reported as they finish
+    return verify_batch_response(verify_batch(batch_documents_from_request(request)))
+
+
+@routes.route("/jobs/<job_id>")
+def job_state(job_id):
+    job = get_job_store().get(job_id)
+    if not job:
+        return job_not_found()
+    return job_status(job)
 
-    # initialize TSdoc
-    ts_doc = TSdoc("verify", document_name, document)
 
-    # return str(ts_doc.__dict__)
-    return verify_decision(ts_doc)
+@routes.route("/jobs/<job_id>/result")
+def job_result_file(job_id):
+    store = get_job_store()
+    job = store.get(job_id)
+    if not job:
+        return job_not_found()
+    return job_result(job, store.result_path(job_id))
 
 
 if __name__ == "__main__":
-    app.run()
+    create_app().run()
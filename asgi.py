@@ -0,0 +1,408 @@
+import os
+import signal
+import shutil
+import asyncio
+import functools
+import contextlib
+from concurrent.futures import ThreadPoolExecutor
+from dotenv import load_dotenv
+
+# loaded before the modules below, which read their settings at import time
+load_dotenv()
+
+import fitz
+from flask import Flask, jsonify
+from starlette.applications import Starlette
+from starlette.datastructures import UploadFile
+from starlette.middleware import Middleware
+from starlette.middleware.cors import CORSMiddleware
+from starlette.responses import FileResponse
+from starlette.responses import Response as AsgiResponse
+from starlette.routing import Route
+from werkzeug.utils import secure_filename
+from modules.TSdoc import TSdoc
+from modules.threesys import (
+    allowed_file,
+    check_document_dimensions,
+    fast_path_doc,
+    spool_upload,
+    verify_fast_path,
+)
+from modules.responses import *
+from modules.signedindex import signed_index
+from modules.storage import get_storage
+from modules.asyncstorage import (
+    close_async_storage,
+    get_async_storage,
+    open_async_storage,
+)
+from modules.admission import (
+    AsyncLane,
+    Overloaded,
+    admission_stats,
+    admit_in,
+    make_lanes,
+)
+from modules.logs import configure_logging, log
+from modules import memory
+from modules.jobs import get_job_store, new_job_id, submit_generate_job
+
+
+# asgi serving mode of the api, with the contract of the flask app in api.py for /,
+# /generate (including ?async=1 and /jobs), /verify and /metrics. Requests wait on the db
+# without holding a thread: queries go through an async driver (modules/asyncstorage.py),
+# and the cpu bound stages of a TSdoc run in a bounded thread pool. Run with:
+#   GUNICORN_WORKER_CLASS=uvicorn.workers.UvicornWorker gunicorn -c gunicorn.conf.py asgi:app
+# The responses are built by modules/responses.py, so both modes answer alike. Request
+# profiling (modules/profiling.py) and /verify/batch are only served by the flask app.
+# Under gunicorn, uvicorn workers differ from gthread ones: they do not call post_request,
+# so their memory is checked on a timer (watch_memory), and the psycopg2 pool is not
+# opened for them in post_worker_init, as they query through the async pool
+
+# threads per process that run cpu bound stages. Further requests wait for a free thread
+# on the event loop, without queuing work behind the executor
+cpu_threads = int(os.getenv("ASGI_CPU_THREADS", "2"))
+max_content_length = int(os.getenv("MAX_CONTENT_LENGTH", str(64 * 1024 * 1024)))
+_cpu_executor = None
+_cpu_slots = None
+# the flask responses of modules/responses.py need an application context to be built
+response_app = Flask(__name__)
+# admission lanes of the process, see modules/admission.py
+lanes = make_lanes(AsyncLane)
+
+
+# runs function(*args, **kwargs) in the cpu pool once one of its threads is free
+async def run_cpu(function, *args, **kwargs):
+    async with _cpu_slots:
+        return await asyncio.get_running_loop().run_in_executor(
+            _cpu_executor, functools.partial(function, *args, **kwargs)
+        )
+
+
+# builds a response of modules/responses.py and converts it to an asgi response
+def respond(build, *args):
+    with response_app.app_context():
+        response = build(*args)
+    headers = {
+        key: value
+        for (key, value) in response.headers.items()
+        if key.lower() != "content-length"
+    }
+    return AsgiResponse(
+        response.get_data(), status_code=response.status_code, headers=headers
+    )
+
+
+# the asgi counterpart of spool_request: checks the "file" field of a parsed form and
+# spools it to disk. Returns (path, secure file name, sha256 of the upload) or False
+async def spool_form(form):
+    # print("spool_form")
+    upload = form.get("file")
+    if not isinstance(upload, UploadFile) or not allowed_file(upload.filename):
+        return False
+    (path, document_raw_hash) = await asyncio.to_thread(spool_upload, upload.file)
+    return (path, secure_filename(upload.filename), document_raw_hash)
+
+
+# parses the multipart body of a request, or returns None when it is larger than
+# MAX_CONTENT_LENGTH (checked on the declared length, then on the spooled form)
+async def read_form(request):
+    declared = request.headers.get("content-length")
+    if declared and declared.isdigit() and int(declared) > max_content_length:
+        return None
+    form = await request.form()
+    upload = form.get("file")
+    if isinstance(upload, UploadFile):
+        size = await asyncio.to_thread(upload.file.seek, 0, os.SEEK_END)
+        await upload.seek(0)
+        if size > max_content_length:
+            await form.close()
+            return None
+    return form
+
+
+# the asgi counterpart of check_if_doc_is_already_prev_signed. A failed query answers
+# with the same error string as lookup_prev_signed_in_db, which fails the request the way
+# the flask app does
+async def already_signed(document_hash):
+    # print("already_signed")
+    storage = get_async_storage()
+    if signed_index.enabled:
+        if signed_index.needs_refresh():
+            try:
+                signed_index.add_rows(
+                    await storage.origs_since(signed_index.refresh_from())
+                )
+            except Exception:
+                pass
+        result = signed_index.lookup(document_hash)
+        if result is not None:
+            return result
+    try:
+        result = await storage.orig_exists(document_hash)
+    except Exception as error:
+        result = f"Error while connecting to PostgreSQL, {error}"
+    if signed_index.enabled:
+        signed_index.confirm(document_hash, result)
+    return result
+
+
+# the asgi counterpart of check_if_document_is_modified, over the steg messages the
+# TSdoc has already read. A failed query answers with the same error string
+async def document_is_modified(ts_doc):
+    # print("document_is_modified")
+    if len(ts_doc.dm_stegs) != 1 or not ts_doc.steg_messages[0].isdigit():
+        return True
+    try:
+        rpdf_hash = await get_async_storage().signed_hash(int(ts_doc.steg_messages[0]))
+    except Exception as error:
+        return f"Error while connecting to PostgreSQL, {error}"
+    if rpdf_hash:
+        return rpdf_hash not in (ts_doc.hash, ts_doc.raw_hash)
+    return True
+
+
+async def main(request):
+    return respond(default_route)
+
+
+async def metrics(request):
+    return respond(metrics_response)
+
+
+async def signed_index_stats(request):
+    return respond(lambda: jsonify(signed_index.stats()))
+
+
+async def admission_stats_route(request):
+    return respond(lambda: jsonify(admission_stats(lanes)))
+
+
+async def overloaded_handler(request, error):
+    return respond(overloaded, error.retry_after)
+
+
+async def generate(request):
+    form = await read_form(request)
+    if form is None:
+        return respond(input_fail, 2)
+    try:
+        # check request file and spool it to disk, hashing it on the way
+        result = await spool_form(form)
+        if not result:
+            return respond(input_fail, 0)
+        (path, document_name, document_raw_hash) = result
+        dm_steg_location = form.get("location", "bottom-right")
+    finally:
+        await form.close()
+    size_bytes = os.path.getsize(path)
+    try:
+        document = await run_cpu(fitz.open, path, filetype="pdf")
+
+        # check if document is big enough for 1 inch margins
+        if not check_document_dimensions(document):
+            return respond(input_fail, 1)
+
+        # with ?async=1 the document is signed by a background worker
+        if request.query_params.get("async") == "1":
+            job_id = new_job_id()
+            await asyncio.to_thread(
+                shutil.copyfile, path, get_job_store().upload_path(job_id)
+            )
+            await asyncio.to_thread(
+                submit_generate_job,
+                job_id,
+                document_name,
+                dm_steg_location,
+                document_raw_hash,
+            )
+            return respond(job_accepted, job_id)
+
+        # the document waits for a slot of its lane, chosen by its size and page
+        # count, or is answered with 503 when the lane is full
+        async with admit_in(lanes, "generate", size_bytes, document.page_count):
+            ts_doc = await run_cpu(
+                TSdoc,
+                "generate",
+                document_name,
+                document,
+                dm_steg_location,
+                document_raw_hash,
+                check_signed=False,
+            )
+            ts_doc.already_signed = await already_signed(ts_doc.hash)
+            return await generate_decision(ts_doc)
+    finally:
+        os.remove(path)
+
+
+# the asgi counterpart of generate_decision
+async def generate_decision(ts_doc):
+    match generate_outcome(ts_doc):
+        case "pass":
+            if ts_doc.already_signed:
+                return respond(generate_fail)
+            signed = await get_async_storage().sign_and_store(ts_doc, run_cpu)
+            if signed is None:
+                return respond(generate_fail)
+            (new_pdf_data, new_pdf_file_name) = signed
+            return respond(
+                signed_pdf_response,
+                new_pdf_data,
+                new_pdf_file_name,
+                ts_doc.dm_steg_location,
+            )
+        case "fail":
+            return respond(generate_fail)
+        case "neutral":
+            return respond(generate_neutral)
+        case _:
+            return respond(generate_fail_margin)
+
+
+async def verify(request):
+    form = await read_form(request)
+    if form is None:
+        return respond(input_fail, 2)
+    try:
+        # check request file and spool it to disk, hashing it on the way
+        result = await spool_form(form)
+    finally:
+        await form.close()
+    if not result:
+        return respond(input_fail, 0)
+    (path, document_name, document_raw_hash) = result
+
+    # an upload identical to a /generate download is answered from its hash
+    if verify_fast_path:
+        try:
+            dm_payload = await get_async_storage().signed_payload(document_raw_hash)
+        except Exception:
+            dm_payload = None
+        ts_doc = fast_path_doc(document_name, document_raw_hash, dm_payload)
+        if ts_doc is not None:
+            os.remove(path)
+            return respond(verify_decision, ts_doc)
+
+    size_bytes = os.path.getsize(path)
+    try:
+        document = await run_cpu(fitz.open, path, filetype="pdf")
+        async with admit_in(lanes, "verify", size_bytes, document.page_count):
+            ts_doc = await run_cpu(
+                TSdoc,
+                "verify",
+                document_name,
+                document,
+                raw_hash=document_raw_hash,
+                check_modified=False,
+                check_signed=False,
+            )
+            if ts_doc.dm_stegs:
+                ts_doc.traits["modified"] = await document_is_modified(ts_doc)
+            return respond(verify_decision, ts_doc)
+    finally:
+        os.remove(path)
+
+
+async def job_state(request):
+    job = await asyncio.to_thread(get_job_store().get, request.path_params["job_id"])
+    if not job:
+        return respond(job_not_found)
+    return respond(job_status, job)
+
+
+async def job_result_file(request):
+    store = get_job_store()
+    job_id = request.path_params["job_id"]
+    job = await asyncio.to_thread(store.get, job_id)
+    if not job:
+        return respond(job_not_found)
+    if job["status"] != "done" or job["outcome"] != "pass":
+        return respond(job_status, job)
+    return FileResponse(
+        store.result_path(job_id),
+        media_type="application/pdf",
+        filename=job["download_name"],
+        content_disposition_type="inline",
+    )
+
+
+# checks the resident memory of the worker every WORKER_RSS_CHECK_SECONDS and above
+# WORKER_MAX_RSS_MB stops it gracefully, like post_request does for gthread workers: the
+# running requests finish and the gunicorn master starts a fresh worker
+async def watch_memory():
+    # print("watch_memory")
+    while True:
+        await asyncio.sleep(memory.rss_check_seconds)
+        rss_mb = memory.resident_memory_mb()
+        if rss_mb > memory.worker_max_rss_mb:
+            log.info(
+                "worker memory above WORKER_MAX_RSS_MB, recycling",
+                extra={
+                    "fields": {
+                        "pid": os.getpid(),
+                        "rss_mb": round(rss_mb),
+                        "max_rss_mb": memory.worker_max_rss_mb,
+                    }
+                },
+            )
+            os.kill(os.getpid(), signal.SIGTERM)
+            return
+
+
+# per process setup, run by every worker after the fork: the cpu pool, the async db
+# pool, the signed index and, under gunicorn, the memory watch
+@contextlib.asynccontextmanager
+async def lifespan(app):
+    global _cpu_executor, _cpu_slots
+    configure_logging()
+    _cpu_executor = ThreadPoolExecutor(
+        max_workers=cpu_threads, thread_name_prefix="threesys-cpu"
+    )
+    _cpu_slots = asyncio.Semaphore(cpu_threads)
+    await open_async_storage()
+    if signed_index.enabled and signed_index.bloom is None:
+        try:
+            await asyncio.to_thread(signed_index.warm_load, get_storage())
+        except Exception as error:
+            log.warning(
+                "signed index warm load failed, using the db for lookups",
+                extra={"fields": {"error": str(error)}},
+            )
+    watcher = asyncio.create_task(watch_memory()) if memory.supervised else None
+    try:
+        yield
+    finally:
+        if watcher is not None:
+            watcher.cancel()
+        await close_async_storage()
+        _cpu_executor.shutdown(wait=False)
+
+
+app = Starlette(
+    routes=[
+        Route("/", main),
+        Route("/metrics", metrics),
+        Route("/stats/signed-index", signed_index_stats),
+        Route("/stats/admission", admission_stats_route),
+        Route("/generate", generate, methods=["POST"]),
+        Route("/verify", verify, methods=["POST"]),
+        Route("/jobs/{job_id}", job_state),
+        Route("/jobs/{job_id}/result", job_result_file),
+    ],
+    middleware=[
+        Middleware(
+            CORSMiddleware,
+            allow_origins=["*"],
+            allow_methods=["*"],
+            allow_headers=["*"],
+            expose_headers=[
+                "Content-Disposition",
+                "X-Signature-Location",
+                "Retry-After",
+            ],
+        )
+    ],
+    exception_handlers={Overloaded: overloaded_handler},
+    lifespan=lifespan,
+)
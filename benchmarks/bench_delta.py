@@ -0,0 +1,120 @@
+import argparse
+import os
+import sys
+import time
+import fitz
+from PIL import Image
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from modules.pdfdelta import make_delta, reconstruct_signed_pdf
+from modules.threesys import (
+    check_document_dimensions,
+    get_hash_and_bytes_of_document,
+    put_steg_dm_in_pdf,
+    sign_document_incrementally,
+    steganography,
+)
+
+# the signing modes of SIGNING_MODE. The signed pdf, and so its delta, differs between
+# them: an incremental update only appends to the original, a rewrite moves objects
+signing_modes = ("incremental", "rewrite")
+
+
+# stand-in for the treepoem dm so that the benchmark runs without ghostscript: a
+# checkerboard of the same size class, carrying a real steg payload
+def signature_image(steg_id):
+    image = Image.new("RGB", (48, 48), "white")
+    for x in range(4, 44):
+        for y in range(4, 44):
+            if (x // 4 + y // 4) % 2 or x < 8 or y >= 40:
+                image.putpixel((x, y), (0, 0, 0))
+    return steganography(image, str(steg_id))
+
+
+# signs one pdf in memory the way /generate does in the given signing mode and returns
+# the original and signed bytes. Like TSdoc.sign_document, a document that cannot be
+# updated incrementally is rewritten
+def sign(path, steg_id, signing_mode):
+    document = fitz.open(path)
+    if not check_document_dimensions(document):
+        return None
+    (orig_hash, orig_bytes) = get_hash_and_bytes_of_document(document)
+    steg_dm = signature_image(steg_id)
+    if signing_mode == "incremental":
+        result = sign_document_incrementally(orig_bytes, steg_dm, "bottom-right")
+        if result:
+            return (orig_bytes, *result)
+    signed = put_steg_dm_in_pdf(document, steg_dm, "bottom-right")
+    (signed_hash, signed_bytes) = get_hash_and_bytes_of_document(signed)
+    return (orig_bytes, signed_hash, signed_bytes)
+
+
+# signs every pdf of paths in one signing mode and prints the size of the signed copy
+# as stored by SIGNED_PDF_STORAGE=full and =delta, and the time to encode the delta and
+# to rebuild it on read (as get_signed_pdf_bytes does, hash check included)
+def measure(paths, signing_mode):
+    total_orig = total_signed = total_delta = 0
+    delta_seconds = rebuild_seconds = 0.0
+    for steg_id, path in enumerate(paths, start=1):
+        try:
+            result = sign(path, steg_id, signing_mode)
+        except Exception as error:
+            print(f"skipped {path}: {error}")
+            continue
+        if result is None:
+            print(f"skipped {path}: pdf size unacceptable")
+            continue
+        (orig_bytes, signed_hash, signed_bytes) = result
+        started = time.perf_counter()
+        delta = make_delta(orig_bytes, signed_bytes)
+        delta_seconds += time.perf_counter() - started
+        started = time.perf_counter()
+        reconstruct_signed_pdf(orig_bytes, delta, signed_hash)
+        rebuild_seconds += time.perf_counter() - started
+        total_orig += len(orig_bytes)
+        total_signed += len(signed_bytes)
+        total_delta += len(delta)
+        print(
+            f"{signing_mode:<11} {os.path.basename(path):<40} "
+            f"orig {len(orig_bytes):>10} signed {len(signed_bytes):>10} "
+            f"delta {len(delta):>9} ({len(delta) / len(signed_bytes):6.1%})"
+        )
+
+    if not total_signed:
+        raise SystemExit("no pdf in the corpus could be signed")
+    full = total_orig + total_signed
+    with_delta = total_orig + total_delta
+    print()
+    print(f"signing mode                   {signing_mode:>14}")
+    print(f"signed pdfs stored in full     {full:>14} bytes")
+    print(f"signed pdfs stored as deltas   {with_delta:>14} bytes")
+    print(f"delta / signed size ratio      {total_delta / total_signed:14.2%}")
+    print(f"storage per signature ratio    {with_delta / full:14.2%}")
+    print(f"delta encoding time            {delta_seconds:14.3f} s")
+    print(f"delta rebuild time on read     {rebuild_seconds:14.3f} s")
+    print()
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="report the storage saved by keeping signed pdfs as deltas"
+    )
+    parser.add_argument("corpus", help="directory searched recursively for *.pdf")
+    parser.add_argument(
+        "--signing-modes", nargs="+", choices=signing_modes, default=list(signing_modes)
+    )
+    args = parser.parse_args()
+
+    paths = sorted(
+        os.path.join(root, name)
+        for root, _, names in os.walk(args.corpus)
+        for name in names
+        if name.lower().endswith(".pdf")
+    )
+    for signing_mode in args.signing_modes:
+        measure(paths, signing_mode)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,199 @@
+import argparse
+import http.client
+import json
+import os
+import signal
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.request
+from collections import Counter
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from bench_startup import multipart
+from bench_suite import summarize
+
+
+# load test of the two serving modes: the flask app under gunicorn's threaded workers
+# and the asgi app (asgi.py) under gunicorn's uvicorn workers, with the same number of
+# worker processes. Closed loop clients post a mix of /verify (signed, never signed) and
+# /generate (fresh documents) requests, and the throughput and latency percentiles of
+# every mode and concurrency are reported as json. The db is a throwaway sqlite database,
+# or the postgres at DATABASE_URL with --db postgres
+SERVERS = {
+    "flask": ("gthread", "api:create_app()"),
+    "asgi": ("uvicorn.workers.UvicornWorker", "asgi:app"),
+}
+
+
+def start_server(name, port, workers, timeout):
+    (worker_class, app) = SERVERS[name]
+    env = dict(
+        os.environ,
+        PORT=str(port),
+        WEB_CONCURRENCY=str(workers),
+        GUNICORN_WORKER_CLASS=worker_class,
+        LOG_LEVEL="WARNING",
+    )
+    server = subprocess.Popen(
+        [sys.executable, "-m", "gunicorn", "-c", "gunicorn.conf.py", app],
+        cwd=ROOT,
+        env=env,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+    )
+    started = time.perf_counter()
+    while True:
+        if time.perf_counter() - started > timeout:
+            stop_server(server)
+            raise SystemExit(f"{name} did not answer within {timeout} s")
+        try:
+            urllib.request.urlopen(f"http://127.0.0.1:{port}/", timeout=1).read()
+            return server
+        except OSError:
+            time.sleep(0.1)
+
+
+def stop_server(server):
+    server.send_signal(signal.SIGTERM)
+    try:
+        server.wait(timeout=30)
+    except subprocess.TimeoutExpired:
+        server.kill()
+
+
+def post(port, endpoint, pdf_bytes, name):
+    (body, content_type) = multipart("file", name, pdf_bytes, "application/pdf")
+    connection = http.client.HTTPConnection("127.0.0.1", port, timeout=300)
+    try:
+        started = time.perf_counter()
+        connection.request(
+            "POST", endpoint, body=body, headers={"Content-Type": content_type}
+        )
+        response = connection.getresponse()
+        data = response.read()
+        return (time.perf_counter() - started, response.status, data)
+    finally:
+        connection.close()
+
+
+# the requests of one run: every client takes the next one until none are left. Every
+# /generate gets a document of its own, so that it is really signed
+def workload(requests, first_variant):
+    from corpus import CASES
+
+    build = CASES["text_1_page"]
+    never_signed = build(first_variant).tobytes()
+    jobs = []
+    for i in range(requests):
+        match i % 3:
+            case 0:
+                jobs.append(("/generate", build(first_variant + 1 + i).tobytes()))
+            case 1:
+                jobs.append(("/verify", never_signed))
+            case _:
+                jobs.append(("/verify", None))
+    return jobs
+
+
+def run_load(port, jobs, concurrency, signed):
+    lock = threading.Lock()
+    pending = iter(jobs)
+    (samples, statuses) = ({}, Counter())
+
+    def client():
+        while True:
+            with lock:
+                job = next(pending, None)
+            if job is None:
+                return
+            (endpoint, pdf_bytes) = job
+            kind = endpoint if pdf_bytes is not None else "/verify signed"
+            (seconds, status, _) = post(port, endpoint, pdf_bytes or signed, "load.pdf")
+            with lock:
+                samples.setdefault(kind, []).append(seconds)
+                statuses[f"{kind} {status}"] += 1
+
+    threads = [threading.Thread(target=client) for _ in range(concurrency)]
+    started = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    seconds = time.perf_counter() - started
+    every = [sample for kind in samples.values() for sample in kind]
+    return {
+        "concurrency": concurrency,
+        "requests": len(every),
+        "seconds": round(seconds, 3),
+        "requests_per_second": round(len(every) / seconds, 2),
+        "p99_ms": round(sorted(every)[int(0.99 * (len(every) - 1))] * 1000, 3),
+        "latency": [
+            summarize(kind, kind_samples) for kind, kind_samples in samples.items()
+        ],
+        "statuses": statuses,
+    }
+
+
+def measure(name, args, first_variant):
+    from corpus import CASES
+
+    server = start_server(name, args.port, args.workers, args.timeout)
+    try:
+        # the signed document posted by the "/verify signed" requests
+        (_, status, signed) = post(
+            args.port,
+            "/generate",
+            CASES["text_1_page"](first_variant).tobytes(),
+            "load.pdf",
+        )
+        if status != 200:
+            raise SystemExit(
+                f"{name}: /generate of the signed document answered {status}"
+            )
+        results = []
+        for (i, concurrency) in enumerate(args.concurrency):
+            jobs = workload(args.requests, first_variant + 1 + i * 100000)
+            results.append(run_load(args.port, jobs, concurrency, signed))
+        return {"server": name, "workers": args.workers, "results": results}
+    finally:
+        stop_server(server)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="load test the flask and asgi serving modes"
+    )
+    parser.add_argument("--servers", nargs="+", default=list(SERVERS))
+    parser.add_argument("--db", choices=["sqlite", "postgres"], default="sqlite")
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1)
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[4, 16, 64])
+    parser.add_argument("--requests", type=int, default=300, help="per concurrency")
+    parser.add_argument("--port", type=int, default=5098)
+    parser.add_argument("--timeout", type=float, default=120)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        if args.db == "sqlite":
+            path = os.path.join(directory, "threesys.sqlite3")
+            os.environ["DATABASE_URL"] = "sqlite://" + path
+        else:
+            from db.migrate import migrate
+
+            migrate(os.environ["DATABASE_URL"])
+        os.environ.setdefault("JOBS_DIR", os.path.join(directory, "jobs"))
+        reports = []
+        for (i, name) in enumerate(args.servers):
+            # documents signed by earlier runs and servers stay in the db, use new
+            # variants
+            first_variant = int(time.time()) * 1000 + i * 10000000
+            reports.append(measure(name, args, first_variant))
+    print(json.dumps(reports, indent=2))
+
+
+if __name__ == "__main__":
+    main()
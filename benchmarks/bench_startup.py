@@ -0,0 +1,144 @@
+import argparse
+import json
+import os
+import signal
+import subprocess
+import sys
+import time
+import urllib.error
+import urllib.request
+import fitz
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# the two ways of serving the api: the development server the Dockerfile used to run,
+# and gunicorn with the bundled configuration (which reads PORT)
+SERVERS = {
+    "flask": lambda port: [
+        sys.executable,
+        "-m",
+        "flask",
+        "--app",
+        "api:create_app()",
+        "run",
+        "--port",
+        str(port),
+    ],
+    "gunicorn": lambda port: [
+        sys.executable,
+        "-m",
+        "gunicorn",
+        "-c",
+        "gunicorn.conf.py",
+        "api:create_app()",
+    ],
+}
+
+
+# a one page pdf, posted to /verify as the first real request
+def tiny_pdf():
+    document = fitz.open()
+    document.new_page(width=612, height=792).insert_text((72, 72), "3.Sys startup")
+    return document.tobytes()
+
+
+def multipart(field, filename, data, content_type):
+    boundary = "3sysbenchboundary"
+    body = (
+        (
+            f"--{boundary}\r\n"
+            f'Content-Disposition: form-data; name="{field}"; filename="{filename}"\r\n'
+            f"Content-Type: {content_type}\r\n\r\n"
+        ).encode()
+        + data
+        + f"\r\n--{boundary}--\r\n".encode()
+    )
+    return (body, f"multipart/form-data; boundary={boundary}")
+
+
+# resident memory in MB of a process and of all its descendants, from /proc
+def process_tree_rss(pid):
+    rss = {}
+    pending = [pid]
+    while pending:
+        current = pending.pop()
+        try:
+            with open(f"/proc/{current}/status") as status:
+                for line in status:
+                    if line.startswith("VmRSS:"):
+                        rss[current] = int(line.split()[1]) / 1024
+            for task in os.listdir(f"/proc/{current}/task"):
+                with open(f"/proc/{current}/task/{task}/children") as children:
+                    pending.extend(int(child) for child in children.read().split())
+        except OSError:
+            continue
+    return rss
+
+
+def measure(name, port, timeout):
+    env = dict(os.environ, PORT=str(port))
+    started = time.perf_counter()
+    server = subprocess.Popen(
+        SERVERS[name](port),
+        cwd=ROOT,
+        env=env,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+    )
+    base_url = f"http://127.0.0.1:{port}"
+    try:
+        while True:
+            if time.perf_counter() - started > timeout:
+                raise SystemExit(f"{name} did not answer within {timeout} s")
+            try:
+                urllib.request.urlopen(base_url + "/", timeout=1).read()
+                break
+            except OSError:
+                time.sleep(0.05)
+        time_to_first_request = time.perf_counter() - started
+
+        (body, content_type) = multipart(
+            "file", "tiny.pdf", tiny_pdf(), "application/pdf"
+        )
+        verify = urllib.request.Request(
+            base_url + "/verify", data=body, headers={"Content-Type": content_type}
+        )
+        request_started = time.perf_counter()
+        try:
+            urllib.request.urlopen(verify, timeout=timeout).read()
+        except urllib.error.HTTPError:
+            # an unsigned document is answered with 422, which is expected here
+            pass
+        first_verify = time.perf_counter() - request_started
+
+        rss = process_tree_rss(server.pid)
+        return {
+            "server": name,
+            "time_to_first_request_s": round(time_to_first_request, 3),
+            "first_verify_s": round(first_verify, 3),
+            "processes": len(rss),
+            "rss_mb_per_process": {str(pid): round(mb, 1) for pid, mb in rss.items()},
+            "rss_mb_total": round(sum(rss.values()), 1),
+        }
+    finally:
+        server.send_signal(signal.SIGTERM)
+        try:
+            server.wait(timeout=30)
+        except subprocess.TimeoutExpired:
+            server.kill()
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="compare cold start of the development server and gunicorn"
+    )
+    parser.add_argument("--servers", nargs="+", default=list(SERVERS))
+    parser.add_argument("--port", type=int, default=5099)
+    parser.add_argument("--timeout", type=float, default=120)
+    args = parser.parse_args()
+    results = [measure(name, args.port, args.timeout) for name in args.servers]
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    main()
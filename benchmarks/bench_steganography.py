@@ -0,0 +1,136 @@
+import argparse
+import os
+import random
+import sys
+import timeit
+from PIL import Image
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from modules.threesys import read_steganography, steganography
+
+
+# the per pixel loops that steganography and read_steganography used before the
+# numpy engine, kept here as the baseline of the benchmark
+def legacy_steganography(image, secret):
+    chunk_size = 2
+    width, height = image.size
+    image_map = image.load()
+    formatted_str = secret + "//3.sys//"
+    secret_ascii = "".join(format(ord(i), "08b") for i in formatted_str)
+    secret_chunks = [
+        secret_ascii[i : i + chunk_size]
+        for i in range(0, len(secret_ascii), chunk_size)
+    ]
+    for i in range(width):
+        for j in range(height):
+            secret_chunks_index = i * height + j
+            if secret_chunks_index < len(secret_chunks):
+                secret_portion = secret_chunks[secret_chunks_index]
+                (r, g, b) = image_map[i, j]
+                bin_r = format(r, "08b")
+                new_bin_r = bin_r[:-chunk_size] + secret_portion
+                new_r = int(new_bin_r, 2)
+                image.putpixel((i, j), (new_r, g, b))
+    return image
+
+
+def legacy_read_steganography(image):
+    chunk_size = 2
+    width, height = image.size
+    image_map = image.load()
+    msg = []
+    byte = ""
+    for i in range(width):
+        for j in range(height):
+            (r, g, b) = image_map[i, j]
+            bin_r = format(r, "08b")
+            chunk = bin_r[-chunk_size:]
+            byte += chunk
+            if len(byte) == 8:
+                msg.append(chr(int(byte, 2)))
+                byte = ""
+    dirty_msg = "".join(msg)
+    marker_i = dirty_msg.find("//3.sys//")
+    if marker_i != -1:
+        return dirty_msg[:marker_i]
+    return False
+
+
+# random rgb image of the given size, noisy so that every bit position is exercised
+def random_image(size, seed):
+    rng = random.Random(seed)
+    return Image.frombytes(
+        "RGB", (size, size), bytes(rng.getrandbits(8) for _ in range(size * size * 3))
+    )
+
+
+def check_compatibility(sizes, secrets):
+    for size in sizes:
+        for seed, secret in enumerate(secrets):
+            legacy = legacy_steganography(random_image(size, seed), secret)
+            current = steganography(random_image(size, seed), secret, version=1)
+            if legacy.tobytes() != current.tobytes():
+                raise SystemExit(f"embedding mismatch at {size}px for {secret!r}")
+            if legacy_read_steganography(legacy) != read_steganography(legacy):
+                raise SystemExit(f"extraction mismatch at {size}px for {secret!r}")
+            v2 = steganography(random_image(size, seed), secret, version=2)
+            if read_steganography(v2) != secret:
+                raise SystemExit(f"v2 round trip failed at {size}px for {secret!r}")
+            noise = random_image(size, seed + 1000)
+            if read_steganography(noise) is not False:
+                raise SystemExit(f"noise accepted as a payload at {size}px")
+
+
+def bench(label, legacy, current, number):
+    legacy_s = timeit.timeit(legacy, number=number) / number
+    current_s = timeit.timeit(current, number=number) / number
+    print(
+        f"{label:<28} legacy {legacy_s * 1000:9.3f} ms   "
+        f"numpy {current_s * 1000:9.3f} ms   speedup {legacy_s / current_s:7.1f}x"
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="compare the numpy steganography engine against the per pixel loops"
+    )
+    parser.add_argument("--sizes", type=int, nargs="+", default=[64, 128, 350])
+    parser.add_argument("--number", type=int, default=20)
+    args = parser.parse_args()
+
+    check_compatibility(args.sizes, ["1", "42", "123456", "9" * 20])
+    print("bit-for-bit compatible with the legacy loops, v2 payloads round trip")
+
+    for size in args.sizes:
+        base = random_image(size, 0)
+        signed = legacy_steganography(base.copy(), "123456")
+        signed_v2 = steganography(base.copy(), "123456", version=2)
+        bench(
+            f"steganography {size}x{size}",
+            lambda: legacy_steganography(base.copy(), "123456"),
+            lambda: steganography(base.copy(), "123456"),
+            args.number,
+        )
+        bench(
+            f"read legacy {size}x{size}",
+            lambda: legacy_read_steganography(signed),
+            lambda: read_steganography(signed),
+            args.number,
+        )
+        bench(
+            f"read v2 {size}x{size}",
+            lambda: legacy_read_steganography(signed),
+            lambda: read_steganography(signed_v2),
+            args.number,
+        )
+        bench(
+            f"reject unsigned {size}x{size}",
+            lambda: legacy_read_steganography(base),
+            lambda: read_steganography(base),
+            args.number,
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,188 @@
+import argparse
+import datetime
+import io
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from collections import Counter
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+
+# end-to-end and micro benchmarks of the api over a synthetic corpus (see corpus.py).
+# Results are printed (or written) as json so that runs on different commits can be
+# compared. The db is either a throwaway embedded sqlite database (default) or the
+# postgres at DATABASE_URL, migrated before the run
+
+
+def summarize(name, samples, **extra):
+    samples_ms = sorted(seconds * 1000 for seconds in samples)
+    return {
+        "name": name,
+        "n": len(samples_ms),
+        "mean_ms": round(statistics.fmean(samples_ms), 3),
+        "median_ms": round(statistics.median(samples_ms), 3),
+        "p95_ms": round(samples_ms[int(0.95 * (len(samples_ms) - 1))], 3),
+        "min_ms": round(samples_ms[0], 3),
+        **extra,
+    }
+
+
+def timed(function, repeat):
+    samples = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        function()
+        samples.append(time.perf_counter() - started)
+    return samples
+
+
+def post(client, endpoint, pdf_bytes, name, **form):
+    data = {"file": (io.BytesIO(pdf_bytes), name), **form}
+    started = time.perf_counter()
+    response = client.post(endpoint, data=data, content_type="multipart/form-data")
+    return (time.perf_counter() - started, response)
+
+
+# /generate on fresh variants of every case, then /verify of the signed, a tampered and
+# a never signed document of the case
+def end_to_end(client, repeat, first_variant):
+    from corpus import CASES, tamper
+
+    results = []
+    for case, build in CASES.items():
+        name = f"{case}.pdf"
+        (samples, statuses, signed) = ([], Counter(), None)
+        for i in range(repeat):
+            pdf_bytes = build(first_variant + i).tobytes()
+            (seconds, response) = post(
+                client, "/generate", pdf_bytes, name, location="bottom-right"
+            )
+            samples.append(seconds)
+            statuses[response.status_code] += 1
+            if response.status_code == 200:
+                signed = response.data
+        results.append(summarize(f"generate/{case}", samples, statuses=statuses))
+
+        documents = {"never_signed": build(first_variant + repeat).tobytes()}
+        if signed is not None:
+            documents["signed"] = signed
+            documents["tampered"] = tamper(signed)
+        for kind, pdf_bytes in documents.items():
+            (samples, statuses) = ([], Counter())
+            for _ in range(repeat):
+                (seconds, response) = post(client, "/verify", pdf_bytes, name)
+                samples.append(seconds)
+                statuses[response.status_code] += 1
+            results.append(
+                summarize(f"verify/{case}/{kind}", samples, statuses=statuses)
+            )
+    return results
+
+
+def micro(repeat):
+    from corpus import CASES
+    from modules.threesys import (
+        generate_dm,
+        get_hash_and_bytes_of_document,
+        read_dm_pylibdmtx,
+        read_steganography,
+        steganography,
+    )
+
+    document = CASES["text_1_page"](0)
+    dm = generate_dm(document)
+    steg_dm = steganography(dm.copy(), "123456")
+    results = [
+        summarize("micro/generate_dm", timed(lambda: generate_dm(document), repeat)),
+        summarize(
+            "micro/steganography",
+            timed(lambda: steganography(dm.copy(), "123456"), repeat),
+        ),
+        summarize(
+            "micro/read_steganography",
+            timed(lambda: read_steganography(steg_dm), repeat),
+        ),
+        summarize(
+            "micro/read_dm_pylibdmtx",
+            timed(lambda: read_dm_pylibdmtx(steg_dm), repeat),
+        ),
+    ]
+    for case in ("text_1_page", "text_100_pages", "images_16"):
+        document = CASES[case](0)
+        results.append(
+            summarize(
+                f"micro/get_hash_and_bytes_of_document/{case}",
+                timed(lambda: get_hash_and_bytes_of_document(document), repeat),
+            )
+        )
+    return results
+
+
+def git_commit():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "HEAD"],
+            cwd=ROOT,
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="benchmark /generate, /verify and their stages on synthetic pdfs"
+    )
+    parser.add_argument("--db", choices=["sqlite", "postgres"], default="sqlite")
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--only", choices=["e2e", "micro"])
+    parser.add_argument("--output", help="write the json here instead of stdout")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        if args.db == "sqlite":
+            path = os.path.join(directory, "threesys.sqlite3")
+            os.environ["DATABASE_URL"] = "sqlite://" + path
+            first_variant = 0
+        else:
+            from db.migrate import migrate
+
+            migrate(os.environ["DATABASE_URL"])
+            # documents signed by earlier runs stay in the db, use new variants
+            first_variant = int(time.time()) * 1000
+
+        from api import create_app
+
+        client = create_app().test_client()
+        results = []
+        if args.only in (None, "micro"):
+            results += micro(args.repeat)
+        if args.only in (None, "e2e"):
+            results += end_to_end(client, args.repeat, first_variant)
+
+    report = {
+        "commit": git_commit(),
+        "date": datetime.datetime.now(datetime.timezone.utc).isoformat(),
+        "python": platform.python_version(),
+        "db": args.db,
+        "repeat": args.repeat,
+        "results": results,
+    }
+    if args.output:
+        with open(args.output, "w") as output:
+            json.dump(report, output, indent=2)
+    else:
+        print(json.dumps(report, indent=2))
+
+
+if __name__ == "__main__":
+    main()
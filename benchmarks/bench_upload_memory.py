@@ -0,0 +1,110 @@
+import argparse
+import io
+import json
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import fitz
+import numpy as np
+from PIL import Image
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+
+# a pdf of about size_mb megabytes: pages carrying an incompressible noise image each
+def noise_pdf(path, size_mb):
+    rng = np.random.default_rng(size_mb)
+    document = fitz.open()
+    written = 0
+    while written < size_mb * 1024 * 1024:
+        noise = rng.integers(0, 256, (1024, 1024, 3), dtype=np.uint8)
+        png = io.BytesIO()
+        Image.fromarray(noise).save(png, "PNG", compress_level=1)
+        page = document.new_page(width=612, height=792)
+        page.insert_image(fitz.Rect(72, 72, 540, 540), stream=png.getvalue())
+        written += png.tell()
+    document.save(path)
+
+
+def peak_rss_mb():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+# runs one request in this (fresh) process and reports how far it raised the peak
+# resident memory above the peak reached by loading the app
+def child(path, endpoint):
+    from api import create_app
+
+    client = create_app().test_client()
+    client.get("/")
+    baseline = peak_rss_mb()
+    with open(path, "rb") as file:
+        response = client.post(
+            f"/{endpoint}",
+            data={"file": (file, "document.pdf")},
+            content_type="multipart/form-data",
+        )
+    peak = peak_rss_mb()
+    print(
+        json.dumps(
+            {
+                "status": response.status_code,
+                "baseline_peak_rss_mb": round(baseline, 1),
+                "request_peak_rss_mb": round(peak, 1),
+                "request_added_mb": round(peak - baseline, 1),
+            }
+        )
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="report the peak memory of one request against the document size"
+    )
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1, 8, 32, 64])
+    parser.add_argument(
+        "--endpoint",
+        choices=["verify", "generate"],
+        default="verify",
+        help="generate needs a DATABASE_URL",
+    )
+    parser.add_argument("--child", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.child:
+        return child(args.child, args.endpoint)
+
+    # every request runs in a process of its own, ru_maxrss never goes down
+    env = dict(
+        os.environ, SIGNED_INDEX="0", MAX_CONTENT_LENGTH=str(max(args.sizes) << 21)
+    )
+    results = []
+    with tempfile.TemporaryDirectory() as directory:
+        for size_mb in args.sizes:
+            path = os.path.join(directory, f"{size_mb}.pdf")
+            noise_pdf(path, size_mb)
+            output = subprocess.run(
+                [
+                    sys.executable,
+                    __file__,
+                    "--child",
+                    path,
+                    "--endpoint",
+                    args.endpoint,
+                ],
+                cwd=ROOT,
+                env=env,
+                capture_output=True,
+                text=True,
+                check=True,
+            ).stdout
+            result = json.loads(output.strip().splitlines()[-1])
+            result["document_mb"] = round(os.path.getsize(path) / (1024 * 1024), 1)
+            results.append(result)
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,70 @@
+import argparse
+import os
+import sys
+import timeit
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from modules.dmrender import module_grid_of_image, render_dm
+from modules.threesys import generate_dm_treepoem, read_dm_pylibdmtx
+
+
+# messages in the shape generate_message produces
+MESSAGES = [
+    "This document was signed using 3.Sys API on January 1, 2023 and is owned by anonymous",
+    "This document was signed using 3.Sys API on December 31, 2024 and is owned by Don Franco Ramos",
+    "This document was signed using 3.Sys API on May 9, 2025 and is owned by a",
+]
+
+
+# compares the in-process rendering of every message with treepoem's, pixel by pixel
+# and module by module, and checks that both decode back to the message
+def main():
+    parser = argparse.ArgumentParser(
+        description="check the in-process dm renderer against treepoem"
+    )
+    parser.add_argument("--number", type=int, default=5)
+    args = parser.parse_args()
+
+    failed = False
+    for message in MESSAGES:
+        treepoem_image = generate_dm_treepoem(message).convert("RGB")
+        libdmtx_image = render_dm(message).copy()
+        treepoem_pixels = np.asarray(treepoem_image)
+        libdmtx_pixels = np.asarray(libdmtx_image)
+        treepoem_grid = module_grid_of_image(treepoem_pixels[:, :, 0] < 128)
+        libdmtx_grid = module_grid_of_image(libdmtx_pixels[:, :, 0] < 128)
+
+        same_size = treepoem_pixels.shape == libdmtx_pixels.shape
+        same_pixels = same_size and (treepoem_pixels == libdmtx_pixels).all()
+        same_grid = treepoem_grid.shape == libdmtx_grid.shape and bool(
+            (treepoem_grid == libdmtx_grid).all()
+        )
+        decodes = read_dm_pylibdmtx(libdmtx_image) == message
+        failed |= not (same_pixels and decodes)
+        print(
+            f"{message[-30:]!r:<34} treepoem {treepoem_image.size} "
+            f"libdmtx {libdmtx_image.size} pixel-equal {same_pixels} "
+            f"module-equal {same_grid} decodes {decodes}"
+        )
+
+    treepoem_s = timeit.timeit(
+        lambda: generate_dm_treepoem(MESSAGES[0]), number=args.number
+    )
+    render_dm.cache_clear()
+    uncached_s = timeit.timeit(
+        lambda: (render_dm.cache_clear(), render_dm(MESSAGES[0])), number=args.number
+    )
+    cached_s = timeit.timeit(lambda: render_dm(MESSAGES[0]).copy(), number=args.number)
+    print(
+        f"treepoem {treepoem_s / args.number * 1000:.2f} ms   "
+        f"libdmtx {uncached_s / args.number * 1000:.2f} ms   "
+        f"libdmtx cached {cached_s / args.number * 1000:.3f} ms"
+    )
+    if failed:
+        raise SystemExit("the in-process renderer differs from treepoem")
+
+
+if __name__ == "__main__":
+    main()
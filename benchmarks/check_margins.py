@@ -0,0 +1,55 @@
+import argparse
+import os
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from corpus import CASES
+from modules.threesys import corner_is_clear, page_content_rects, signature_locations
+
+
+# a corpus document signed in a corner, so that the checks also see occupied corners
+def signed_in(build, location):
+    from modules.dmrender import render_dm
+    from modules.threesys import put_steg_dm_in_pdf
+
+    return put_steg_dm_in_pdf(build(0), render_dm("margin check"), location)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="compare the vector margin check with rendering every corner"
+    )
+    parser.add_argument("--number", type=int, default=20)
+    args = parser.parse_args()
+
+    documents = {case: build(0) for case, build in CASES.items()}
+    documents["signed_bottom_right"] = signed_in(CASES["text_1_page"], "bottom-right")
+    disagreements = 0
+    for name, document in documents.items():
+        page = document[0]
+        vector = render = 0.0
+        for _ in range(args.number):
+            started = time.perf_counter()
+            content_rects = page_content_rects(page)
+            by_vector = [
+                corner_is_clear(page, l, content_rects) for l in signature_locations
+            ]
+            vector += time.perf_counter() - started
+            started = time.perf_counter()
+            by_render = [corner_is_clear(page, l, None) for l in signature_locations]
+            render += time.perf_counter() - started
+        if by_vector != by_render:
+            disagreements += 1
+            print(f"{name}: vector {by_vector} != render {by_render}")
+        print(
+            f"{name:24} four corners: vector {vector / args.number * 1000:7.3f} ms, "
+            f"render {render / args.number * 1000:7.3f} ms, clear {by_render}"
+        )
+    print(f"{disagreements} disagreements")
+
+
+if __name__ == "__main__":
+    main()
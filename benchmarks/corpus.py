@@ -0,0 +1,109 @@
+import io
+import fitz
+import numpy as np
+from PIL import Image
+
+# synthetic pdfs for the benchmarks, built with pymupdf. Every builder takes a variant
+# number that is stamped on the first page, so that the variants of a case are distinct
+# documents (with distinct hashes) of the same shape
+
+letter = (612, 792)
+
+
+def new_document(pages, variant, metadata=None):
+    document = fitz.open()
+    for number in range(pages):
+        page = document.new_page(width=letter[0], height=letter[1])
+        page.insert_text((72, 72), f"3.Sys benchmark document {variant}, page {number}")
+        page.insert_textbox(
+            fitz.Rect(72, 100, 540, 700),
+            "Lorem ipsum dolor sit amet, consectetur adipiscing elit. " * 20,
+            fontsize=10,
+        )
+    if metadata:
+        document.set_metadata(metadata)
+    return document
+
+
+def png_bytes(pixels, mode="RGB"):
+    output = io.BytesIO()
+    Image.fromarray(pixels, mode).save(output, "PNG")
+    return output.getvalue()
+
+
+# a photo-like image: smooth gradients plus noise, never mistaken for a data matrix
+def photo(seed, size=(480, 320)):
+    rng = np.random.default_rng(seed)
+    (width, height) = size
+    gradient = np.linspace(0, 255, width, dtype=np.float32)[None, :, None]
+    pixels = gradient + rng.normal(0, 40, (height, width, 3))
+    return np.clip(pixels, 0, 255).astype(np.uint8)
+
+
+def text_only(variant, pages=1):
+    return new_document(pages, variant)
+
+
+def with_images(variant, images=4, pages=1):
+    document = new_document(pages, variant)
+    page = document[0]
+    for i in range(images):
+        top = 120 + (i % 4) * 140
+        page.insert_image(
+            fitz.Rect(150, top, 462, top + 130), stream=png_bytes(photo(variant + i))
+        )
+    return document
+
+
+# first page image stored as DeviceCMYK, which the api skips
+def with_cmyk_image(variant):
+    document = new_document(1, variant)
+    pixmap = fitz.Pixmap(fitz.csCMYK, fitz.IRect(0, 0, 120, 120), False)
+    pixmap.set_rect(pixmap.irect, (0, 255, 255, 0))
+    document[0].insert_image(fitz.Rect(200, 200, 320, 320), pixmap=pixmap)
+    return document
+
+
+# first page carrying an ordinary (non steg) data matrix, as printed by other software
+def with_existing_dm(variant):
+    from modules.dmrender import render_dm
+
+    document = new_document(1, variant)
+    dm = render_dm(f"existing data matrix {variant}")
+    output = io.BytesIO()
+    dm.save(output, "PNG")
+    document[0].insert_image(fitz.Rect(400, 600, 460, 660), stream=output.getvalue())
+    return document
+
+
+# the metadata google docs exports carry: no author, skia as the producer
+def google_docs(variant, pages=3):
+    return new_document(
+        pages,
+        variant,
+        metadata={
+            "producer": "Skia/PDF m108 Google Docs Renderer",
+            "title": f"Untitled document {variant}",
+            "author": "",
+        },
+    )
+
+
+# builders of the unsigned cases by name
+CASES = {
+    "text_1_page": lambda variant: text_only(variant, pages=1),
+    "text_20_pages": lambda variant: text_only(variant, pages=20),
+    "text_100_pages": lambda variant: text_only(variant, pages=100),
+    "images_4": lambda variant: with_images(variant, images=4),
+    "images_16": lambda variant: with_images(variant, images=16),
+    "cmyk_image": with_cmyk_image,
+    "existing_dm": with_existing_dm,
+    "google_docs": google_docs,
+}
+
+
+# modifies a signed pdf the way a forger would: new text on the first page, saved again
+def tamper(signed_bytes):
+    document = fitz.open(stream=signed_bytes, filetype="pdf")
+    document[0].insert_text((72, 90), "amended")
+    return document.tobytes()
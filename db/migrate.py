@@ -0,0 +1,97 @@
+import argparse
+import os
+import re
+import psycopg2
+from dotenv import load_dotenv
+
+
+MIGRATIONS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "migrations")
+# name of the index a CREATE INDEX statement builds
+CREATE_INDEX = re.compile(
+    r"CREATE\s+(?:UNIQUE\s+)?INDEX\s+(?:CONCURRENTLY\s+)?(?:IF\s+NOT\s+EXISTS\s+)?(\w+)",
+    re.IGNORECASE,
+)
+
+
+# splits a migration file into its statements. Statements are run one at a time and
+# outside of a transaction because CREATE INDEX CONCURRENTLY refuses to run inside one
+def split_statements(sql):
+    lines = [line for line in sql.splitlines() if not line.strip().startswith("--")]
+    return [stmt.strip() for stmt in "\n".join(lines).split(";") if stmt.strip()]
+
+
+# returns the migration files that have not been recorded in schema_migrations yet
+def pending_migrations(cursor):
+    cursor.execute(
+        "CREATE TABLE IF NOT EXISTS schema_migrations "
+        "(name TEXT PRIMARY KEY, applied_at TIMESTAMPTZ NOT NULL DEFAULT now());"
+    )
+    cursor.execute("SELECT name FROM schema_migrations;")
+    applied = {row[0] for row in cursor.fetchall()}
+    names = sorted(name for name in os.listdir(MIGRATIONS_DIR) if name.endswith(".sql"))
+    return [name for name in names if name not in applied]
+
+
+# True when the index exists and is valid, False when it exists but is invalid (a
+# CREATE INDEX CONCURRENTLY that failed leaves it behind), None when it does not exist
+def index_valid(cursor, index_name):
+    cursor.execute(
+        "SELECT i.indisvalid FROM pg_index i JOIN pg_class c ON c.oid = i.indexrelid "
+        "WHERE c.relname = %s AND pg_catalog.pg_table_is_visible(c.oid);",
+        (index_name,),
+    )
+    row = cursor.fetchone()
+    return row[0] if row else None
+
+
+# runs one statement of a migration. The invalid leftover of an earlier failed build of
+# an index is dropped first, IF NOT EXISTS would otherwise keep it, and postgres ignores
+# invalid indexes (ON CONFLICT on its columns then fails)
+def run_statement(cursor, statement):
+    match = CREATE_INDEX.match(statement)
+    if match and index_valid(cursor, match[1]) is False:
+        print(f"dropping invalid index {match[1]}")
+        cursor.execute(f"DROP INDEX CONCURRENTLY IF EXISTS {match[1]};")
+    cursor.execute(statement)
+
+
+# raises when an index created by the statements is missing or invalid, so that the
+# migration is not recorded and runs again once the cause is fixed
+def check_indexes(cursor, name, statements):
+    for statement in statements:
+        match = CREATE_INDEX.match(statement)
+        if match and not index_valid(cursor, match[1]):
+            raise RuntimeError(
+                f"{name}: index {match[1]} is missing or invalid, fix the rows that "
+                "keep it from being built and run the migration again"
+            )
+
+
+def migrate(database_url, dry_run=False):
+    connection = psycopg2.connect(database_url)
+    connection.autocommit = True
+    try:
+        with connection.cursor() as cursor:
+            for name in pending_migrations(cursor):
+                print(f"applying {name}")
+                if dry_run:
+                    continue
+                with open(os.path.join(MIGRATIONS_DIR, name)) as migration:
+                    statements = split_statements(migration.read())
+                for statement in statements:
+                    run_statement(cursor, statement)
+                check_indexes(cursor, name, statements)
+                cursor.execute(
+                    "INSERT INTO schema_migrations (name) VALUES (%s);", (name,)
+                )
+    finally:
+        connection.close()
+
+
+if __name__ == "__main__":
+    load_dotenv()
+    parser = argparse.ArgumentParser(description="apply pending 3.Sys db migrations")
+    parser.add_argument("--database-url", default=os.getenv("DATABASE_URL"))
+    parser.add_argument("--dry-run", action="store_true")
+    args = parser.parse_args()
+    migrate(args.database_url, args.dry_run)
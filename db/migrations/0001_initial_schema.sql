@@ -0,0 +1,15 @@
+-- tables as created by the first deployments of the api. IF NOT EXISTS makes this a
+-- no-op on existing databases
+
+CREATE TABLE IF NOT EXISTS origpdfs (
+    orig_id SERIAL PRIMARY KEY,
+    orig_pdf_hash TEXT NOT NULL,
+    orig_pdf_data BYTEA NOT NULL
+);
+
+CREATE TABLE IF NOT EXISTS threesyspdfs (
+    pdf_id SERIAL PRIMARY KEY,
+    pdf_hash TEXT NOT NULL,
+    pdf_data BYTEA NOT NULL,
+    origpdfs_id INTEGER NOT NULL REFERENCES origpdfs (orig_id)
+);
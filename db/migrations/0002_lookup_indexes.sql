@@ -0,0 +1,9 @@
+-- unique indexes behind the hash and steg id lookups. Built concurrently so that a live
+-- database keeps serving while they are created. Creation fails if duplicate hashes or
+-- steg ids already exist; those rows have to be cleaned up first. A failed build leaves
+-- an invalid index behind, which db/migrate.py drops before building it again, and the
+-- migration is only recorded once every index is valid
+
+CREATE UNIQUE INDEX CONCURRENTLY IF NOT EXISTS origpdfs_orig_pdf_hash_key ON origpdfs (orig_pdf_hash);
+CREATE UNIQUE INDEX CONCURRENTLY IF NOT EXISTS threesyspdfs_pdf_hash_key ON threesyspdfs (pdf_hash);
+CREATE UNIQUE INDEX CONCURRENTLY IF NOT EXISTS threesyspdfs_origpdfs_id_key ON threesyspdfs (origpdfs_id);
@@ -0,0 +1,5 @@
+-- pdf bytes may live in the blob store (BLOB_STORE_URL) instead of the db, in which
+-- case the rows keep only the hash
+
+ALTER TABLE origpdfs ALTER COLUMN orig_pdf_data DROP NOT NULL;
+ALTER TABLE threesyspdfs ALTER COLUMN pdf_data DROP NOT NULL;
@@ -0,0 +1,3 @@
+-- signed pdfs may be stored as a delta against their original (SIGNED_PDF_STORAGE=delta)
+
+ALTER TABLE threesyspdfs ADD COLUMN IF NOT EXISTS pdf_encoding TEXT NOT NULL DEFAULT 'full';
@@ -0,0 +1,5 @@
+-- regular payload of the dm in each signed pdf, stored when it is signed, so that
+-- /verify can answer a byte-identical upload from its hash alone (threesyspdfs_pdf_hash_key).
+-- NULL for pdfs signed before this column existed; those take the full verification
+
+ALTER TABLE threesyspdfs ADD COLUMN IF NOT EXISTS dm_payload TEXT;
@@ -0,0 +1,29 @@
+-- reference schema of the 3.Sys database, kept in sync with the files in migrations/.
+-- apply it to an existing database with: python -m db.migrate
+
+CREATE TABLE IF NOT EXISTS origpdfs (
+    orig_id SERIAL PRIMARY KEY,
+    orig_pdf_hash TEXT NOT NULL,
+    -- NULL when the bytes live in the blob store under orig_pdf_hash
+    orig_pdf_data BYTEA
+);
+
+CREATE TABLE IF NOT EXISTS threesyspdfs (
+    pdf_id SERIAL PRIMARY KEY,
+    pdf_hash TEXT NOT NULL,
+    -- NULL when the bytes live in the blob store under pdf_hash
+    pdf_data BYTEA,
+    -- "full" when pdf_data (or the blob) is the signed pdf, "delta" when pdf_data is a
+    -- modules/pdfdelta.py delta against the original
+    pdf_encoding TEXT NOT NULL DEFAULT 'full',
+    -- regular payload of the signature dm, answers /verify of an unmodified download
+    -- without parsing it. NULL for pdfs signed before it was recorded
+    dm_payload TEXT,
+    origpdfs_id INTEGER NOT NULL REFERENCES origpdfs (orig_id)
+);
+
+-- every lookup of the api goes through one of these, so none of them has to read
+-- the pdf data columns
+CREATE UNIQUE INDEX IF NOT EXISTS origpdfs_orig_pdf_hash_key ON origpdfs (orig_pdf_hash);
+CREATE UNIQUE INDEX IF NOT EXISTS threesyspdfs_pdf_hash_key ON threesyspdfs (pdf_hash);
+CREATE UNIQUE INDEX IF NOT EXISTS threesyspdfs_origpdfs_id_key ON threesyspdfs (origpdfs_id);
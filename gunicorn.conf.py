@@ -0,0 +1,97 @@
+import os
+import multiprocessing
+
+# gunicorn settings of the api, run with:
+#   gunicorn -c gunicorn.conf.py "api:create_app()"
+# every value can be overridden through the environment
+
+bind = f'0.0.0.0:{os.getenv("PORT", "5000")}'
+
+# the app is imported and warmed up once in the master and shared with the workers
+# through fork, instead of every worker loading it on its first request
+preload_app = True
+
+# signing and verifying are cpu bound, so one worker per cpu. A few threads per worker
+# keep the cpus busy while requests wait on the db or on uploads, and hold the requests
+# waiting in the admission lanes (see modules/admission.py)
+workers = int(os.getenv("WEB_CONCURRENCY", str(multiprocessing.cpu_count())))
+threads = int(os.getenv("GUNICORN_THREADS", "8"))
+# uvicorn.workers.UvicornWorker serves the asgi app instead, "asgi:app" (see asgi.py)
+worker_class = os.getenv("GUNICORN_WORKER_CLASS", "gthread")
+timeout = int(os.getenv("GUNICORN_TIMEOUT", "120"))
+graceful_timeout = 30
+keepalive = 5
+
+# workers are recycled after a number of requests, and as soon as their resident memory
+# goes above WORKER_MAX_RSS_MB (see modules/memory.py). uvicorn workers do not count
+# requests, nor call post_request: asgi.py checks their memory on a timer instead
+max_requests = int(os.getenv("GUNICORN_MAX_REQUESTS", "1000"))
+max_requests_jitter = max_requests // 10
+
+accesslog = "-"
+errorlog = "-"
+
+
+# with PROMETHEUS_MULTIPROC_DIR set, every process writes its metrics to files in that
+# directory and /metrics adds them up. Files of an earlier run are removed at start, and
+# those of exited workers are marked dead
+def on_starting(server):
+    multiproc_dir = os.getenv("PROMETHEUS_MULTIPROC_DIR")
+    if multiproc_dir:
+        os.makedirs(multiproc_dir, exist_ok=True)
+        for name in os.listdir(multiproc_dir):
+            if name.endswith(".db"):
+                os.remove(os.path.join(multiproc_dir, name))
+
+
+def child_exit(server, worker):
+    if os.getenv("PROMETHEUS_MULTIPROC_DIR"):
+        from prometheus_client import multiprocess
+
+        multiprocess.mark_process_dead(worker.pid)
+
+
+def when_ready(server):
+    from modules.warmup import warm_up
+
+    if os.getenv("WARM_UP", "1") != "1":
+        return
+    try:
+        timings = warm_up(server.app.wsgi())
+        server.log.info(
+            "warm up done: "
+            + ", ".join(
+                f"{stage} {seconds * 1000:.0f} ms" for stage, seconds in timings.items()
+            )
+        )
+    except Exception as error:
+        server.log.warning(f"warm up failed: {error}")
+
+
+# opens the psycopg2 pool of a gthread worker. uvicorn workers query through the asyncpg
+# pool that asgi.py opens in its lifespan, so theirs would only hold idle connections
+def post_worker_init(worker):
+    import modules.memory
+    from modules.warmup import warm_up_worker
+
+    modules.memory.supervised = True
+    if os.getenv("WARM_UP", "1") != "1":
+        return
+    if "uvicorn" in worker.cfg.worker_class_str.lower():
+        return
+    try:
+        seconds = warm_up_worker()
+        worker.log.info(f"db pool opened in {seconds * 1000:.0f} ms")
+    except Exception as error:
+        worker.log.warning(f"db pool warm up failed: {error}")
+
+
+def post_request(worker, req, environ, resp):
+    from modules.memory import resident_memory_mb, worker_max_rss_mb
+
+    rss_mb = resident_memory_mb()
+    if rss_mb > worker_max_rss_mb and worker.alive:
+        worker.log.info(
+            f"worker {worker.pid} uses {rss_mb:.0f} MB > {worker_max_rss_mb} MB, recycling"
+        )
+        worker.alive = False
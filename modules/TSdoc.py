@@ -1,7 +1,7 @@
-import fitz
-import io
-from PIL import Image
+import time
+from concurrent.futures import FIRST_COMPLETED, wait
 from modules.threesys import *
+from modules.metrics import record_signature_search, timed_stage
 
 
 # class definition that allows the api to define the five document traits of
@@ -9,23 +9,59 @@ from modules.threesys import *
 class TSdoc:
     # initialize GenereateTSdoc the 5 notable traits and the desired location for
     # the dm-steg to be located (default is bottom right)
-    def __init__(self, mode, document_name, document, dm_steg_location=None):
+    # check_modified=False leaves the "modified" trait to the caller, which then looks
+    # up self.steg_messages itself (batch verification does so for many documents at once)
+    # check_signed=False likewise leaves self.already_signed (None until then) to the
+    # caller, the asgi app looks it up without blocking
+    def __init__(
+        self,
+        mode,
+        document_name,
+        document,
+        dm_steg_location=None,
+        raw_hash=None,
+        check_modified=True,
+        check_signed=True,
+    ):
         self.mode = mode
         self.document_name = document_name
+        # sha256 of the bytes as uploaded (may be None)
+        self.raw_hash = raw_hash
         # string of the location where the user may or may not have defined where to put the steg dm
         self.dm_steg_location = self.check_set_dm_steg_location(dm_steg_location)
         # this is a fitz document object
         self.document = document
-        # get hash and bytes of the document
-        (self.hash, self.bytes) = get_hash_and_bytes_of_document(self.document)
+        # get hash and bytes of the document. /verify only needs the hash, so the bytes
+        # of its canonical rewrite are never held in memory
+        if self.mode == "verify":
+            (self.hash, self.bytes) = (get_hash_of_document(self.document), None)
+        else:
+            (self.hash, self.bytes) = get_hash_and_bytes_of_document(self.document)
         # A boolean of if the document has already been previously signed by 3.Sys
-        self.already_signed = check_if_doc_is_already_prev_signed(self.hash)
-        # a list of all the document images (may be empty)
+        if not check_signed:
+            self.already_signed = None
+        elif self.mode == "verify" and skip_signed_lookup_on_verify:
+            self.already_signed = False
+        else:
+            self.already_signed = check_if_doc_is_already_prev_signed(self.hash)
+        # a list of the document images that may be dms (may be empty)
         self.images = self.grab_all_first_page_images()
+        # regular payloads of the dms, keyed by id() of their image, so that no dm is
+        # decoded twice
+        self.dm_payloads = {}
         # a list of all dms derived from self.images (may be empty)
         self.dm_images = self.grab_all_dms_from_images()
+        # hidden messages of the dm stegs, in the order of self.dm_stegs
+        self.steg_messages = []
         # a list of all dm stegs from self.dm_images (may be empty)
         self.dm_stegs = self.grab_all_dm_steg_from_dms()
+        # number of the page the dm stegs were found on, None when there are none. With
+        # SIGNATURE_SEARCH /verify also looks on the pages after the first, for a signed
+        # page that was moved or merged into another document
+        self.signature_page = 0 if self.dm_stegs else None
+        self.search_timed_out = False
+        if self.mode == "verify" and signature_search and not self.dm_stegs:
+            self.search_other_pages()
 
         # All 5 binary traits
         self.traits = {
@@ -33,104 +69,223 @@ class TSdoc:
             "margins": self.document_margins_passed()
             if self.mode == "generate"
             else True,
-            "images": True if self.images else False,
+            "images": self.has_images,
             "dm_images": True if self.dm_images else False,
             "dm_steg": True if self.dm_stegs else False,
             # this is set to default False as it will only be determined by the /verify endpoint
-            "modified": check_if_document_is_modified(self.hash, self.dm_stegs)
-            if self.dm_stegs
+            "modified": check_if_document_is_modified(
+                self.hash, self.dm_stegs, self.raw_hash
+            )
+            if self.dm_stegs and check_modified
             else False,
         }
 
         if not self.traits["modified"] and self.dm_stegs:
-            self.regular_dm_payload = read_dm_pylibdmtx(self.dm_stegs[0])
+            self.regular_dm_payload = self.dm_payloads[id(self.dm_stegs[0])]
 
     def check_set_dm_steg_location(self, location):
         match location:
-            case "top-left" | "top-right" | "bottom-left" | "bottom-right":
+            case "top-left" | "top-right" | "bottom-left" | "bottom-right" | "auto":
                 return location
             case _:
                 return "bottom-right"
 
     # mother function for checking if the margins of the document have enough
-    # white pixel space for the dm-steg to be placed in.
+    # white pixel space for the dm-steg to be placed in. With the "auto" location the
+    # corners are tried in the order of signature_locations and the first clear one
+    # becomes self.dm_steg_location
+    @timed_stage("margins")
     def document_margins_passed(self):
         # print("document_margins_passed")
         page = self.document[0]
-        page_width = page.rect.width
-        page_height = page.rect.height
-        match self.dm_steg_location:
-            case "top-left":
-                corner = fitz.Rect(0, 0, padded_dm, padded_dm)
-            case "top-right":
-                corner = fitz.Rect(page_width - padded_dm, 0, page_width, padded_dm)
-            case "bottom-left":
-                corner = fitz.Rect(0, page_height - padded_dm, padded_dm, page_height)
-            case "bottom-right":
-                corner = fitz.Rect(
-                    page_width - padded_dm,
-                    page_height - padded_dm,
-                    page_width,
-                    page_height,
-                )
-
-        dm_area = page.get_pixmap(clip=corner)
-        return dm_area.is_unicolor
+        content_rects = page_content_rects(page)
+        if self.dm_steg_location != "auto":
+            return corner_is_clear(page, self.dm_steg_location, content_rects)
+        for location in signature_locations:
+            if corner_is_clear(page, location, content_rects):
+                self.dm_steg_location = location
+                return True
+        self.dm_steg_location = "bottom-right"
+        return False
 
-    # indiscirminantly grabs all the images from the first page of the document
+    # grabs the images from the first page of the document that may be a dm. The size
+    # and colorspace of every image are read from the page's image list first: an image
+    # that cannot be a dm is never decoded, unless its pixels are needed to tell whether
+    # it counts for the "images" trait (set in self.has_images)
+    @timed_stage("images")
     def grab_all_first_page_images(self):
         # print("grab_all_first_page_images")
-        page = self.document[0]
-        image_list = page.get_images()
-        images = []
-        for j, img in enumerate(image_list, start=1):
-            xref = img[0]
-            pix = fitz.Pixmap(self.document, xref)
-
-            if pix.colorspace.name == "DeviceCMYK":
-                continue
-
-            image_bytes = pix.tobytes()
-            image = Image.open(io.BytesIO(image_bytes))
-            images.append(image)
+        (images, self.has_images) = page_candidate_images(
+            self.document, self.document[0]
+        )
         return images
 
     # filters out the dms from the collected document images
+    @timed_stage("dm_images")
     def grab_all_dms_from_images(self):
         # print("grab_all_dms_from_images")
         if not self.images:
             return []
-        return list(
-            filter(lambda img: True if read_dm_pylibdmtx(img) else False, self.images)
-        )
+        dm_images = []
+        for img in self.images:
+            payload = read_dm_pylibdmtx(img)
+            if payload:
+                self.dm_payloads[id(img)] = payload
+                dm_images.append(img)
+        return dm_images
 
     # reads every collected dm from the document (if there are any) and checks to see
     # if there are any with valid 3.Sys This function will return false if there are multiple
     # steg valid dms because this is an indicator of a falsified document
 
+    @timed_stage("dm_stegs")
     def grab_all_dm_steg_from_dms(self):
         # print("grab_all_dm_steg_from_dms")
         if not self.dm_images:
             return []
-        return list(
-            filter(
-                lambda img: True if read_steganography(img) else False, self.dm_images
+        dm_stegs = []
+        for img in self.dm_images:
+            steg_message = read_steganography(img)
+            if steg_message:
+                self.steg_messages.append(steg_message)
+                dm_stegs.append(img)
+        return dm_stegs
+
+    # looks for the dm steg on the pages of SIGNATURE_SEARCH_PAGES. The pages are read
+    # here, one after the other (a fitz document must not be used by several threads at
+    # once), while their candidate images are decoded on the search pool. The search
+    # stops at the first page with a dm steg, once the other images of that page are
+    # decoded, or when SIGNATURE_SEARCH_BUDGET_MS runs out (self.search_timed_out). The
+    # traits of the first page are kept, a found page only sets the dm traits
+    @timed_stage("page_search")
+    def search_other_pages(self):
+        # print("search_other_pages")
+        deadline = time.monotonic() + signature_search_budget
+        executor = get_search_executor()
+        # future -> (page number, image) of the images being decoded
+        pending = {}
+        # page number -> [(image, payload, steg message)] of the dm stegs found
+        found = {}
+
+        # waits for decoded images until at most in_flight are left, or, once a page
+        # with a dm steg is found, until no image of that page or before it is left
+        def collect(in_flight):
+            while pending:
+                if found:
+                    if min(n for (n, _) in pending.values()) > min(found):
+                        return
+                elif len(pending) <= in_flight:
+                    return
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    self.search_timed_out = True
+                    return
+                (done, _) = wait(pending, remaining, FIRST_COMPLETED)
+                for future in done:
+                    (page_number, img) = pending.pop(future)
+                    (payload, steg_message) = future.result()
+                    if steg_message:
+                        found.setdefault(page_number, []).append(
+                            (img, payload, steg_message)
+                        )
+
+        try:
+            for page_number in search_page_numbers(
+                signature_search_ranges, self.document.page_count
+            ):
+                if found or self.search_timed_out:
+                    break
+                if time.monotonic() >= deadline:
+                    self.search_timed_out = True
+                    break
+                (images, _) = page_candidate_images(
+                    self.document, self.document[page_number]
+                )
+                for img in images:
+                    pending[executor.submit(classify_dm_image, img)] = (
+                        page_number,
+                        img,
+                    )
+                collect(2 * signature_search_threads)
+            collect(0)
+        finally:
+            for future in pending:
+                future.cancel()
+
+        if not found:
+            record_signature_search(
+                "timed_out" if self.search_timed_out else "not_found"
             )
-        )
+            return
+        record_signature_search("found")
+        self.signature_page = min(found)
+        for (img, payload, steg_message) in found[self.signature_page]:
+            self.dm_payloads[id(img)] = payload
+            self.dm_images.append(img)
+            self.dm_stegs.append(img)
+            self.steg_messages.append(steg_message)
 
-    # generate a dm, steganographize it and add it to the document at the specified location
+    # generate a dm, steganographize it and add it to the document at the specified location.
+    # Returns None when the document turns out to be already signed
 
     def generate_dm_and_add_to_pdf(self):
         # print("generate_dm_and_add_to_pdf")
-        steg_id = save_orig_doc_to_db(self.hash, self.bytes)
-        ord_dm = generate_dm(self.document)
+        # the orig_id hidden in the signature is reserved up front and the document is
+        # signed outside of any transaction, which would otherwise hold the db (the write
+        # lock of sqlite, a pooled connection of postgres) for the whole signature. Both
+        # rows are then written in one short transaction, so a failure part way through
+        # never leaves an original without its signed copy
+        storage = get_storage()
+        steg_id = storage.reserve_orig_ids(1)[0]
+        (message, new_pdf_hash, new_pdf_bytes) = self.sign_with_steg_id(steg_id)
+        (pdf_encoding, pdf_data) = encode_signed_pdf(
+            new_pdf_hash, new_pdf_bytes, self.bytes
+        )
+        row = (
+            steg_id,
+            self.hash,
+            store_pdf_bytes(self.hash, self.bytes),
+            new_pdf_hash,
+            pdf_data,
+            pdf_encoding,
+            message,
+        )
+        with storage.transaction() as connection:
+            inserted = storage.bulk_insert_signed(connection, [row])
+        # the document was signed by another request since __init__ checked, the signed
+        # copy is dropped
+        if steg_id not in inserted:
+            return None
+        signed_index.add(self.hash)
+        return (new_pdf_bytes, self.signed_name())
+
+    # file name of the signed document
+    def signed_name(self):
+        return f'{self.document_name [:self.document_name.find(".pdf")]}-signed.pdf'
+
+    # generates the dm of the document, hides steg_id in it and signs the document with
+    # it. Returns (dm payload, hash, bytes) of the signed pdf, nothing is stored
+    def sign_with_steg_id(self, steg_id):
+        # print("sign_with_steg_id")
+        message = generate_message(self.document.metadata)
+        ord_dm = generate_dm(self.document, message)
         steg_dm = steganography(ord_dm, str(steg_id))
+        (new_pdf_hash, new_pdf_bytes) = self.sign_document(steg_dm)
+        return (message, new_pdf_hash, new_pdf_bytes)
+
+    # puts the steg dm in the document and returns the hash and bytes of the signed pdf.
+    # Incremental signing appends to self.bytes and leaves self.document untouched, the
+    # rewrite fallback modifies self.document and serializes it again
+    @timed_stage("sign")
+    def sign_document(self, steg_dm):
+        # print("sign_document")
+        if signing_mode == "incremental":
+            result = sign_document_incrementally(
+                self.bytes, steg_dm, self.dm_steg_location
+            )
+            if result:
+                return result
         modified_document = put_steg_dm_in_pdf(
             self.document, steg_dm, self.dm_steg_location
         )
-        (new_pdf_hash, new_pdf_bytes) = get_hash_and_bytes_of_document(
-            modified_document
-        )
-        save_modified_doc_to_db(new_pdf_hash, new_pdf_bytes, steg_id)
-        new_name = f'{self.document_name [:self.document_name.find(".pdf")]}-signed.pdf'
-        return (new_pdf_bytes, new_name)
+        return get_hash_and_bytes_of_document(modified_document)
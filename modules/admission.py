@@ -0,0 +1,246 @@
+import os
+import math
+import time
+import asyncio
+import threading
+from contextlib import asynccontextmanager, contextmanager, nullcontext
+from modules.metrics import (
+    admission_active,
+    admission_queued,
+    admission_rejected,
+    admission_wait_seconds,
+)
+
+
+# admission control of the cpu heavy stages of /generate and /verify. Every endpoint has
+# a lane of its own, so that a burst of one cannot take all the threads of the other,
+# and documents whose estimated cost is too high go through the narrow "large" lane
+# whatever their endpoint. A lane runs up to ADMISSION_<LANE>_LIMIT requests at once and
+# lets up to ADMISSION_<LANE>_QUEUE more wait for a slot, each for at most
+# ADMISSION_QUEUE_TIMEOUT_SECONDS. Anything beyond that is answered right away with 503
+# and a Retry-After. Lanes are per worker process, and the threaded ones are sized from
+# the worker threads (see threaded_lane_defaults and make_lanes)
+admission_enabled = os.getenv("ADMISSION_CONTROL", "1") == "1"
+admission_queue_timeout = float(os.getenv("ADMISSION_QUEUE_TIMEOUT_SECONDS", "5"))
+# cost of a document in pages: its page count plus one page per ADMISSION_BYTES_PER_PAGE
+# of upload, images weigh on the rewrite more than text does
+admission_bytes_per_page = int(os.getenv("ADMISSION_BYTES_PER_PAGE", str(256 * 1024)))
+admission_large_cost = float(os.getenv("ADMISSION_LARGE_COST", "200"))
+# threads of a gthread worker (see gunicorn.conf.py). A request waiting for a threaded
+# lane holds its thread, so the defaults of the threaded lanes are derived from it
+worker_threads = int(os.getenv("GUNICORN_THREADS", "8"))
+# (limit, queue) of every lane of the asgi app, where waiting holds no thread, unless
+# overridden through the environment
+lane_defaults = {
+    "generate": (2, 8),
+    "verify": (4, 16),
+    "large": (1, 2),
+}
+
+
+# raised when a lane turns a request away. Answered with 503 by the apps
+class Overloaded(Exception):
+    def __init__(self, lane, retry_after):
+        super().__init__(f"admission lane {lane} is full")
+        self.lane = lane
+        self.retry_after = retry_after
+
+
+# a lane for threaded workers. Keeps the count of running and waiting requests and a
+# moving average of how long a request holds its slot, which sizes Retry-After
+class Lane:
+    def __init__(self, name, limit, queue_limit, queue_timeout):
+        self.name = name
+        self.limit = limit
+        self.queue_limit = queue_limit
+        self.queue_timeout = queue_timeout
+        self.active = 0
+        self.waiting = 0
+        self.admitted = 0
+        self.rejected = 0
+        self.service_seconds = 1.0
+        self.condition = threading.Condition()
+        self.active_gauge = admission_active.labels(name)
+        self.queued_gauge = admission_queued.labels(name)
+        self.wait_histogram = admission_wait_seconds.labels(name)
+
+    # runs the with block in a slot of the lane, waiting for one if need be. Raises
+    # Overloaded when the queue is full or the wait times out
+    @contextmanager
+    def admit(self):
+        with self.condition:
+            started = time.monotonic()
+            if self.active >= self.limit or self.waiting:
+                self.queue()
+                try:
+                    deadline = started + self.queue_timeout
+                    while self.active >= self.limit:
+                        remaining = deadline - time.monotonic()
+                        if remaining <= 0:
+                            raise self.reject("timeout")
+                        self.condition.wait(remaining)
+                finally:
+                    self.dequeue()
+            self.enter(started)
+        try:
+            yield
+        finally:
+            with self.condition:
+                self.leave(started)
+                self.condition.notify()
+
+    # utility functions of admit, shared with AsyncLane. They run under the lane's lock
+    def queue(self):
+        if self.waiting >= self.queue_limit:
+            raise self.reject("queue_full")
+        self.waiting += 1
+        self.queued_gauge.inc()
+
+    def dequeue(self):
+        self.waiting -= 1
+        self.queued_gauge.dec()
+
+    def enter(self, started):
+        self.active += 1
+        self.admitted += 1
+        self.active_gauge.inc()
+        self.wait_histogram.observe(time.monotonic() - started)
+
+    def leave(self, started):
+        self.active -= 1
+        self.active_gauge.dec()
+        seconds = time.monotonic() - started
+        self.service_seconds = 0.8 * self.service_seconds + 0.2 * seconds
+
+    def reject(self, reason):
+        self.rejected += 1
+        admission_rejected.labels(self.name, reason).inc()
+        return Overloaded(self.name, self.retry_after())
+
+    # seconds until the queue ahead of a new request has likely drained. A lane with a
+    # limit of 0 is closed and rejects every request
+    def retry_after(self):
+        return max(
+            1,
+            math.ceil(self.service_seconds * (self.waiting + 1) / max(1, self.limit)),
+        )
+
+    def stats(self):
+        return {
+            "limit": self.limit,
+            "queue_limit": self.queue_limit,
+            "active": self.active,
+            "waiting": self.waiting,
+            "admitted": self.admitted,
+            "rejected": self.rejected,
+            "service_seconds": round(self.service_seconds, 3),
+        }
+
+
+# the same lane for an event loop (asgi.py), waiting without holding a thread
+class AsyncLane(Lane):
+    def __init__(self, name, limit, queue_limit, queue_timeout):
+        super().__init__(name, limit, queue_limit, queue_timeout)
+        self.condition = asyncio.Condition()
+
+    @asynccontextmanager
+    async def admit(self):
+        async with self.condition:
+            started = time.monotonic()
+            if self.active >= self.limit or self.waiting:
+                self.queue()
+                try:
+                    await asyncio.wait_for(
+                        self.condition.wait_for(lambda: self.active < self.limit),
+                        self.queue_timeout,
+                    )
+                except asyncio.TimeoutError:
+                    raise self.reject("timeout")
+                finally:
+                    self.dequeue()
+            self.enter(started)
+        try:
+            yield
+        finally:
+            async with self.condition:
+                self.leave(started)
+                self.condition.notify()
+
+
+# (limit, queue) of every threaded lane of a worker with threads threads. The lanes
+# together hold at most the threads of the worker: the large lane runs one document, and
+# /generate holds a third of the others (at least one running and one waiting) and
+# /verify the rest, so that a burst on either endpoint leaves the other its share
+def threaded_lane_defaults(threads):
+    # print("threaded_lane_defaults")
+    remaining = max(0, threads - 1)
+    generate_threads = max(2, remaining // 3)
+    verify_threads = max(1, remaining - generate_threads)
+    generate_limit = max(1, generate_threads // 2)
+    verify_limit = max(1, (verify_threads + 1) // 2)
+    return {
+        "generate": (generate_limit, generate_threads - generate_limit),
+        "verify": (verify_limit, verify_threads - verify_limit),
+        "large": (1, 0),
+    }
+
+
+# returns the lanes of a process, by name, from their defaults and the environment.
+# Threaded lanes are capped to the threads of the worker all together: every lane keeps
+# one running slot, and the other slots are granted in the order of the lanes for as
+# long as threads are left. Below 3 threads the lanes cannot be kept apart
+def make_lanes(lane_class=Lane):
+    # print("make_lanes")
+    threaded = not issubclass(lane_class, AsyncLane)
+    defaults = threaded_lane_defaults(worker_threads) if threaded else lane_defaults
+    remaining = worker_threads - len(defaults)
+    lanes = {}
+    for (name, (limit, queue_limit)) in defaults.items():
+        limit = int(os.getenv(f"ADMISSION_{name.upper()}_LIMIT", str(limit)))
+        queue_limit = int(
+            os.getenv(f"ADMISSION_{name.upper()}_QUEUE", str(queue_limit))
+        )
+        if threaded:
+            granted = max(0, min(limit - 1 + queue_limit, remaining))
+            remaining -= granted
+            limit = 1 + min(max(0, limit - 1), granted)
+            queue_limit = granted - (limit - 1)
+        lanes[name] = lane_class(name, limit, queue_limit, admission_queue_timeout)
+    return lanes
+
+
+# estimated cost of a document in pages, from its upload size (None when unknown) and
+# its page count
+def estimate_cost(size_bytes, page_count):
+    return page_count + (size_bytes or 0) / admission_bytes_per_page
+
+
+# name of the lane of a document posted to endpoint
+def choose_lane(endpoint, size_bytes, page_count):
+    # print("choose_lane")
+    if estimate_cost(size_bytes, page_count) >= admission_large_cost:
+        return "large"
+    return endpoint
+
+
+lanes = make_lanes()
+
+
+# runs the with block in the lane of a document posted to endpoint (see choose_lane),
+# in the threaded lanes of the flask app
+def admit(endpoint, size_bytes, page_count):
+    return admit_in(lanes, endpoint, size_bytes, page_count)
+
+
+# admit over the given lanes, AsyncLane ones are entered with async with
+def admit_in(lanes, endpoint, size_bytes, page_count):
+    if not admission_enabled:
+        return nullcontext()
+    return lanes[choose_lane(endpoint, size_bytes, page_count)].admit()
+
+
+def admission_stats(lanes):
+    return {
+        "enabled": admission_enabled,
+        "lanes": {name: lane.stats() for (name, lane) in lanes.items()},
+    }
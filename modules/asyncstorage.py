@@ -0,0 +1,209 @@
+import os
+import asyncio
+from urllib.parse import urlparse
+from modules.storage import get_storage
+from modules.signedindex import signed_index
+from modules.threesys import encode_signed_pdf, store_pdf_bytes
+from modules.metrics import timed_query
+
+
+# the queries of the asgi app (asgi.py), which must not block its event loop while it
+# waits on the db. Postgres is reached through an asyncpg pool; the embedded sqlite
+# database has no network round trips to wait on and is run in threads instead
+class AsyncStorage:
+    async def open(self):
+        pass
+
+    async def close(self):
+        pass
+
+    async def orig_exists(self, orig_pdf_hash):
+        raise NotImplementedError
+
+    # returns the pdf_hash of the signed document of an orig_id, or None
+    async def signed_hash(self, orig_id):
+        raise NotImplementedError
+
+    # returns the dm payload stored with the signed document of pdf_hash, or None
+    async def signed_payload(self, pdf_hash):
+        raise NotImplementedError
+
+    # returns (orig_id, orig_pdf_hash) of the originals inserted after orig_id
+    async def origs_since(self, orig_id):
+        raise NotImplementedError
+
+    # stores the original of ts_doc, signs it under the new orig_id and stores the
+    # signed document, in one transaction like TSdoc.generate_dm_and_add_to_pdf. The
+    # signing itself is handed to run_cpu(function, *args). Returns (signed bytes, file
+    # name), or None when the document was signed by another request in the meantime
+    async def sign_and_store(self, ts_doc, run_cpu):
+        raise NotImplementedError
+
+
+# postgres through an asyncpg pool of DB_POOL_MIN to DB_POOL_MAX connections per process
+class AsyncPostgresStorage(AsyncStorage):
+    def __init__(self, database_url):
+        self.database_url = database_url
+        self.pool = None
+
+    async def open(self):
+        import asyncpg
+
+        self.pool = await asyncpg.create_pool(
+            self.database_url or None,
+            min_size=int(os.getenv("DB_POOL_MIN", "1")),
+            max_size=int(os.getenv("DB_POOL_MAX", "10")),
+            timeout=float(os.getenv("DB_POOL_TIMEOUT", "30")),
+        )
+
+    async def close(self):
+        if self.pool is not None:
+            await self.pool.close()
+
+    @timed_query("orig_exists")
+    async def orig_exists(self, orig_pdf_hash):
+        return await self.pool.fetchval(
+            "SELECT EXISTS (SELECT 1 FROM origpdfs WHERE orig_pdf_hash = $1);",
+            orig_pdf_hash,
+        )
+
+    @timed_query("signed_hash")
+    async def signed_hash(self, orig_id):
+        return await self.pool.fetchval(
+            "SELECT pdf_hash FROM threesyspdfs WHERE origpdfs_id = $1;", orig_id
+        )
+
+    @timed_query("signed_payload")
+    async def signed_payload(self, pdf_hash):
+        return await self.pool.fetchval(
+            "SELECT dm_payload FROM threesyspdfs WHERE pdf_hash = $1;", pdf_hash
+        )
+
+    @timed_query("origs_since")
+    async def origs_since(self, orig_id):
+        rows = await self.pool.fetch(
+            "SELECT orig_id, orig_pdf_hash FROM origpdfs WHERE orig_id > $1;", orig_id
+        )
+        return [tuple(row) for row in rows]
+
+    # like the wsgi app, the orig_id is reserved and the document signed before a
+    # connection is taken for the transaction, which only writes the two rows. When the
+    # original was stored in the meantime the signed copy is dropped
+    async def sign_and_store(self, ts_doc, run_cpu):
+        orig_id = await self.reserve_orig_id()
+        (message, new_pdf_hash, new_pdf_bytes) = await run_cpu(
+            ts_doc.sign_with_steg_id, orig_id
+        )
+        orig_pdf_data = await run_cpu(store_pdf_bytes, ts_doc.hash, ts_doc.bytes)
+        (pdf_encoding, pdf_data) = await run_cpu(
+            encode_signed_pdf, new_pdf_hash, new_pdf_bytes, ts_doc.bytes
+        )
+        async with self.pool.acquire() as connection:
+            async with connection.transaction():
+                inserted = await self.insert_orig(
+                    connection, orig_id, ts_doc.hash, orig_pdf_data
+                )
+                if inserted is None:
+                    return None
+                await self.insert_signed(
+                    connection, new_pdf_hash, pdf_data, pdf_encoding, orig_id, message
+                )
+        signed_index.add(ts_doc.hash)
+        return (new_pdf_bytes, ts_doc.signed_name())
+
+    @timed_query("reserve_orig_ids")
+    async def reserve_orig_id(self):
+        return await self.pool.fetchval(
+            "SELECT nextval(pg_get_serial_sequence('origpdfs', 'orig_id'));"
+        )
+
+    @timed_query("insert_orig")
+    async def insert_orig(self, connection, orig_id, orig_pdf_hash, orig_pdf_data):
+        return await connection.fetchval(
+            "INSERT INTO origpdfs (orig_id, orig_pdf_data, orig_pdf_hash) "
+            "VALUES ($1, $2, $3) "
+            "ON CONFLICT (orig_pdf_hash) DO NOTHING RETURNING orig_id;",
+            orig_id,
+            orig_pdf_data,
+            orig_pdf_hash,
+        )
+
+    @timed_query("insert_signed")
+    async def insert_signed(
+        self, connection, pdf_hash, pdf_data, pdf_encoding, orig_id, dm_payload
+    ):
+        await connection.execute(
+            "INSERT INTO threesyspdfs "
+            "(pdf_hash, pdf_data, pdf_encoding, origpdfs_id, dm_payload) "
+            "VALUES ($1, $2, $3, $4, $5);",
+            pdf_hash,
+            pdf_data,
+            pdf_encoding,
+            orig_id,
+            dm_payload,
+        )
+
+
+# any synchronous storage (see modules/storage.py), its queries run in threads. Used for
+# the embedded sqlite database
+class ThreadedStorage(AsyncStorage):
+    def __init__(self, storage):
+        self.storage = storage
+
+    async def orig_exists(self, orig_pdf_hash):
+        return await asyncio.to_thread(self.storage.orig_exists, orig_pdf_hash)
+
+    async def signed_hash(self, orig_id):
+        return await asyncio.to_thread(self.storage.signed_hash, orig_id)
+
+    async def signed_payload(self, pdf_hash):
+        return await asyncio.to_thread(self.storage.signed_payload, pdf_hash)
+
+    async def origs_since(self, orig_id):
+        def query():
+            with self.storage.connection() as connection:
+                return self.storage.origs_since(connection, orig_id)
+
+        return await asyncio.to_thread(query)
+
+    # the transaction of the synchronous storage is bound to its thread, the whole
+    # signature runs as one cpu task
+    async def sign_and_store(self, ts_doc, run_cpu):
+        return await run_cpu(ts_doc.generate_dm_and_add_to_pdf)
+
+
+# url schemes understood by DATABASE_URL and the async backends that handle them
+async_storage_backends = {
+    "": lambda url: AsyncPostgresStorage(url),
+    "postgres": lambda url: AsyncPostgresStorage(url),
+    "postgresql": lambda url: AsyncPostgresStorage(url),
+    "sqlite": lambda url: ThreadedStorage(get_storage()),
+}
+_async_storage = None
+
+
+# opens the async storage configured by DATABASE_URL. Called once per process by the
+# startup of the asgi app, after any fork
+async def open_async_storage():
+    # print("open_async_storage")
+    global _async_storage
+    database_url = os.getenv("DATABASE_URL") or ""
+    scheme = urlparse(database_url).scheme
+    if scheme not in async_storage_backends:
+        raise ValueError(f"unsupported DATABASE_URL scheme: {scheme!r}")
+    storage = async_storage_backends[scheme](database_url)
+    await storage.open()
+    _async_storage = storage
+    return storage
+
+
+def get_async_storage():
+    return _async_storage
+
+
+async def close_async_storage():
+    # print("close_async_storage")
+    global _async_storage
+    if _async_storage is not None:
+        await _async_storage.close()
+        _async_storage = None
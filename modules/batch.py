@@ -0,0 +1,219 @@
+import os
+import hashlib
+import zipfile
+import threading
+import multiprocessing
+from types import SimpleNamespace
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from concurrent.futures.process import BrokenProcessPool
+import fitz
+from werkzeug.utils import secure_filename
+from modules.TSdoc import TSdoc
+from modules.threesys import allowed_file, lookup_signed_hashes
+
+
+# /verify/batch: documents are analyzed by a bounded process pool while the request
+# streams one result per document. The signed-hash lookups of the analyzed documents are
+# made in chunks, one query per chunk, instead of one query per document
+batch_workers = int(os.getenv("BATCH_WORKERS", str(os.cpu_count() or 1)))
+# documents handed to the pool at once, bounds the uploads held in memory
+batch_max_in_flight = int(os.getenv("BATCH_MAX_IN_FLIGHT", str(batch_workers * 2)))
+batch_db_chunk = int(os.getenv("BATCH_DB_CHUNK", "50"))
+# largest accepted body of a batch request, which holds many documents and is exempt
+# from MAX_CONTENT_LENGTH
+batch_max_content_length = int(
+    os.getenv("BATCH_MAX_CONTENT_LENGTH", str(1024 * 1024 * 1024))
+)
+# largest uncompressed member of a zip upload, larger members are reported as errors
+# without being decompressed
+batch_max_file_bytes = int(os.getenv("BATCH_MAX_FILE_BYTES", str(64 * 1024 * 1024)))
+_executor = None
+_executor_pid = None
+_executor_lock = threading.Lock()
+
+
+# returns the batch process pool of the current process, created after any fork and
+# after the pool broke
+def get_batch_executor():
+    # print("get_batch_executor")
+    global _executor, _executor_pid
+    with _executor_lock:
+        if _executor is None or _executor_pid != os.getpid():
+            _executor = ProcessPoolExecutor(
+                max_workers=batch_workers,
+                mp_context=multiprocessing.get_context("forkserver"),
+            )
+            _executor_pid = os.getpid()
+    return _executor
+
+
+# drops a pool whose process died (a crash in MuPDF, an out of memory kill), so that the
+# next get_batch_executor starts a new one
+def discard_batch_executor(executor):
+    # print("discard_batch_executor")
+    global _executor
+    with _executor_lock:
+        if _executor is executor:
+            _executor = None
+    executor.shutdown(wait=False, cancel_futures=True)
+
+
+# yields (file name, pdf bytes) for every document of a batch request: the pdfs of a
+# multipart "files" list, or the pdfs inside a single uploaded zip. Anything that cannot
+# be verified is yielded with an error message instead of bytes, so that it is reported
+# on its own line
+def batch_documents_from_request(req):
+    # print("batch_documents_from_request")
+    uploads = req.files.getlist("files") or req.files.getlist("file")
+    if len(uploads) == 1 and uploads[0].filename.lower().endswith(".zip"):
+        yield from documents_in_zip(uploads[0].stream)
+        return
+    for upload in uploads:
+        name = secure_filename(upload.filename or "")
+        yield (name, upload.read() if allowed_file(name) else "Invalid request")
+
+
+# utility function for batch_documents_from_request that reads the members of a zip one
+# at a time, as the pool asks for more work. A member is never decompressed past
+# BATCH_MAX_FILE_BYTES, whatever size its header declares
+def documents_in_zip(stream):
+    try:
+        archive = zipfile.ZipFile(stream)
+    except zipfile.BadZipFile:
+        yield ("", "Invalid request")
+        return
+    with archive:
+        for member in archive.infolist():
+            if member.is_dir():
+                continue
+            name = secure_filename(os.path.basename(member.filename))
+            if not allowed_file(name):
+                yield (name, "Invalid request")
+                continue
+            if member.file_size > batch_max_file_bytes:
+                yield (name, "Pdf file too large")
+                continue
+            try:
+                with archive.open(member) as file:
+                    pdf_bytes = file.read(batch_max_file_bytes + 1)
+            except (zipfile.BadZipFile, OSError, NotImplementedError) as error:
+                yield (name, str(error))
+                continue
+            if len(pdf_bytes) > batch_max_file_bytes:
+                yield (name, "Pdf file too large")
+                continue
+            yield (name, pdf_bytes)
+
+
+# analyzes one document in a pool process: everything /verify does except the lookup of
+# the signed hash, which the parent batches
+def analyze_for_verify(document_name, pdf_bytes):
+    try:
+        raw_hash = hashlib.sha256(pdf_bytes).hexdigest()
+        document = fitz.open(stream=pdf_bytes, filetype="pdf")
+        ts_doc = TSdoc(
+            "verify", document_name, document, raw_hash=raw_hash, check_modified=False
+        )
+    except Exception as error:
+        return {"file": document_name, "error": str(error)}
+    return {
+        "file": document_name,
+        "hash": ts_doc.hash,
+        "raw_hash": raw_hash,
+        "traits": ts_doc.traits,
+        "steg_messages": ts_doc.steg_messages,
+        "regular_dm_payload": getattr(ts_doc, "regular_dm_payload", None),
+    }
+
+
+# verifies the documents of a batch and yields one result per document as it finishes.
+# A result is either {"file", "error"} or {"file", "ts_doc"}, where ts_doc carries the
+# traits and payload that verify_decision needs. When a pool process dies, the documents
+# it took down with it are reported as errors and the rest go to a new pool
+def verify_batch(documents):
+    # print("verify_batch")
+    executor = get_batch_executor()
+    documents = iter(documents)
+    # future -> (file name, pool) of the documents being analyzed
+    in_flight = {}
+    awaiting_lookup = []
+    exhausted = False
+    while True:
+        while not exhausted and len(in_flight) < batch_max_in_flight:
+            document = next(documents, None)
+            if document is None:
+                exhausted = True
+                break
+            (document_name, pdf_bytes) = document
+            if isinstance(pdf_bytes, str):
+                yield {"file": document_name, "error": pdf_bytes}
+                continue
+            try:
+                future = executor.submit(analyze_for_verify, document_name, pdf_bytes)
+            except BrokenProcessPool:
+                discard_batch_executor(executor)
+                executor = get_batch_executor()
+                future = executor.submit(analyze_for_verify, document_name, pdf_bytes)
+            in_flight[future] = (document_name, executor)
+        if not in_flight:
+            break
+        (done, _) = wait(in_flight, return_when=FIRST_COMPLETED)
+        for future in done:
+            (document_name, pool) = in_flight.pop(future)
+            try:
+                analysis = future.result()
+            except Exception as error:
+                if isinstance(error, BrokenProcessPool) and pool is executor:
+                    discard_batch_executor(executor)
+                    executor = get_batch_executor()
+                analysis = {"file": document_name, "error": str(error) or repr(error)}
+            if "error" in analysis or len(analysis["steg_messages"]) != 1:
+                yield finish_analysis(analysis, {})
+            else:
+                awaiting_lookup.append(analysis)
+        if len(awaiting_lookup) >= batch_db_chunk or (exhausted and not in_flight):
+            yield from finish_chunk(awaiting_lookup)
+            awaiting_lookup = []
+    yield from finish_chunk(awaiting_lookup)
+
+
+# utility function for verify_batch that looks up the signed hashes of a chunk of
+# analyzed documents with a single query
+def finish_chunk(analyses):
+    if not analyses:
+        return
+    steg_ids = {
+        int(analysis["steg_messages"][0])
+        for analysis in analyses
+        if analysis["steg_messages"][0].isdigit()
+    }
+    try:
+        signed_hashes = lookup_signed_hashes(steg_ids)
+    except Exception as error:
+        for analysis in analyses:
+            yield {"file": analysis["file"], "error": str(error)}
+        return
+    for analysis in analyses:
+        yield finish_analysis(analysis, signed_hashes)
+
+
+# utility function for verify_batch that settles the "modified" trait of an analyzed
+# document the way check_if_document_is_modified does
+def finish_analysis(analysis, signed_hashes):
+    if "error" in analysis:
+        return analysis
+    traits = dict(analysis["traits"])
+    if traits["dm_steg"]:
+        steg_message = analysis["steg_messages"][0]
+        signed_hash = (
+            signed_hashes.get(int(steg_message))
+            if len(analysis["steg_messages"]) == 1 and steg_message.isdigit()
+            else None
+        )
+        traits["modified"] = signed_hash not in (analysis["hash"], analysis["raw_hash"])
+    return {
+        "file": analysis["file"],
+        "ts_doc": SimpleNamespace(
+            traits=traits, regular_dm_payload=analysis["regular_dm_payload"]
+        ),
+    }
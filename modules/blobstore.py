@@ -0,0 +1,98 @@
+import os
+import hashlib
+import tempfile
+from urllib.parse import urlparse
+
+
+# content addressed storage for pdf bytes. Blobs are keyed by the sha256 hex digest that
+# get_hash_and_bytes_of_document computes, so the db rows only need to keep the hash
+class BlobStore:
+    # stores data under digest. Storing the same digest twice is a no-op
+    def put(self, digest, data):
+        raise NotImplementedError
+
+    # returns the stored bytes of digest
+    def get(self, digest):
+        raise NotImplementedError
+
+    # returns a readable binary file object of digest, for streaming large blobs
+    def open(self, digest):
+        raise NotImplementedError
+
+    def exists(self, digest):
+        raise NotImplementedError
+
+
+# blob store on the local filesystem. Blobs are sharded into nested directories by the
+# leading characters of their digest (ab/cd/abcd...) to keep directories small, and are
+# written to a temporary file first and renamed into place, so readers never see a
+# partially written blob
+class LocalBlobStore(BlobStore):
+    def __init__(self, root, shard_depth=2, shard_width=2):
+        self.root = root
+        self.shard_depth = shard_depth
+        self.shard_width = shard_width
+        os.makedirs(self.root, exist_ok=True)
+
+    def path(self, digest):
+        digest = digest.lower()
+        if len(digest) != 64 or not all(c in "0123456789abcdef" for c in digest):
+            raise ValueError(f"not a sha256 hex digest: {digest!r}")
+        shards = [
+            digest[i * self.shard_width : (i + 1) * self.shard_width]
+            for i in range(self.shard_depth)
+        ]
+        return os.path.join(self.root, *shards, digest)
+
+    def put(self, digest, data):
+        path = self.path(digest)
+        if os.path.exists(path):
+            return
+        if hashlib.sha256(data).hexdigest() != digest.lower():
+            raise ValueError(f"data does not match digest {digest}")
+        directory = os.path.dirname(path)
+        os.makedirs(directory, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=directory, prefix=".tmp-")
+        try:
+            with os.fdopen(fd, "wb") as tmp:
+                tmp.write(data)
+                tmp.flush()
+                os.fsync(tmp.fileno())
+            os.replace(tmp_path, path)
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+
+    def get(self, digest):
+        with self.open(digest) as blob:
+            return blob.read()
+
+    def open(self, digest):
+        return open(self.path(digest), "rb")
+
+    def exists(self, digest):
+        return os.path.exists(self.path(digest))
+
+
+# url schemes understood by BLOB_STORE_URL and the stores that handle them
+blob_store_backends = {
+    "file": lambda parsed: LocalBlobStore(parsed.path),
+}
+_blob_store = None
+
+
+# returns the blob store configured by BLOB_STORE_URL (e.g. file:///var/lib/threesys/blobs),
+# or None when pdf bytes should stay in the db
+def get_blob_store():
+    # print("get_blob_store")
+    global _blob_store
+    blob_store_url = os.getenv("BLOB_STORE_URL")
+    if not blob_store_url:
+        return None
+    if _blob_store is None:
+        parsed = urlparse(blob_store_url)
+        if parsed.scheme not in blob_store_backends:
+            raise ValueError(f"unsupported BLOB_STORE_URL scheme: {parsed.scheme!r}")
+        _blob_store = blob_store_backends[parsed.scheme](parsed)
+    return _blob_store
@@ -0,0 +1,315 @@
+import argparse
+import hashlib
+import json
+import multiprocessing
+import os
+import sys
+import time
+from collections import Counter, deque
+from concurrent.futures import ProcessPoolExecutor
+import fitz
+from dotenv import load_dotenv
+from modules.TSdoc import TSdoc
+from modules.responses import generate_outcome
+from modules.threesys import encode_signed_pdf, store_pdf_bytes
+from modules.storage import get_storage
+from modules.logs import configure_logging
+
+
+# offline bulk signing of archived pdfs: python -m modules.bulksign SOURCE OUTPUT.
+# Every document goes through the same TSdoc analysis and signing as /generate, on a
+# local process pool. The orig_ids that become the steg payloads are reserved per batch
+# before the documents are signed, so that the rows of a whole batch can be written with
+# one bulk insert (COPY on postgres) in a single transaction. A checkpoint file in
+# OUTPUT records every batch before and after its transaction, and a restarted run skips
+# the documents of the batches that made it to the db
+checkpoint_name = "bulksign.checkpoint.jsonl"
+
+
+# returns the (path, path relative to the source) of the pdfs of a directory tree, or
+# of the files listed one per line in a manifest
+def collect_documents(source):
+    # print("collect_documents")
+    if os.path.isdir(source):
+        paths = [
+            os.path.join(directory, name)
+            for (directory, _, names) in os.walk(source)
+            for name in names
+            if name.lower().endswith(".pdf")
+        ]
+        base = source
+    else:
+        manifest_dir = os.path.dirname(os.path.abspath(source))
+        with open(source) as manifest:
+            paths = [
+                os.path.join(manifest_dir, line.strip())
+                for line in manifest
+                if line.strip() and not line.startswith("#")
+            ]
+        base = os.path.commonpath([os.path.dirname(path) for path in paths] or ["/"])
+    return [(path, os.path.relpath(path, base)) for path in sorted(paths)]
+
+
+# where the signed copy of a document is written, named like the download of /generate
+def output_path(output_dir, relative):
+    # print("output_path")
+    (directory, name) = os.path.split(relative)
+    signed_name = f'{name[:name.lower().find(".pdf")]}-signed.pdf'
+    return os.path.join(output_dir, directory, signed_name)
+
+
+# body of a pool process: analyzes and signs one document under a reserved orig_id and
+# writes the signed copy. Returns the outcome and, when it passed, the db row of the
+# document (see Storage.bulk_insert_signed); the pdf bytes are moved to the blob store
+# here already when one is configured
+def sign_file(path, signed_path, orig_id, dm_steg_location):
+    result = {"path": path, "output": None, "orig_id": None, "row": None}
+    try:
+        with open(path, "rb") as file:
+            raw_hash = hashlib.sha256(file.read()).hexdigest()
+        document = fitz.open(path, filetype="pdf")
+        ts_doc = TSdoc(
+            "generate", os.path.basename(path), document, dm_steg_location, raw_hash
+        )
+        outcome = generate_outcome(ts_doc)
+        if outcome == "pass" and ts_doc.already_signed:
+            outcome = "fail"
+        result["outcome"] = outcome
+        if outcome != "pass":
+            return result
+        (message, new_pdf_hash, new_pdf_bytes) = ts_doc.sign_with_steg_id(orig_id)
+        os.makedirs(os.path.dirname(signed_path), exist_ok=True)
+        with open(signed_path + ".part", "wb") as file:
+            file.write(new_pdf_bytes)
+        os.replace(signed_path + ".part", signed_path)
+        (pdf_encoding, pdf_data) = encode_signed_pdf(
+            new_pdf_hash, new_pdf_bytes, ts_doc.bytes
+        )
+        result.update(
+            output=signed_path,
+            orig_id=orig_id,
+            row=(
+                orig_id,
+                ts_doc.hash,
+                store_pdf_bytes(ts_doc.hash, ts_doc.bytes),
+                new_pdf_hash,
+                pdf_data,
+                pdf_encoding,
+                message,
+            ),
+        )
+    except Exception as error:
+        result.update(outcome="error", error=str(error))
+    return result
+
+
+# json lines file of the batches of a run. A batch is written once before its
+# transaction, with the outcome of every document, and once more after the commit
+class Checkpoint:
+    def __init__(self, path):
+        self.path = path
+        self.file = None
+
+    # returns the paths already done, and the next batch number. A batch without its
+    # commit line is done when its rows are in the db (the run stopped between commit
+    # and checkpoint); otherwise its signed copies are removed, their steg ids were
+    # never stored
+    def recover(self, storage, retry_errors):
+        (batches, committed) = ({}, set())
+        if os.path.exists(self.path):
+            with open(self.path) as file:
+                for line in file:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        # a line cut short by the stop of the previous run
+                        continue
+                    if "documents" in entry:
+                        batches[entry["batch"]] = entry["documents"]
+                    elif entry.get("committed"):
+                        committed.add(entry["batch"])
+        done = set()
+        for (batch, documents) in batches.items():
+            orig_ids = [doc["orig_id"] for doc in documents if doc["orig_id"]]
+            if batch not in committed and orig_ids:
+                if not storage.signed_hashes(orig_ids):
+                    for doc in documents:
+                        if doc["output"] and os.path.exists(doc["output"]):
+                            os.remove(doc["output"])
+                    continue
+            done.update(
+                doc["path"]
+                for doc in documents
+                if doc["outcome"] != "error" or not retry_errors
+            )
+        return (done, max(batches, default=0) + 1)
+
+    def write(self, entry):
+        if self.file is None:
+            self.file = open(self.path, "a")
+        self.file.write(json.dumps(entry) + "\n")
+        self.file.flush()
+        os.fsync(self.file.fileno())
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+
+
+# reserves the orig_ids of a batch and queues its documents on the pool
+def submit_batch(executor, storage, batch, output_dir, dm_steg_location):
+    # print("submit_batch")
+    orig_ids = storage.reserve_orig_ids(len(batch))
+    return [
+        executor.submit(
+            sign_file,
+            path,
+            output_path(output_dir, relative),
+            orig_id,
+            dm_steg_location,
+        )
+        for ((path, relative), orig_id) in zip(batch, orig_ids)
+    ]
+
+
+# waits for the documents of a batch and writes their rows in one transaction.
+# Documents whose original was stored by someone else in the meantime (or appears twice)
+# lose their signed copy and count as failed. Returns the outcomes of the batch
+def ingest_batch(storage, checkpoint, batch_number, futures):
+    # print("ingest_batch")
+    results = [future.result() for future in futures]
+    documents = [
+        {key: result.get(key) for key in ("path", "output", "orig_id", "outcome")}
+        for result in results
+    ]
+    checkpoint.write({"batch": batch_number, "documents": documents})
+    rows = [result["row"] for result in results if result["row"] is not None]
+    with storage.transaction() as connection:
+        inserted = storage.bulk_insert_signed(connection, rows)
+    rejected = []
+    for result in results:
+        if result["row"] is not None and result["orig_id"] not in inserted:
+            os.remove(result["output"])
+            result["outcome"] = "fail"
+            rejected.append(result["path"])
+    checkpoint.write({"batch": batch_number, "committed": True, "rejected": rejected})
+    for result in results:
+        if result["outcome"] == "error":
+            print(f"error: {result['path']}: {result['error']}", file=sys.stderr)
+    return Counter(result["outcome"] for result in results)
+
+
+# signs every pending document of source into output_dir and prints the throughput of
+# each batch and of the whole run. Two batches are in flight at a time, the pool signs
+# the next batch while the rows of the previous one are written
+def bulk_sign(
+    source,
+    output_dir,
+    workers=None,
+    batch_size=64,
+    dm_steg_location="bottom-right",
+    retry_errors=False,
+):
+    # print("bulk_sign")
+    os.makedirs(output_dir, exist_ok=True)
+    storage = get_storage()
+    checkpoint = Checkpoint(os.path.join(output_dir, checkpoint_name))
+    (done, batch_number) = checkpoint.recover(storage, retry_errors)
+    pending = [doc for doc in collect_documents(source) if doc[0] not in done]
+    batches = [pending[i : i + batch_size] for i in range(0, len(pending), batch_size)]
+    print(
+        f"{len(pending)} documents to sign in {len(batches)} batches, "
+        f"{len(done)} done by earlier runs",
+        file=sys.stderr,
+    )
+    totals = Counter()
+    started = time.perf_counter()
+    in_flight = deque()
+    try:
+        with ProcessPoolExecutor(
+            max_workers=workers or os.cpu_count() or 1,
+            mp_context=multiprocessing.get_context("forkserver"),
+            initializer=configure_logging,
+        ) as executor:
+            for batch in batches:
+                in_flight.append(
+                    submit_batch(executor, storage, batch, output_dir, dm_steg_location)
+                )
+                if len(in_flight) > 1:
+                    report_batch(
+                        ingest_batch(
+                            storage, checkpoint, batch_number, in_flight.popleft()
+                        ),
+                        batch_number,
+                        totals,
+                        started,
+                    )
+                    batch_number += 1
+            while in_flight:
+                report_batch(
+                    ingest_batch(
+                        storage, checkpoint, batch_number, in_flight.popleft()
+                    ),
+                    batch_number,
+                    totals,
+                    started,
+                )
+                batch_number += 1
+    finally:
+        checkpoint.close()
+    seconds = time.perf_counter() - started
+    summary = {
+        "documents": sum(totals.values()),
+        "outcomes": dict(totals),
+        "seconds": round(seconds, 3),
+        "docs_per_second": round(sum(totals.values()) / seconds, 3)
+        if seconds
+        else None,
+    }
+    print(json.dumps(summary))
+    return summary
+
+
+# utility function for bulk_sign that adds the outcomes of a batch to the totals and
+# prints the progress of the run
+def report_batch(outcomes, batch_number, totals, started):
+    totals.update(outcomes)
+    seconds = time.perf_counter() - started
+    print(
+        f"batch {batch_number}: {sum(outcomes.values())} documents "
+        f"({outcomes['pass']} signed, {outcomes['error']} errors), "
+        f"{sum(totals.values())} so far at "
+        f"{sum(totals.values()) / seconds:.2f} docs/s",
+        file=sys.stderr,
+    )
+
+
+if __name__ == "__main__":
+    load_dotenv()
+    parser = argparse.ArgumentParser(
+        description="sign a directory (or manifest) of pdfs offline, like /generate"
+    )
+    parser.add_argument("source", help="directory of pdfs, or a file listing them")
+    parser.add_argument("output", help="directory of the signed copies and checkpoint")
+    parser.add_argument("--workers", type=int, help="pool processes, default cpu count")
+    parser.add_argument("--batch-size", type=int, default=64)
+    parser.add_argument(
+        "--location",
+        default="bottom-right",
+        choices=["bottom-right", "bottom-left", "top-right", "top-left", "auto"],
+    )
+    parser.add_argument(
+        "--retry-errors",
+        action="store_true",
+        help="sign again the documents that raised an error in earlier runs",
+    )
+    args = parser.parse_args()
+    configure_logging()
+    bulk_sign(
+        args.source,
+        args.output,
+        args.workers,
+        args.batch_size,
+        args.location,
+        args.retry_errors,
+    )
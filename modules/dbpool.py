@@ -0,0 +1,119 @@
+import os
+import threading
+import time
+from contextlib import contextmanager
+from psycopg2 import pool as psycopg2_pool
+from psycopg2 import extensions as psycopg2_extensions
+
+
+# process wide pool of 3.Sys db connections. The pool is created lazily by the first
+# caller of every process, so gunicorn workers forked from a preloaded master each get
+# their own connections instead of sharing the master's sockets
+_pool = None
+_pool_pid = None
+_pool_slots = None
+_pool_lock = threading.Lock()
+# pools inherited through fork. They are kept referenced and never closed, closing them
+# would terminate the sessions that still belong to the parent process
+_inherited_pools = []
+# time each idle connection was last handed back, used to decide on health checks
+_last_used = {}
+
+
+# returns the pool of the current process, creating it on first use
+def get_pool():
+    # print("get_pool")
+    global _pool, _pool_pid, _pool_slots
+    pid = os.getpid()
+    if _pool is not None and _pool_pid == pid:
+        return _pool
+    with _pool_lock:
+        if _pool is None or _pool_pid != pid:
+            if _pool is not None:
+                _inherited_pools.append(_pool)
+            min_size = int(os.getenv("DB_POOL_MIN", "1"))
+            max_size = int(os.getenv("DB_POOL_MAX", "10"))
+            _pool = psycopg2_pool.ThreadedConnectionPool(
+                min_size, max_size, os.getenv("DATABASE_URL")
+            )
+            _pool_slots = threading.BoundedSemaphore(max_size)
+            _pool_pid = pid
+            _last_used.clear()
+    return _pool
+
+
+# checks out a connection, waiting up to DB_POOL_TIMEOUT seconds when all of them are in
+# use. Connections that sat idle longer than DB_POOL_HEALTH_CHECK_SECONDS are pinged
+# first and replaced if the server has gone away
+def checkout_connection():
+    # print("checkout_connection")
+    pool = get_pool()
+    timeout = float(os.getenv("DB_POOL_TIMEOUT", "30"))
+    if not _pool_slots.acquire(timeout=timeout):
+        raise psycopg2_pool.PoolError("timed out waiting for a db connection")
+    try:
+        health_check_seconds = float(os.getenv("DB_POOL_HEALTH_CHECK_SECONDS", "30"))
+        while True:
+            connection = pool.getconn()
+            idle_since = _last_used.pop(id(connection), None)
+            if connection_is_healthy(connection, idle_since, health_check_seconds):
+                return connection
+            pool.putconn(connection, close=True)
+    except BaseException:
+        _pool_slots.release()
+        raise
+
+
+# hands a connection back to the pool, discarding it if it is broken
+def release_connection(connection):
+    # print("release_connection")
+    pool = get_pool()
+    try:
+        broken = connection.closed
+        if not broken:
+            status = connection.info.transaction_status
+            if status == psycopg2_extensions.TRANSACTION_STATUS_UNKNOWN:
+                broken = True
+            elif status != psycopg2_extensions.TRANSACTION_STATUS_IDLE:
+                connection.rollback()
+        if not broken:
+            _last_used[id(connection)] = time.monotonic()
+        pool.putconn(connection, close=broken)
+    finally:
+        _pool_slots.release()
+
+
+# utility function for checkout_connection that pings connections which have been idle
+# for too long
+def connection_is_healthy(connection, idle_since, health_check_seconds):
+    # print("connection_is_healthy")
+    if connection.closed:
+        return False
+    if idle_since is None or time.monotonic() - idle_since < health_check_seconds:
+        return True
+    try:
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT 1;")
+        connection.rollback()
+        return True
+    except Exception:
+        return False
+
+
+# borrows a pooled connection for the duration of the with block
+@contextmanager
+def db_connection():
+    connection = checkout_connection()
+    try:
+        yield connection
+    finally:
+        release_connection(connection)
+
+
+# borrows a pooled connection and runs the with block as a single transaction, which is
+# committed on success and rolled back on any exception
+@contextmanager
+def db_transaction():
+    with db_connection() as connection:
+        with connection:
+            yield connection
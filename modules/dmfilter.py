@@ -0,0 +1,74 @@
+import os
+import numpy as np
+
+
+# cheap checks that rule out images which cannot be a square data matrix before libdmtx
+# spends its (slow) symbol search on them. Every check is a handful of numpy reductions
+dm_prefilter_enabled = os.getenv("DM_PREFILTER", "1") == "1"
+# widest width:height (or height:width) ratio still treated as a square symbol
+max_aspect_ratio = 1.25
+# share of pixels that must be close to black or white
+min_bilevel_share = 0.8
+# share of a finder edge, or of the quiet zone, that must have the expected colour
+min_edge_share = 0.9
+dark_threshold = 96
+light_threshold = 160
+dm_decode_timeout_ms = int(os.getenv("DM_DECODE_TIMEOUT_MS", "500"))
+
+
+# returns the keyword arguments for pylibdmtx.decode when the image may hold a data
+# matrix, or None when it certainly does not
+def dm_decode_hints(image):
+    # print("dm_decode_hints")
+    hints = {"max_count": 1, "timeout": dm_decode_timeout_ms}
+    if not dm_prefilter_enabled:
+        return hints
+    width, height = image.size
+    if not near_square(width, height):
+        return None
+
+    gray = np.asarray(image.convert("L"))
+    dark = gray < dark_threshold
+    light = gray > light_threshold
+    dark_share = dark.mean()
+    if (dark | light).mean() < min_bilevel_share or not 0.1 < dark_share < 0.9:
+        return None
+
+    # quiet zone: the outermost rows and columns of the image are light
+    border = np.concatenate([light[0], light[-1], light[:, 0], light[:, -1]])
+    if border.mean() < min_edge_share:
+        return None
+
+    # the symbol spans the bounding box of its dark modules, which must be square and
+    # have two adjacent solid edges, the L shaped finder pattern
+    rows = np.flatnonzero(dark.any(axis=1))
+    columns = np.flatnonzero(dark.any(axis=0))
+    (top, bottom, left, right) = (rows[0], rows[-1], columns[0], columns[-1])
+    symbol_width = right - left + 1
+    symbol_height = bottom - top + 1
+    if not near_square(symbol_width, symbol_height):
+        return None
+    symbol = dark[top : bottom + 1, left : right + 1]
+    solid = [
+        symbol[:, 0].mean() >= min_edge_share,
+        symbol[-1].mean() >= min_edge_share,
+        symbol[:, -1].mean() >= min_edge_share,
+        symbol[0].mean() >= min_edge_share,
+    ]
+    if not any(solid[i] and solid[(i + 1) % 4] for i in range(4)):
+        return None
+
+    # large symbols are searched on a shrunk copy, edges are measured on that copy
+    edge = max(symbol_width, symbol_height)
+    shrink = 2 if edge > 200 else 1
+    hints["shrink"] = shrink
+    hints["min_edge"] = int(edge * 0.8 / shrink)
+    hints["max_edge"] = int(edge * 1.2 / shrink) + 1
+    return hints
+
+
+# utility function for dm_decode_hints
+def near_square(width, height):
+    if min(width, height) <= 0:
+        return False
+    return max(width, height) / min(width, height) <= max_aspect_ratio
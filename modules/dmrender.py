@@ -0,0 +1,52 @@
+import os
+from functools import lru_cache
+import numpy as np
+from PIL import Image
+from pylibdmtx.pylibdmtx import encode as pylibdmtx_encode
+
+
+# in-process data matrix rendering through libdmtx, which pylibdmtx already loads for
+# decoding. The geometry follows what treepoem produces for generate_dm: modules of
+# 2pt and a padding of 2pt, rendered at treepoem's default scale of 2 (144 dpi)
+dm_module_px = 4
+dm_padding_px = 4
+dm_background = (255, 255, 255)
+dm_render_cache_size = int(os.getenv("DM_RENDER_CACHE_SIZE", "256"))
+
+
+# returns the rendered dm of message. The image is shared by the cache, so callers that
+# modify it (steganography does) must work on a copy
+@lru_cache(maxsize=dm_render_cache_size)
+def render_dm(message):
+    # print("render_dm")
+    modules = dm_module_grid(message)
+    pixels = np.kron(modules, np.ones((dm_module_px, dm_module_px), dtype=bool))
+    pixels = np.pad(pixels, dm_padding_px, constant_values=False)
+    image = np.empty(pixels.shape + (3,), dtype=np.uint8)
+    image[...] = dm_background
+    image[pixels] = (0, 0, 0)
+    return Image.fromarray(image)
+
+
+# returns the modules of the square data matrix of message as a boolean array, True
+# for dark modules
+def dm_module_grid(message):
+    # print("dm_module_grid")
+    encoded = pylibdmtx_encode(message.encode("utf-8"), size="SquareAuto")
+    pixels = np.frombuffer(encoded.pixels, dtype=np.uint8)
+    pixels = pixels.reshape(encoded.height, encoded.width, encoded.bpp // 8)
+    return module_grid_of_image(pixels[:, :, 0] < 128)
+
+
+# samples the module grid of a rendered data matrix given as a boolean (dark) array. The
+# top row of a symbol starts with a dark module followed by a light one, so the first
+# dark run of that row is one module wide
+def module_grid_of_image(dark):
+    # print("module_grid_of_image")
+    rows = np.flatnonzero(dark.any(axis=1))
+    columns = np.flatnonzero(dark.any(axis=0))
+    (top, bottom, left, right) = (rows[0], rows[-1], columns[0], columns[-1])
+    top_row = dark[top, left : right + 1]
+    module = int(np.argmin(top_row)) or 1
+    center = module // 2
+    return dark[top + center : bottom + 1 : module, left + center : right + 1 : module]
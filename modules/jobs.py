@@ -0,0 +1,257 @@
+import os
+import time
+import uuid
+import sqlite3
+import threading
+import multiprocessing
+from contextlib import contextmanager
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from urllib.parse import urlparse
+import fitz
+from modules.TSdoc import TSdoc
+from modules.responses import generate_outcome
+from modules.logs import configure_logging, log
+
+
+# background /generate jobs. The request handler stores the upload and a job record and
+# hands the job to a local process pool; the worker signs the document and records the
+# outcome. Job state lives behind the JobStore interface so that any gunicorn worker can
+# answer the polls of a job submitted to another one
+jobs_dir = os.getenv("JOBS_DIR", os.path.join(os.getcwd(), "jobs"))
+jobs_ttl_seconds = int(os.getenv("JOBS_TTL_SECONDS", "3600"))
+job_workers = int(os.getenv("JOB_WORKERS", str(os.cpu_count() or 1)))
+
+
+class JobStore:
+    # records a new queued job
+    def create(self, job_id, document_name):
+        raise NotImplementedError
+
+    # updates the given fields (status, outcome, download_name, error) of a job
+    def update(self, job_id, **fields):
+        raise NotImplementedError
+
+    # returns the job as a dict, or None when it does not exist (or has expired)
+    def get(self, job_id):
+        raise NotImplementedError
+
+    # removes jobs older than the ttl together with their files
+    def cleanup(self):
+        raise NotImplementedError
+
+    # path of the upload of a job
+    def upload_path(self, job_id):
+        return os.path.join(self.files_dir, f"{job_id}.upload.pdf")
+
+    # path of the signed pdf of a job
+    def result_path(self, job_id):
+        return os.path.join(self.files_dir, f"{job_id}.signed.pdf")
+
+    def remove_files(self, job_id):
+        for path in (self.upload_path(job_id), self.result_path(job_id)):
+            if os.path.exists(path):
+                os.remove(path)
+
+
+# job store in a local sqlite database, with uploads and results next to it
+class SQLiteJobStore(JobStore):
+    def __init__(self, path, files_dir, ttl_seconds):
+        self.path = path
+        self.files_dir = files_dir
+        self.ttl_seconds = ttl_seconds
+        os.makedirs(self.files_dir, exist_ok=True)
+        directory = os.path.dirname(os.path.abspath(self.path))
+        os.makedirs(directory, exist_ok=True)
+        with self.connect() as connection:
+            connection.execute("PRAGMA journal_mode=WAL;")
+            connection.execute(
+                "CREATE TABLE IF NOT EXISTS jobs ("
+                "job_id TEXT PRIMARY KEY, status TEXT NOT NULL, outcome TEXT, "
+                "document_name TEXT, download_name TEXT, error TEXT, "
+                "created_at REAL NOT NULL, updated_at REAL NOT NULL);"
+            )
+            connection.execute(
+                "CREATE INDEX IF NOT EXISTS jobs_created_at ON jobs (created_at);"
+            )
+
+    # opens a connection for one transaction, committed when the with block succeeds
+    @contextmanager
+    def connect(self):
+        connection = sqlite3.connect(self.path, timeout=30)
+        try:
+            with connection:
+                yield connection
+        finally:
+            connection.close()
+
+    def create(self, job_id, document_name):
+        now = time.time()
+        with self.connect() as connection:
+            connection.execute(
+                "INSERT INTO jobs (job_id, status, document_name, created_at, "
+                "updated_at) VALUES (?, 'queued', ?, ?, ?);",
+                (job_id, document_name, now, now),
+            )
+
+    def update(self, job_id, **fields):
+        columns = ", ".join(f"{column} = ?" for column in fields)
+        with self.connect() as connection:
+            connection.execute(
+                f"UPDATE jobs SET {columns}, updated_at = ? WHERE job_id = ?;",
+                (*fields.values(), time.time(), job_id),
+            )
+
+    def get(self, job_id):
+        with self.connect() as connection:
+            connection.row_factory = sqlite3.Row
+            row = connection.execute(
+                "SELECT * FROM jobs WHERE job_id = ? AND created_at >= ?;",
+                (job_id, time.time() - self.ttl_seconds),
+            ).fetchone()
+        return dict(row) if row else None
+
+    def cleanup(self):
+        with self.connect() as connection:
+            expired = connection.execute(
+                "SELECT job_id FROM jobs WHERE created_at < ?;",
+                (time.time() - self.ttl_seconds,),
+            ).fetchall()
+            for (job_id,) in expired:
+                self.remove_files(job_id)
+            connection.executemany("DELETE FROM jobs WHERE job_id = ?;", expired)
+
+
+# url schemes understood by JOB_STORE_URL and the stores that handle them
+job_store_backends = {
+    "sqlite": lambda parsed: SQLiteJobStore(parsed.path, jobs_dir, jobs_ttl_seconds),
+}
+_job_store = None
+_executor = None
+_executor_pid = None
+_executor_lock = threading.Lock()
+_cleaned_at = 0.0
+
+
+# returns the job store configured by JOB_STORE_URL, a sqlite database in JOBS_DIR by
+# default
+def get_job_store():
+    # print("get_job_store")
+    global _job_store
+    if _job_store is None:
+        job_store_url = os.getenv(
+            "JOB_STORE_URL", "sqlite://" + os.path.join(jobs_dir, "jobs.sqlite3")
+        )
+        parsed = urlparse(job_store_url)
+        if parsed.scheme not in job_store_backends:
+            raise ValueError(f"unsupported JOB_STORE_URL scheme: {parsed.scheme!r}")
+        _job_store = job_store_backends[parsed.scheme](parsed)
+    return _job_store
+
+
+# returns the process pool of the current process, created after any fork and after
+# the pool broke. Pool processes are started by a fork server, forking a threaded web
+# worker is not safe
+def get_executor():
+    # print("get_executor")
+    global _executor, _executor_pid
+    with _executor_lock:
+        if _executor is None or _executor_pid != os.getpid():
+            _executor = ProcessPoolExecutor(
+                max_workers=job_workers,
+                mp_context=multiprocessing.get_context("forkserver"),
+            )
+            _executor_pid = os.getpid()
+    return _executor
+
+
+# drops a pool whose process died, so that the next get_executor starts a new one
+def discard_executor(executor):
+    # print("discard_executor")
+    global _executor
+    with _executor_lock:
+        if _executor is executor:
+            _executor = None
+    executor.shutdown(wait=False)
+
+
+# records a job for the upload, which the caller must already have saved to
+# store.upload_path(job_id), and queues it on the process pool. Expired jobs are swept
+# at most once a minute
+def submit_generate_job(job_id, document_name, dm_steg_location, raw_hash):
+    # print("submit_generate_job")
+    global _cleaned_at
+    store = get_job_store()
+    if time.monotonic() - _cleaned_at > 60:
+        _cleaned_at = time.monotonic()
+        store.cleanup()
+    store.create(job_id, document_name)
+    args = (job_id, document_name, dm_steg_location, raw_hash)
+    executor = get_executor()
+    try:
+        future = executor.submit(run_generate_job, *args)
+    except BrokenProcessPool:
+        discard_executor(executor)
+        executor = get_executor()
+        future = executor.submit(run_generate_job, *args)
+    future.add_done_callback(
+        lambda future: generate_job_finished(job_id, executor, future)
+    )
+
+
+# done callback of a job's future. run_generate_job records its own outcome and errors,
+# an exception here means the job never ran to its end (its pool process died, or the
+# pool was shut down), and the job is marked failed instead of staying queued or running
+def generate_job_finished(job_id, executor, future):
+    if future.cancelled():
+        error = "job cancelled"
+    elif future.exception() is None:
+        return
+    else:
+        error = str(future.exception()) or repr(future.exception())
+        if isinstance(future.exception(), BrokenProcessPool):
+            discard_executor(executor)
+    store = get_job_store()
+    try:
+        store.update(job_id, status="failed", error=error)
+        store.remove_files(job_id)
+    except Exception as update_error:
+        log.warning(
+            "could not mark the job failed",
+            extra={"fields": {"job_id": job_id, "error": str(update_error)}},
+        )
+
+
+def new_job_id():
+    return uuid.uuid4().hex
+
+
+# body of a job, runs in a pool process. Signs the upload exactly like the synchronous
+# /generate and records the outcome, plus the signed pdf when it passed
+def run_generate_job(job_id, document_name, dm_steg_location, raw_hash):
+    configure_logging()
+    store = get_job_store()
+    store.update(job_id, status="running")
+    try:
+        document = fitz.open(store.upload_path(job_id))
+        ts_doc = TSdoc("generate", document_name, document, dm_steg_location, raw_hash)
+        outcome = generate_outcome(ts_doc)
+        download_name = None
+        if outcome == "pass" and ts_doc.already_signed:
+            outcome = "fail"
+        elif outcome == "pass":
+            result = ts_doc.generate_dm_and_add_to_pdf()
+            if result is None:
+                outcome = "fail"
+            else:
+                (new_pdf_bytes, download_name) = result
+                with open(store.result_path(job_id), "wb") as file:
+                    file.write(new_pdf_bytes)
+        store.update(
+            job_id, status="done", outcome=outcome, download_name=download_name
+        )
+    except Exception as error:
+        store.update(job_id, status="failed", error=str(error))
+    finally:
+        if os.path.exists(store.upload_path(job_id)):
+            os.remove(store.upload_path(job_id))
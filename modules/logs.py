@@ -0,0 +1,39 @@
+import os
+import json
+import logging
+
+
+# structured logging of the api: one json object per line, carrying the fields passed as
+# extra={"fields": {...}} next to the message. LOG_FORMAT=text keeps plain lines
+log = logging.getLogger("threesys")
+
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record):
+        entry = {
+            "time": self.formatTime(record),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+        }
+        entry.update(getattr(record, "fields", {}))
+        if record.exc_info:
+            entry["exception"] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+
+# sets up the "threesys" logger once per process, from LOG_LEVEL (default INFO) and
+# LOG_FORMAT (json or text)
+def configure_logging():
+    if log.handlers:
+        return
+    handler = logging.StreamHandler()
+    if os.getenv("LOG_FORMAT", "json") == "json":
+        handler.setFormatter(JsonFormatter())
+    else:
+        handler.setFormatter(
+            logging.Formatter("%(asctime)s %(levelname)s %(name)s %(message)s")
+        )
+    log.addHandler(handler)
+    log.setLevel(os.getenv("LOG_LEVEL", "INFO"))
+    log.propagate = False
@@ -0,0 +1,22 @@
+import os
+
+
+# workers are recycled as soon as their resident memory goes above WORKER_MAX_RSS_MB.
+# gthread workers check after every request (post_request in gunicorn.conf.py); uvicorn
+# workers never call post_request, so asgi.py checks every WORKER_RSS_CHECK_SECONDS
+worker_max_rss_mb = int(os.getenv("WORKER_MAX_RSS_MB", "1024"))
+rss_check_seconds = float(os.getenv("WORKER_RSS_CHECK_SECONDS", "10"))
+# set by gunicorn.conf.py in its workers: a worker that exits is then replaced by the
+# master. A lone uvicorn process is not, so it is never recycled
+supervised = False
+
+
+# resident memory of the current process, from /proc (linux only, 0 elsewhere)
+def resident_memory_mb():
+    # print("resident_memory_mb")
+    try:
+        with open("/proc/self/statm") as statm:
+            pages = int(statm.read().split()[1])
+    except (OSError, IndexError, ValueError):
+        return 0
+    return pages * os.sysconf("SC_PAGE_SIZE") / (1024 * 1024)
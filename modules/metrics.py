@@ -0,0 +1,174 @@
+import os
+import time
+import inspect
+import functools
+from prometheus_client import (
+    CONTENT_TYPE_LATEST,
+    REGISTRY,
+    CollectorRegistry,
+    Counter,
+    Gauge,
+    Histogram,
+    generate_latest,
+    multiprocess,
+)
+
+
+# prometheus metrics of the api, served at /metrics. Under gunicorn every worker keeps its
+# own values; set PROMETHEUS_MULTIPROC_DIR to a directory shared by the workers to have
+# /metrics report the sum over all of them (see gunicorn.conf.py)
+
+# from well under a millisecond (steg reads, indexed queries) to whole documents
+latency_buckets = (
+    0.0005,
+    0.001,
+    0.0025,
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1.0,
+    2.5,
+    5.0,
+    10.0,
+    30.0,
+)
+
+stage_seconds = Histogram(
+    "threesys_stage_seconds",
+    "Time spent in a stage of /generate or /verify",
+    ["stage"],
+    buckets=latency_buckets,
+)
+db_seconds = Histogram(
+    "threesys_db_seconds",
+    "Time spent in a db query, including waiting for a connection",
+    ["query"],
+    buckets=latency_buckets,
+)
+db_errors = Counter(
+    "threesys_db_errors_total", "Db queries that raised an error", ["query"]
+)
+trait_vectors = Counter(
+    "threesys_trait_vectors_total",
+    "TSdoc trait vectors (margins, images, dm_images, dm_steg, modified as bits)",
+    ["endpoint", "traits"],
+)
+decisions = Counter(
+    "threesys_decisions_total",
+    "Outcomes of /generate and /verify",
+    ["endpoint", "outcome"],
+)
+signature_searches = Counter(
+    "threesys_signature_searches_total",
+    "Searches of /verify for a signature past the first page",
+    ["result"],
+)
+
+# admission control, see modules/admission.py. The gauges add up the workers' lanes
+admission_active = Gauge(
+    "threesys_admission_active",
+    "Requests running in an admission lane",
+    ["lane"],
+    multiprocess_mode="livesum",
+)
+admission_queued = Gauge(
+    "threesys_admission_queued",
+    "Requests waiting for a slot of an admission lane",
+    ["lane"],
+    multiprocess_mode="livesum",
+)
+admission_rejected = Counter(
+    "threesys_admission_rejected_total",
+    "Requests answered with 503 by an admission lane",
+    ["lane", "reason"],
+)
+admission_wait_seconds = Histogram(
+    "threesys_admission_wait_seconds",
+    "Time admitted requests waited for a slot of their lane",
+    ["lane"],
+    buckets=latency_buckets,
+)
+
+
+# decorator that records the duration of every call of the function in stage_seconds
+def timed_stage(stage):
+    histogram = stage_seconds.labels(stage)
+
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            started = time.perf_counter()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                histogram.observe(time.perf_counter() - started)
+
+        return wrapper
+
+    return decorator
+
+
+# decorator that records the duration of every call of a db helper in db_seconds, and
+# counts the calls that raised. Coroutine functions are timed until they complete
+def timed_query(query):
+    histogram = db_seconds.labels(query)
+    errors = db_errors.labels(query)
+
+    def decorator(function):
+        if inspect.iscoroutinefunction(function):
+
+            @functools.wraps(function)
+            async def async_wrapper(*args, **kwargs):
+                started = time.perf_counter()
+                try:
+                    return await function(*args, **kwargs)
+                except BaseException:
+                    errors.inc()
+                    raise
+                finally:
+                    histogram.observe(time.perf_counter() - started)
+
+            return async_wrapper
+
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            started = time.perf_counter()
+            try:
+                return function(*args, **kwargs)
+            except BaseException:
+                errors.inc()
+                raise
+            finally:
+                histogram.observe(time.perf_counter() - started)
+
+        return wrapper
+
+    return decorator
+
+
+# counts the trait vector and the outcome of a decision. Returns the trait vector as a
+# string of bits, e.g. "10110"
+def record_decision(endpoint, traits, outcome):
+    bits = "".join(str(int(x)) for x in traits.values())
+    trait_vectors.labels(endpoint, bits).inc()
+    decisions.labels(endpoint, outcome).inc()
+    return bits
+
+
+# result is "found", "not_found" or "timed_out", see TSdoc.search_other_pages
+def record_signature_search(result):
+    signature_searches.labels(result).inc()
+
+
+# returns (body, content type) of the metrics exposition
+def render_metrics():
+    if os.getenv("PROMETHEUS_MULTIPROC_DIR"):
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    else:
+        registry = REGISTRY
+    return (generate_latest(registry), CONTENT_TYPE_LATEST)
@@ -0,0 +1,131 @@
+import re
+import zlib
+import hashlib
+
+
+# binary delta of a signed pdf against its original. A delta is a list of operations
+# that rebuild the target: COPY takes a range of the original, INSERT adds literal bytes.
+# The operations are zlib compressed behind a short magic
+delta_magic = b"3SD1"
+COPY = 1
+INSERT = 2
+# pdf serializations are cut into chunks after every "endobj", so objects that did not
+# change between original and signed pdf line up even when their offsets shifted
+chunk_boundary = re.compile(rb"endobj\s*")
+
+
+# returns a delta that rebuilds target from source
+def make_delta(source, target):
+    # print("make_delta")
+    ops = bytearray()
+    # signing by incremental update only appends to the original
+    if target.startswith(source):
+        append_copy(ops, 0, len(source))
+        append_insert(ops, target[len(source) :])
+        return delta_magic + zlib.compress(bytes(ops))
+
+    source_chunks = {}
+    for start, end in chunk_spans(source):
+        source_chunks.setdefault(hash(source[start:end]), (start, end))
+
+    pending_copy = None
+    literal_start = None
+    for start, end in chunk_spans(target):
+        chunk = target[start:end]
+        match = source_chunks.get(hash(chunk))
+        if match is None or source[match[0] : match[1]] != chunk:
+            if literal_start is None:
+                literal_start = start
+            continue
+        if literal_start is not None:
+            if pending_copy:
+                append_copy(ops, *pending_copy)
+                pending_copy = None
+            append_insert(ops, target[literal_start:start])
+            literal_start = None
+        if pending_copy and pending_copy[0] + pending_copy[1] == match[0]:
+            pending_copy = (pending_copy[0], pending_copy[1] + end - start)
+        else:
+            if pending_copy:
+                append_copy(ops, *pending_copy)
+            pending_copy = (match[0], end - start)
+    if pending_copy:
+        append_copy(ops, *pending_copy)
+    if literal_start is not None:
+        append_insert(ops, target[literal_start:])
+    return delta_magic + zlib.compress(bytes(ops))
+
+
+# rebuilds the target bytes from source and a delta made by make_delta
+def apply_delta(source, delta):
+    # print("apply_delta")
+    if not delta.startswith(delta_magic):
+        raise ValueError("not a 3.Sys pdf delta")
+    ops = zlib.decompress(delta[len(delta_magic) :])
+    target = bytearray()
+    i = 0
+    while i < len(ops):
+        op = ops[i]
+        if op == COPY:
+            offset, i = read_varint(ops, i + 1)
+            length, i = read_varint(ops, i)
+            target += source[offset : offset + length]
+        elif op == INSERT:
+            length, i = read_varint(ops, i + 1)
+            target += ops[i : i + length]
+            i += length
+        else:
+            raise ValueError(f"unknown delta operation {op}")
+    return bytes(target)
+
+
+# rebuilds a signed pdf and checks it against the hash recorded when it was signed
+def reconstruct_signed_pdf(orig_pdf_bytes, delta, pdf_hash):
+    # print("reconstruct_signed_pdf")
+    pdf_bytes = apply_delta(orig_pdf_bytes, delta)
+    if hashlib.sha256(pdf_bytes).hexdigest() != pdf_hash:
+        raise ValueError(f"reconstructed pdf does not match {pdf_hash}")
+    return pdf_bytes
+
+
+# utility function for make_delta that yields the (start, end) spans of the chunks of data
+def chunk_spans(data):
+    start = 0
+    for boundary in chunk_boundary.finditer(data):
+        yield (start, boundary.end())
+        start = boundary.end()
+    if start < len(data):
+        yield (start, len(data))
+
+
+def append_copy(ops, offset, length):
+    ops.append(COPY)
+    write_varint(ops, offset)
+    write_varint(ops, length)
+
+
+def append_insert(ops, data):
+    if not data:
+        return
+    ops.append(INSERT)
+    write_varint(ops, len(data))
+    ops += data
+
+
+def write_varint(ops, value):
+    while value >= 0x80:
+        ops.append((value & 0x7F) | 0x80)
+        value >>= 7
+    ops.append(value)
+
+
+def read_varint(ops, i):
+    value = 0
+    shift = 0
+    while True:
+        byte = ops[i]
+        i += 1
+        value |= (byte & 0x7F) << shift
+        if byte < 0x80:
+            return (value, i)
+        shift += 7
@@ -0,0 +1,156 @@
+import os
+import sys
+import json
+import time
+import hmac
+import cProfile
+import functools
+import threading
+from collections import Counter
+from flask import g, request
+
+
+# opt-in profiling of single /generate and /verify requests. A request carrying the
+# X-Profile-Token header equal to PROFILE_TOKEN is run under cProfile while a sampler
+# thread records its stacks. Both are written to PROFILE_DIR: a .pstats file for
+# pstats/snakeviz, a .collapsed file of folded stacks for flamegraph.pl or speedscope,
+# and a .json file with the document hash and the trait vector of the request. Without
+# PROFILE_TOKEN nothing is ever profiled. The token is never taken from the url, which
+# ends up in access logs
+profile_token = os.getenv("PROFILE_TOKEN") or None
+profile_dir = os.getenv("PROFILE_DIR", os.path.join(os.getcwd(), "profiles"))
+# profiles kept on disk, the oldest are removed beyond that
+profile_max_profiles = int(os.getenv("PROFILE_MAX_PROFILES", "50"))
+profile_sample_interval = float(os.getenv("PROFILE_SAMPLE_INTERVAL_MS", "5")) / 1000
+_profile_lock = threading.Lock()
+
+
+# samples the stack of one thread at a fixed interval and counts the folded stacks
+class StackSampler(threading.Thread):
+    def __init__(self, thread_id, interval):
+        super().__init__(daemon=True)
+        self.thread_id = thread_id
+        self.interval = interval
+        self.stacks = Counter()
+        self.stopped = threading.Event()
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            if frame is None:
+                continue
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(
+                    f"{code.co_name} ({os.path.basename(code.co_filename)}:{frame.f_lineno})"
+                )
+                frame = frame.f_back
+            self.stacks[";".join(reversed(stack))] += 1
+
+    def stop(self):
+        self.stopped.set()
+        self.join()
+
+
+# True when the current request asks for profiling with the right token. The header is
+# compared as the bytes it was sent as (werkzeug decodes headers as latin-1):
+# compare_digest refuses str with non-ascii characters
+def profiling_requested():
+    if profile_token is None:
+        return False
+    token = request.headers.get("X-Profile-Token")
+    return token is not None and hmac.compare_digest(
+        token.encode("latin-1", "replace"), profile_token.encode("utf-8")
+    )
+
+
+# decorator of the /generate and /verify views. The view tags its TSdoc by setting
+# g.ts_doc, which puts the document hash and trait vector on the profile
+def profiled(endpoint):
+    def decorator(view):
+        @functools.wraps(view)
+        def wrapper(*args, **kwargs):
+            if not profiling_requested():
+                return view(*args, **kwargs)
+            return run_profiled(endpoint, view, *args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+# runs one view under both profilers. Only one request per process is profiled at a
+# time, cProfile cannot be nested; the others run normally
+def run_profiled(endpoint, view, *args, **kwargs):
+    if not _profile_lock.acquire(blocking=False):
+        return view(*args, **kwargs)
+    try:
+        profiler = cProfile.Profile()
+        sampler = StackSampler(threading.get_ident(), profile_sample_interval)
+        started = time.perf_counter()
+        sampler.start()
+        profiler.enable()
+        try:
+            response = view(*args, **kwargs)
+        finally:
+            profiler.disable()
+            sampler.stop()
+        seconds = time.perf_counter() - started
+        profile_id = save_profile(endpoint, profiler, sampler, seconds, response)
+        response.headers["X-Profile-Id"] = profile_id
+        return response
+    finally:
+        _profile_lock.release()
+
+
+# writes the three files of a profile and enforces PROFILE_MAX_PROFILES. Returns the
+# profile id, the common name of its files
+def save_profile(endpoint, profiler, sampler, seconds, response):
+    ts_doc = g.get("ts_doc")
+    document_hash = getattr(ts_doc, "hash", None)
+    traits = getattr(ts_doc, "traits", None)
+    profile_id = (
+        f"{time.strftime('%Y%m%dT%H%M%S')}-{endpoint}-"
+        f"{(document_hash or 'nohash')[:12]}-{os.getpid()}"
+    )
+    os.makedirs(profile_dir, exist_ok=True)
+    path = os.path.join(profile_dir, profile_id)
+    profiler.dump_stats(path + ".pstats")
+    with open(path + ".collapsed", "w") as collapsed:
+        for stack, count in sampler.stacks.items():
+            collapsed.write(f"{stack} {count}\n")
+    with open(path + ".json", "w") as metadata:
+        json.dump(
+            {
+                "profile_id": profile_id,
+                "endpoint": endpoint,
+                "document": getattr(ts_doc, "document_name", None),
+                "hash": document_hash,
+                "raw_hash": getattr(ts_doc, "raw_hash", None),
+                "traits": (
+                    "".join(str(int(x)) for x in traits.values()) if traits else None
+                ),
+                "status": response.status_code,
+                "seconds": round(seconds, 6),
+                "samples": sum(sampler.stacks.values()),
+                "sample_interval_ms": profile_sample_interval * 1000,
+            },
+            metadata,
+            indent=2,
+        )
+    remove_old_profiles()
+    return profile_id
+
+
+# utility function for save_profile that keeps the newest PROFILE_MAX_PROFILES profiles
+def remove_old_profiles():
+    profiles = sorted(
+        (entry for entry in os.scandir(profile_dir) if entry.name.endswith(".json")),
+        key=lambda entry: entry.stat().st_mtime,
+    )
+    for entry in profiles[: max(0, len(profiles) - profile_max_profiles)]:
+        base = entry.path[: -len(".json")]
+        for extension in (".json", ".pstats", ".collapsed"):
+            if os.path.exists(base + extension):
+                os.remove(base + extension)
@@ -1,5 +1,7 @@
-from flask import send_file, jsonify, make_response
-import io
+from flask import send_file, jsonify, make_response, Response, stream_with_context
+import json
+from modules.metrics import record_decision, render_metrics
+from modules.logs import log
 
 
 def default_route():
@@ -23,20 +25,39 @@ def input_fail(type):
             response = jsonify({"message": "Pdf size unacceptable"})
             response.status_code = 422
 
+        case 2:
+            response = jsonify({"message": "Pdf file too large"})
+            response.status_code = 413
+
+    return response
+
+
+# a lane of modules/admission.py turned the request away
+def overloaded(retry_after):
+    response = jsonify({"message": "The server is busy, please retry later"})
+    response.status_code = 503
+    response.headers["Retry-After"] = str(retry_after)
+
     return response
 
 
 def generate_pass(TSdoc):
     if TSdoc.already_signed:
         return generate_fail()
-    (new_pdf_data, new_pdf_file_name) = TSdoc.generate_dm_and_add_to_pdf()
-    response = make_response(
-        send_file(
-            io.BytesIO(new_pdf_data),
-            mimetype="application/pdf",
-            download_name=new_pdf_file_name,
-        )
-    )
+    result = TSdoc.generate_dm_and_add_to_pdf()
+    if result is None:
+        return generate_fail()
+    (new_pdf_data, new_pdf_file_name) = result
+    return signed_pdf_response(new_pdf_data, new_pdf_file_name, TSdoc.dm_steg_location)
+
+
+def signed_pdf_response(new_pdf_data, new_pdf_file_name, dm_steg_location):
+    # the signed bytes are the body as they are, instead of being streamed through a
+    # file wrapper in small copied blocks
+    response = Response(new_pdf_data, mimetype="application/pdf")
+    response.headers.set("Content-Disposition", "inline", filename=new_pdf_file_name)
+    # the corner the signature went to, which the "auto" location chooses
+    response.headers["X-Signature-Location"] = dm_steg_location
     response.status_code = 200
 
     return response
@@ -97,10 +118,114 @@ def verify_fail():
     return response
 
 
+def job_accepted(job_id):
+    response = jsonify(
+        {"job_id": job_id, "status": "queued", "status_url": f"/jobs/{job_id}"}
+    )
+    response.status_code = 202
+    response.headers["Location"] = f"/jobs/{job_id}"
+
+    return response
+
+
+def job_not_found():
+    response = jsonify({"message": "No such job, or the job has expired"})
+    response.status_code = 404
+
+    return response
+
+
+# reports a job by its state. A finished job that did not pass answers with the same
+# message and status code that the synchronous /generate would have returned
+def job_status(job):
+    match (job["status"], job["outcome"]):
+        case ("done", "pass"):
+            response = jsonify(
+                {
+                    "job_id": job["job_id"],
+                    "status": "done",
+                    "result_url": f'/jobs/{job["job_id"]}/result',
+                }
+            )
+            response.status_code = 200
+        case ("done", "fail"):
+            response = generate_fail()
+        case ("done", "neutral"):
+            response = generate_neutral()
+        case ("done", _):
+            response = generate_fail_margin()
+        case ("failed", _):
+            response = jsonify(
+                {"job_id": job["job_id"], "status": "failed", "message": job["error"]}
+            )
+            response.status_code = 500
+        case (status, _):
+            response = jsonify({"job_id": job["job_id"], "status": status})
+            response.status_code = 202
+
+    return response
+
+
+def job_result(job, result_path):
+    if job["status"] != "done" or job["outcome"] != "pass":
+        return job_status(job)
+    response = make_response(
+        send_file(
+            result_path,
+            mimetype="application/pdf",
+            download_name=job["download_name"],
+        )
+    )
+    response.status_code = 200
+
+    return response
+
+
+# streams the results of /verify/batch as ndjson, one line per document as it finishes.
+# Each line carries the file name plus the status code and body that /verify would have
+# answered for that document alone
+def verify_batch_response(results):
+    def lines():
+        for result in results:
+            if "error" in result:
+                line = {"file": result["file"], "status": 422}
+                line["message"] = result["error"]
+            else:
+                response = verify_decision(result["ts_doc"])
+                line = {"file": result["file"], "status": response.status_code}
+                line.update(response.get_json())
+            yield json.dumps(line) + "\n"
+
+    return Response(stream_with_context(lines()), mimetype="application/x-ndjson")
+
+
 def generate_decision(TSdoc):
+    match generate_outcome(TSdoc):
+        case "pass":
+            return generate_pass(TSdoc)
+        case "fail":
+            return generate_fail()
+        case "neutral":
+            return generate_neutral()
+        case _:
+            return generate_fail_margin()
+
+
+def verify_decision(TSdoc):
+    match verify_outcome(TSdoc):
+        case "pass":
+            return verify_pass(TSdoc)
+        case "falsified":
+            return verify_falsified()
+        case _:
+            return verify_fail()
+
+
+# classifies the traits of a TSdoc into the outcome of /generate: "pass", "fail",
+# "neutral" or "fail_margin"
+def generate_outcome(TSdoc):
     traits = TSdoc.traits
     # print(traits)
-    print(list(traits.values()))
     # convert dictionary to a binary list
     traitsList = [int(x) for x in list(traits.values())]
     # fmt: off
@@ -113,44 +238,46 @@ def generate_decision(TSdoc):
              [1, 1, 1, 0, 0] |\
              [1, 1, 1, 0, 1] |\
              [1, 1, 0, 0, 1]:
-            return generate_pass(TSdoc)
+            outcome = "pass"
         case [1, 0, 0, 1, 1] |\
              [1, 0, 1, 1, 0] |\
              [1, 0, 0, 1, 0] |\
              [1, 1, 0, 1, 0] |\
              [1, 1, 1, 1, 0] |\
              [1, 1, 1, 1, 1]:
-            return generate_fail()
+            outcome = "fail"
         case [0, 1, 1, 1, 0] |\
              [0, 1, 1, 1, 1] |\
              [1, 0, 1, 1, 1] |\
              [1, 1, 0, 1, 1]:
-            return generate_neutral()
+            outcome = "neutral"
         case _:
-            return generate_fail_margin()
+            outcome = "fail_margin"
+    # fmt: on
+    log_decision("generate", TSdoc, outcome)
+    return outcome
 
 
-# fmt:on
-# fmt: off
-def verify_decision(TSdoc):
+# classifies the traits of a TSdoc into the outcome of /verify: "pass", "falsified" or
+# "fail"
+def verify_outcome(TSdoc):
     traits = TSdoc.traits
     # print(traits)
-    print(list(traits.values()))
     # convert dictionary to a binary list
     traitsList = [int(x) for x in list(traits.values())]
-
+    # fmt: off
     match (traitsList):
         case [1, 0, 1, 1, 0] |\
              [1, 0, 0, 1, 0] |\
              [1, 1, 0, 1, 0] |\
              [1, 1, 1, 1, 0]:
-            return verify_pass(TSdoc)
+            outcome = "pass"
 
         case [1, 0, 0, 1, 1] |\
              [1, 0, 1, 1, 1] |\
              [1, 1, 0, 1, 1] |\
              [1, 1, 1, 1, 1]:
-            return verify_falsified()
+            outcome = "falsified"
 
         case [1, 0, 0, 0, 0] |\
              [1, 0, 0, 0, 1] |\
@@ -160,8 +287,39 @@ def verify_decision(TSdoc):
              [1, 1, 1, 0, 0] |\
              [1, 1, 1, 0, 1] |\
              [1, 1, 0, 0, 1]:
-            return verify_fail()
+            outcome = "fail"
 
         case _:
-            return verify_fail()
-# fmt:on
+            outcome = "fail"
+    # fmt: on
+    log_decision("verify", TSdoc, outcome)
+    return outcome
+
+
+# counts and logs a decision, in place of the print of the trait vector. For /verify,
+# the 1-based page the signature was found on and whether the search of the other pages
+# ran out of time are logged as well
+def log_decision(endpoint, TSdoc, outcome):
+    traits = record_decision(endpoint, TSdoc.traits, outcome)
+    signature_page = getattr(TSdoc, "signature_page", None)
+    log.info(
+        "decision",
+        extra={
+            "fields": {
+                "endpoint": endpoint,
+                "outcome": outcome,
+                "traits": traits,
+                "document": getattr(TSdoc, "document_name", None),
+                "hash": getattr(TSdoc, "hash", None),
+                "signature_page": (
+                    None if signature_page is None else signature_page + 1
+                ),
+                "search_timed_out": getattr(TSdoc, "search_timed_out", False),
+            }
+        },
+    )
+
+
+def metrics_response():
+    (body, content_type) = render_metrics()
+    return Response(body, content_type=content_type)
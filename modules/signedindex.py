@@ -0,0 +1,174 @@
+import os
+import math
+import threading
+import time
+from collections import OrderedDict
+
+
+# bloom filter over sha256 hex digests. The digests are already uniformly distributed, so
+# the bit positions are derived from two slices of the digest (double hashing) instead of
+# hashing the key again
+class BloomFilter:
+    def __init__(self, capacity, error_rate):
+        bits = -capacity * math.log(error_rate) / math.log(2) ** 2
+        self.size = max(8, math.ceil(bits))
+        self.hash_count = max(1, round(self.size / capacity * math.log(2)))
+        self.bits = bytearray(math.ceil(self.size / 8))
+        self.count = 0
+
+    def positions(self, digest):
+        h1 = int(digest[:16], 16)
+        h2 = int(digest[16:32], 16) | 1
+        return [(h1 + i * h2) % self.size for i in range(self.hash_count)]
+
+    def add(self, digest):
+        for position in self.positions(digest):
+            self.bits[position >> 3] |= 1 << (position & 7)
+        self.count += 1
+
+    def __contains__(self, digest):
+        return all(
+            self.bits[position >> 3] & (1 << (position & 7))
+            for position in self.positions(digest)
+        )
+
+    # false positive rate expected for the number of keys added so far
+    def estimated_false_positive_rate(self):
+        fill = 1 - math.exp(-self.hash_count * self.count / self.size)
+        return fill**self.hash_count
+
+
+# in-process membership index of origpdfs.orig_pdf_hash that sits in front of the
+# "already signed" db lookup. A bloom filter answers definite misses without touching
+# the db, a small lru remembers recent confirmed hits, and everything else is confirmed
+# by the db. Hashes inserted by other processes are picked up by a periodic refresh;
+# until then the unique index on orig_pdf_hash still rejects a second signing. Ids are
+# not committed in their order (concurrent transactions, the ids that bulk signing
+# reserves ahead of its inserts), so every refresh reads again the last
+# SIGNED_INDEX_REFRESH_OVERLAP ids below the highest one seen
+class SignedIndex:
+    def __init__(self):
+        self.enabled = os.getenv("SIGNED_INDEX", "1") == "1"
+        self.capacity = int(os.getenv("SIGNED_INDEX_CAPACITY", "1000000"))
+        self.error_rate = float(os.getenv("SIGNED_INDEX_ERROR_RATE", "0.01"))
+        self.lru_size = int(os.getenv("SIGNED_INDEX_LRU_SIZE", "1024"))
+        self.refresh_seconds = float(os.getenv("SIGNED_INDEX_REFRESH_SECONDS", "5"))
+        self.refresh_overlap = int(os.getenv("SIGNED_INDEX_REFRESH_OVERLAP", "10000"))
+        self.bloom = None
+        self.recent_hits = OrderedDict()
+        self.max_orig_id = 0
+        self.refreshed_at = 0.0
+        self.lock = threading.Lock()
+        self.lookups = 0
+        self.lru_hits = 0
+        self.definite_misses = 0
+        self.db_confirmed = 0
+        self.false_positives = 0
+
+    # loads every stored hash into a fresh bloom filter. Uses its own short lived
+    # connection so that it can run in a preloading master before workers fork
+    def warm_load(self, storage):
+        with storage.standalone_connection() as connection:
+            (count, max_orig_id) = storage.orig_stats(connection)
+            bloom = BloomFilter(max(self.capacity, count * 2), self.error_rate)
+            for orig_pdf_hash in storage.iter_orig_hashes(connection, max_orig_id):
+                bloom.add(orig_pdf_hash)
+        with self.lock:
+            self.bloom = bloom
+            self.max_orig_id = max_orig_id
+            self.refreshed_at = time.monotonic()
+
+    # adds the hashes inserted since the last load or refresh
+    def refresh(self, storage, connection):
+        self.add_rows(storage.origs_since(connection, self.refresh_from()))
+
+    # the orig_id after which a refresh reads the originals: the overlap window below
+    # the highest id seen, for rows committed after higher ids
+    def refresh_from(self):
+        return max(0, self.max_orig_id - self.refresh_overlap)
+
+    # adds (orig_id, orig_pdf_hash) rows read by the caller, see refresh. Hashes of the
+    # overlap window that are in the filter already are not counted again
+    def add_rows(self, rows):
+        with self.lock:
+            for (orig_id, orig_pdf_hash) in rows:
+                if orig_pdf_hash not in self.bloom:
+                    self.bloom.add(orig_pdf_hash)
+                self.max_orig_id = max(self.max_orig_id, orig_id)
+            self.refreshed_at = time.monotonic()
+
+    # True when a refresh is due, used by the db helper that owns the connection
+    def needs_refresh(self):
+        return (
+            self.bloom is not None
+            and time.monotonic() - self.refreshed_at >= self.refresh_seconds
+        )
+
+    # answers whether digest is a signed original. db_lookup(digest) is only called when
+    # neither the bloom filter nor the lru can answer
+    def contains(self, digest, db_lookup):
+        result = self.lookup(digest)
+        if result is not None:
+            return result
+        result = db_lookup(digest)
+        self.confirm(digest, result)
+        return result
+
+    # first half of contains, for callers that query the db themselves: True or False
+    # when the lru or the bloom filter answers, None when the db has to be asked
+    def lookup(self, digest):
+        with self.lock:
+            self.lookups += 1
+            if digest in self.recent_hits:
+                self.recent_hits.move_to_end(digest)
+                self.lru_hits += 1
+                return True
+            if self.bloom is not None and digest not in self.bloom:
+                self.definite_misses += 1
+                return False
+        return None
+
+    # second half of contains: records the answer of the db to a lookup
+    def confirm(self, digest, result):
+        with self.lock:
+            if result is True:
+                self.db_confirmed += 1
+                self.recent_hits[digest] = True
+                if len(self.recent_hits) > self.lru_size:
+                    self.recent_hits.popitem(last=False)
+            elif result is False and self.bloom is not None:
+                self.false_positives += 1
+
+    # records a freshly inserted original. Only the bloom filter is updated, the lru
+    # holds hits confirmed by the db alone, so a rolled back insert can never be
+    # reported as signed
+    def add(self, digest):
+        with self.lock:
+            if self.bloom is not None:
+                self.bloom.add(digest)
+
+    # counters of the index. The observed false positive rate is the share of unsigned
+    # documents that the bloom filter failed to rule out
+    def stats(self):
+        with self.lock:
+            negatives = self.definite_misses + self.false_positives
+            bloom = self.bloom
+            return {
+                "enabled": self.enabled,
+                "loaded": bloom is not None,
+                "keys": bloom.count if bloom else 0,
+                "lookups": self.lookups,
+                "lru_hits": self.lru_hits,
+                "definite_misses": self.definite_misses,
+                "db_confirmed": self.db_confirmed,
+                "false_positives": self.false_positives,
+                "observed_false_positive_rate": (
+                    self.false_positives / negatives if negatives else 0.0
+                ),
+                "estimated_false_positive_rate": (
+                    bloom.estimated_false_positive_rate() if bloom else 0.0
+                ),
+            }
+
+
+signed_index = SignedIndex()
@@ -0,0 +1,39 @@
+import argparse
+import sys
+from dotenv import load_dotenv
+
+# loaded before the modules below, which read their settings at import time
+load_dotenv()
+
+from modules.threesys import get_signed_pdf_bytes
+
+
+# writes a stored signed pdf back out: python -m modules.signedpdf PDF_HASH [OUTPUT].
+# The bytes are those /generate returned, read from the db or the blob store and, with
+# SIGNED_PDF_STORAGE=delta, rebuilt from the original and checked against PDF_HASH. Used
+# to hand a lost signed copy back to its owner, or to check that stored deltas rebuild
+def export_signed_pdf(pdf_hash, output=None):
+    # print("export_signed_pdf")
+    try:
+        pdf_bytes = get_signed_pdf_bytes(pdf_hash)
+    except ValueError as error:
+        raise SystemExit(f"error: {error}")
+    if pdf_bytes is None:
+        raise SystemExit(f"error: no signed pdf with hash {pdf_hash}")
+    if output is None or output == "-":
+        sys.stdout.buffer.write(pdf_bytes)
+        sys.stdout.buffer.flush()
+    else:
+        with open(output, "wb") as file:
+            file.write(pdf_bytes)
+    return len(pdf_bytes)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="write a stored signed pdf, as /generate returned it"
+    )
+    parser.add_argument("pdf_hash", help="sha256 of the signed pdf")
+    parser.add_argument("output", nargs="?", help="file to write, default stdout")
+    args = parser.parse_args()
+    export_signed_pdf(args.pdf_hash, args.output)
@@ -0,0 +1,457 @@
+import io
+import os
+import sqlite3
+import threading
+from contextlib import contextmanager
+from urllib.parse import urlparse
+import psycopg2
+from modules.dbpool import db_connection, db_transaction
+from modules.metrics import timed_query
+
+
+# the queries of the 3.Sys db behind one interface, so that the api runs against the
+# postgres at DATABASE_URL or against an embedded sqlite database on single node
+# deployments. The queries are written once with %s placeholders; a backend only adapts
+# what its dialect does differently. Writes take the connection of the caller's
+# transaction, reads borrow one of their own
+class Storage:
+    # borrows a connection for the duration of the with block
+    @contextmanager
+    def connection(self):
+        raise NotImplementedError
+
+    # borrows a connection and runs the with block as a single transaction, committed on
+    # success and rolled back on any exception
+    @contextmanager
+    def transaction(self):
+        raise NotImplementedError
+
+    # opens a connection of its own, outside of any pool, for the with block. Used to
+    # warm load the signed index in a preloading master before workers fork
+    @contextmanager
+    def standalone_connection(self):
+        raise NotImplementedError
+
+    # adapts a %s query to the dialect of the backend
+    def prepare(self, query):
+        return query
+
+    def execute(self, connection, query, params=()):
+        cursor = connection.cursor()
+        cursor.execute(self.prepare(query), params)
+        return cursor
+
+    # inserts an original and returns its orig_id, the steg payload of its signature, or
+    # None when the same document is already stored
+    @timed_query("insert_orig")
+    def insert_orig(self, connection, orig_pdf_hash, orig_pdf_data):
+        row = self.execute(
+            connection,
+            "INSERT INTO origpdfs (orig_pdf_data, orig_pdf_hash) VALUES (%s, %s) "
+            "ON CONFLICT (orig_pdf_hash) DO NOTHING RETURNING orig_id;",
+            (orig_pdf_data, orig_pdf_hash),
+        ).fetchone()
+        return row[0] if row else None
+
+    @timed_query("insert_signed")
+    def insert_signed(
+        self, connection, pdf_hash, pdf_data, pdf_encoding, orig_id, dm_payload=None
+    ):
+        self.execute(
+            connection,
+            "INSERT INTO threesyspdfs "
+            "(pdf_hash, pdf_data, pdf_encoding, origpdfs_id, dm_payload) "
+            "VALUES (%s, %s, %s, %s, %s);",
+            (pdf_hash, pdf_data, pdf_encoding, orig_id, dm_payload),
+        )
+
+    @timed_query("orig_exists")
+    def orig_exists(self, orig_pdf_hash):
+        with self.connection() as connection:
+            return bool(
+                self.execute(
+                    connection,
+                    "SELECT EXISTS (SELECT 1 FROM origpdfs WHERE orig_pdf_hash = %s);",
+                    (orig_pdf_hash,),
+                ).fetchone()[0]
+            )
+
+    # returns the pdf_hash of the signed document of an orig_id, or None
+    @timed_query("signed_hash")
+    def signed_hash(self, orig_id):
+        with self.connection() as connection:
+            row = self.execute(
+                connection,
+                "SELECT pdf_hash FROM threesyspdfs WHERE origpdfs_id = %s;",
+                (orig_id,),
+            ).fetchone()
+        return row[0] if row else None
+
+    # returns the dm payload stored with the signed document whose returned bytes hash
+    # to pdf_hash, or None when there is no such document or no payload was stored
+    @timed_query("signed_payload")
+    def signed_payload(self, pdf_hash):
+        with self.connection() as connection:
+            row = self.execute(
+                connection,
+                "SELECT dm_payload FROM threesyspdfs WHERE pdf_hash = %s;",
+                (pdf_hash,),
+            ).fetchone()
+        return row[0] if row else None
+
+    # returns a dict of orig_id to the pdf_hash of its signed document, leaving out ids
+    # without one
+    @timed_query("signed_hashes")
+    def signed_hashes(self, orig_ids):
+        with self.connection() as connection:
+            return dict(
+                self.execute(
+                    connection,
+                    "SELECT origpdfs_id, pdf_hash FROM threesyspdfs "
+                    "WHERE origpdfs_id = ANY(%s);",
+                    (list(orig_ids),),
+                ).fetchall()
+            )
+
+    # returns (pdf_data, pdf_encoding, orig_pdf_hash, orig_pdf_data) of a signed
+    # document, or None
+    @timed_query("signed_pdf_row")
+    def signed_pdf_row(self, pdf_hash):
+        with self.connection() as connection:
+            return self.execute(
+                connection,
+                "SELECT t.pdf_data, t.pdf_encoding, o.orig_pdf_hash, o.orig_pdf_data "
+                "FROM threesyspdfs t JOIN origpdfs o ON o.orig_id = t.origpdfs_id "
+                "WHERE t.pdf_hash = %s;",
+                (pdf_hash,),
+            ).fetchone()
+
+    # reserves count orig_ids ahead of their inserts, for bulk signing where the steg
+    # payload must be known before the rows are written. Ids never inserted stay unused
+    @timed_query("reserve_orig_ids")
+    def reserve_orig_ids(self, count):
+        with self.connection() as connection:
+            return [
+                row[0]
+                for row in self.execute(
+                    connection,
+                    "SELECT nextval(pg_get_serial_sequence('origpdfs', 'orig_id')) "
+                    "FROM generate_series(1, %s);",
+                    (count,),
+                ).fetchall()
+            ]
+
+    # inserts many signed documents with their originals under reserved orig_ids. Every
+    # row is (orig_id, orig_pdf_hash, orig_pdf_data, pdf_hash, pdf_data, pdf_encoding,
+    # dm_payload). An original that is already stored (or repeated in rows) is skipped
+    # together with its signed document; returns the set of orig_ids inserted
+    @timed_query("bulk_insert_signed")
+    def bulk_insert_signed(self, connection, rows):
+        if not rows:
+            return set()
+        cursor = connection.cursor()
+        cursor.executemany(
+            self.prepare(
+                "INSERT INTO origpdfs (orig_id, orig_pdf_hash, orig_pdf_data) "
+                "VALUES (%s, %s, %s) ON CONFLICT (orig_pdf_hash) DO NOTHING;"
+            ),
+            [row[:3] for row in rows],
+        )
+        orig_ids = [row[0] for row in rows]
+        stored = set(
+            self.execute(
+                connection,
+                "SELECT orig_id, orig_pdf_hash FROM origpdfs "
+                "WHERE orig_id BETWEEN %s AND %s;",
+                (min(orig_ids), max(orig_ids)),
+            ).fetchall()
+        )
+        inserted = [row for row in rows if (row[0], row[1]) in stored]
+        cursor.executemany(
+            self.prepare(
+                "INSERT INTO threesyspdfs "
+                "(pdf_hash, pdf_data, pdf_encoding, origpdfs_id, dm_payload) "
+                "VALUES (%s, %s, %s, %s, %s);"
+            ),
+            [(row[3], row[4], row[5], row[0], row[6]) for row in inserted],
+        )
+        return {row[0] for row in inserted}
+
+    # returns (count, max orig_id) of the stored originals
+    def orig_stats(self, connection):
+        return self.execute(
+            connection, "SELECT count(*), coalesce(max(orig_id), 0) FROM origpdfs;"
+        ).fetchone()
+
+    # yields the hashes of the originals up to max_orig_id
+    def iter_orig_hashes(self, connection, max_orig_id):
+        cursor = self.execute(
+            connection,
+            "SELECT orig_pdf_hash FROM origpdfs WHERE orig_id <= %s;",
+            (max_orig_id,),
+        )
+        for (orig_pdf_hash,) in cursor:
+            yield orig_pdf_hash
+
+    # returns (orig_id, orig_pdf_hash) of the originals inserted after orig_id
+    @timed_query("origs_since")
+    def origs_since(self, connection, orig_id):
+        return self.execute(
+            connection,
+            "SELECT orig_id, orig_pdf_hash FROM origpdfs WHERE orig_id > %s;",
+            (orig_id,),
+        ).fetchall()
+
+
+# the postgres db at DATABASE_URL, through the per-process pool of modules/dbpool.py
+class PostgresStorage(Storage):
+    def __init__(self, database_url):
+        self.database_url = database_url
+
+    @contextmanager
+    def connection(self):
+        with db_connection() as connection:
+            yield connection
+
+    @contextmanager
+    def transaction(self):
+        with db_transaction() as connection:
+            yield connection
+
+    @contextmanager
+    def standalone_connection(self):
+        connection = psycopg2.connect(self.database_url)
+        try:
+            yield connection
+        finally:
+            connection.close()
+
+    # the rows are copied into a temporary table and inserted from there, COPY itself
+    # cannot skip conflicting rows. Runs once per transaction
+    @timed_query("bulk_insert_signed")
+    def bulk_insert_signed(self, connection, rows):
+        if not rows:
+            return set()
+        cursor = connection.cursor()
+        cursor.execute(
+            "CREATE TEMP TABLE bulk_signed (orig_id INTEGER, orig_pdf_hash TEXT, "
+            "orig_pdf_data BYTEA, pdf_hash TEXT, pdf_data BYTEA, pdf_encoding TEXT, "
+            "dm_payload TEXT) ON COMMIT DROP;"
+        )
+        cursor.copy_expert("COPY bulk_signed FROM STDIN;", copy_text(rows))
+        cursor.execute(
+            "INSERT INTO origpdfs (orig_id, orig_pdf_hash, orig_pdf_data) "
+            "SELECT orig_id, orig_pdf_hash, orig_pdf_data FROM bulk_signed "
+            "ON CONFLICT (orig_pdf_hash) DO NOTHING RETURNING orig_id;"
+        )
+        inserted = [row[0] for row in cursor.fetchall()]
+        cursor.execute(
+            "INSERT INTO threesyspdfs "
+            "(pdf_hash, pdf_data, pdf_encoding, origpdfs_id, dm_payload) "
+            "SELECT pdf_hash, pdf_data, pdf_encoding, orig_id, dm_payload "
+            "FROM bulk_signed WHERE orig_id = ANY(%s);",
+            (inserted,),
+        )
+        return set(inserted)
+
+    # streamed through a server side cursor, the table may hold millions of rows
+    def iter_orig_hashes(self, connection, max_orig_id):
+        with connection.cursor(name="signed_index_warm_load") as cursor:
+            cursor.itersize = 10000
+            cursor.execute(
+                "SELECT orig_pdf_hash FROM origpdfs WHERE orig_id <= %s;",
+                (max_orig_id,),
+            )
+            for (orig_pdf_hash,) in cursor:
+                yield orig_pdf_hash
+
+
+# embedded sqlite database, for single node deployments without a db server. The schema
+# mirrors db/schema.sql and is created on first use. WAL mode lets readers run next to
+# the single writer, and every thread keeps a connection of its own
+class SQLiteStorage(Storage):
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS origpdfs (
+            orig_id INTEGER PRIMARY KEY AUTOINCREMENT,
+            orig_pdf_hash TEXT NOT NULL,
+            orig_pdf_data BLOB
+        );
+        CREATE TABLE IF NOT EXISTS threesyspdfs (
+            pdf_id INTEGER PRIMARY KEY AUTOINCREMENT,
+            pdf_hash TEXT NOT NULL,
+            pdf_data BLOB,
+            pdf_encoding TEXT NOT NULL DEFAULT 'full',
+            origpdfs_id INTEGER NOT NULL REFERENCES origpdfs (orig_id),
+            dm_payload TEXT
+        );
+        CREATE UNIQUE INDEX IF NOT EXISTS origpdfs_orig_pdf_hash_key
+            ON origpdfs (orig_pdf_hash);
+        CREATE UNIQUE INDEX IF NOT EXISTS threesyspdfs_pdf_hash_key
+            ON threesyspdfs (pdf_hash);
+        CREATE UNIQUE INDEX IF NOT EXISTS threesyspdfs_origpdfs_id_key
+            ON threesyspdfs (origpdfs_id);
+    """
+
+    def __init__(self, path, timeout):
+        self.path = path
+        self.timeout = timeout
+        self.local = threading.local()
+        directory = os.path.dirname(os.path.abspath(self.path))
+        os.makedirs(directory, exist_ok=True)
+        with self.standalone_connection() as connection:
+            connection.execute("PRAGMA journal_mode=WAL;")
+            connection.executescript(self.SCHEMA)
+            # columns added after the first release, for databases created before them
+            columns = {
+                row[1] for row in connection.execute("PRAGMA table_info(threesyspdfs);")
+            }
+            if "dm_payload" not in columns:
+                connection.execute(
+                    "ALTER TABLE threesyspdfs ADD COLUMN dm_payload TEXT;"
+                )
+
+    def connect(self):
+        connection = sqlite3.connect(self.path, timeout=self.timeout)
+        # WAL makes NORMAL durable across application crashes, and spares an fsync per
+        # commit
+        connection.execute("PRAGMA synchronous=NORMAL;")
+        connection.execute("PRAGMA foreign_keys=ON;")
+        return connection
+
+    # the connection of the current thread, opened on first use. Connections are never
+    # carried across a fork
+    @contextmanager
+    def connection(self):
+        if getattr(self.local, "pid", None) != os.getpid():
+            self.local.connection = self.connect()
+            self.local.pid = os.getpid()
+        yield self.local.connection
+
+    @contextmanager
+    def transaction(self):
+        with self.connection() as connection:
+            with connection:
+                yield connection
+
+    @contextmanager
+    def standalone_connection(self):
+        connection = self.connect()
+        try:
+            yield connection
+        finally:
+            connection.close()
+
+    def prepare(self, query):
+        return query.replace("%s", "?")
+
+    # RETURNING needs sqlite 3.35, older than what Debian bullseye ships. The id of the
+    # new row is read from the cursor instead, an ignored conflict inserts no row
+    @timed_query("insert_orig")
+    def insert_orig(self, connection, orig_pdf_hash, orig_pdf_data):
+        cursor = self.execute(
+            connection,
+            "INSERT INTO origpdfs (orig_pdf_data, orig_pdf_hash) VALUES (%s, %s) "
+            "ON CONFLICT (orig_pdf_hash) DO NOTHING;",
+            (orig_pdf_data, orig_pdf_hash),
+        )
+        return cursor.lastrowid if cursor.rowcount == 1 else None
+
+    # the AUTOINCREMENT counter of origpdfs is moved past the reserved ids, in a write
+    # transaction of its own so that concurrent inserts never take one of them
+    @timed_query("reserve_orig_ids")
+    def reserve_orig_ids(self, count):
+        with self.connection() as connection:
+            connection.execute("BEGIN IMMEDIATE;")
+            try:
+                row = connection.execute(
+                    "SELECT seq FROM sqlite_sequence WHERE name = 'origpdfs';"
+                ).fetchone()
+                last = row[0] if row else 0
+                if row:
+                    connection.execute(
+                        "UPDATE sqlite_sequence SET seq = ? WHERE name = 'origpdfs';",
+                        (last + count,),
+                    )
+                else:
+                    connection.execute(
+                        "INSERT INTO sqlite_sequence (name, seq) VALUES ('origpdfs', ?);",
+                        (last + count,),
+                    )
+                connection.commit()
+            except BaseException:
+                connection.rollback()
+                raise
+        return list(range(last + 1, last + count + 1))
+
+    # sqlite has no arrays, the ids become an IN list
+    @timed_query("signed_hashes")
+    def signed_hashes(self, orig_ids):
+        orig_ids = list(orig_ids)
+        if not orig_ids:
+            return {}
+        placeholders = ", ".join("?" * len(orig_ids))
+        with self.connection() as connection:
+            return dict(
+                connection.execute(
+                    "SELECT origpdfs_id, pdf_hash FROM threesyspdfs "
+                    f"WHERE origpdfs_id IN ({placeholders});",
+                    orig_ids,
+                ).fetchall()
+            )
+
+
+# utility function for PostgresStorage.bulk_insert_signed that writes rows in the text
+# format of COPY: tab separated, \N for NULL, bytea as escaped hex
+def copy_text(rows):
+    buffer = io.StringIO()
+    for row in rows:
+        buffer.write("\t".join(copy_text_field(value) for value in row))
+        buffer.write("\n")
+    buffer.seek(0)
+    return buffer
+
+
+def copy_text_field(value):
+    if value is None:
+        return "\\N"
+    if isinstance(value, (bytes, bytearray, memoryview)):
+        return "\\\\x" + bytes(value).hex()
+    return (
+        str(value)
+        .replace("\\", "\\\\")
+        .replace("\t", "\\t")
+        .replace("\n", "\\n")
+        .replace("\r", "\\r")
+    )
+
+
+# url schemes understood by DATABASE_URL and the backends that handle them
+storage_backends = {
+    "": lambda url, parsed: PostgresStorage(url),
+    "postgres": lambda url, parsed: PostgresStorage(url),
+    "postgresql": lambda url, parsed: PostgresStorage(url),
+    "sqlite": lambda url, parsed: SQLiteStorage(
+        parsed.path, float(os.getenv("SQLITE_TIMEOUT", "30"))
+    ),
+}
+_storage = None
+_storage_lock = threading.Lock()
+
+
+# returns the storage configured by DATABASE_URL: postgres for postgres:// and
+# postgresql:// urls (and libpq's defaults when unset), an embedded database for
+# sqlite:///path/to/threesys.sqlite3
+def get_storage():
+    # print("get_storage")
+    global _storage
+    if _storage is None:
+        with _storage_lock:
+            if _storage is None:
+                database_url = os.getenv("DATABASE_URL") or ""
+                parsed = urlparse(database_url)
+                if parsed.scheme not in storage_backends:
+                    raise ValueError(
+                        f"unsupported DATABASE_URL scheme: {parsed.scheme!r}"
+                    )
+                _storage = storage_backends[parsed.scheme](database_url, parsed)
+    return _storage
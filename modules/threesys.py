@@ -1,29 +1,94 @@
 import fitz
 from pylibdmtx.pylibdmtx import decode as pylibdmtx_decode
 import os
-import psycopg2
 from psycopg2 import Error
+from modules.storage import get_storage
+from modules.blobstore import get_blob_store
+from modules.pdfdelta import make_delta, reconstruct_signed_pdf
+from modules.signedindex import signed_index
+from modules.dmfilter import dm_decode_hints, dm_prefilter_enabled, near_square
+from modules.dmrender import render_dm
+from modules.metrics import timed_stage
+from modules.logs import log
 import json
+import re
 import treepoem
 import datetime
 import io
 import math
 import hashlib
+import tempfile
+import zlib
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from types import SimpleNamespace
+import numpy as np
+from PIL import Image
 from werkzeug.utils import secure_filename
 
 
 ALLOWED_EXTENSIONS = {"pdf"}
-url = os.getenv("DATABASE_URL")
 inch = 72
 allowance = 2
 dm_width = (inch - (2 * allowance)) / 3
 padded_dm = dm_width + (2 * allowance)
-
-
-# checks the request file if it is a pdf. If it is, then it is read into
-# memory for api manipulation
+# number of least significant red bits used by the steganography per pixel
+chunk_size = 2
+chunk_mask = (1 << chunk_size) - 1
+chunks_per_byte = 8 // chunk_size
+# payload format written by steganography (1 = legacy trailer, 2 = length prefixed)
+steg_payload_version = int(os.getenv("STEG_PAYLOAD_VERSION", "2"))
+steg_magic = b"3SYS"
+# a legacy payload is at most a 20 digit row id followed by the "//3.sys//" trailer
+legacy_steg_max_size = 20 + len("//3.sys//")
+# how signed pdfs are stored: "full" copies or a "delta" against the original
+signed_pdf_storage = os.getenv("SIGNED_PDF_STORAGE", "full")
+# verify never uses the "already signed" answer, so its db lookup is skipped by default
+skip_signed_lookup_on_verify = os.getenv("SKIP_SIGNED_LOOKUP_ON_VERIFY", "1") == "1"
+# "libdmtx" renders dms in-process, "treepoem" renders them through ghostscript
+dm_renderer = os.getenv("DM_RENDERER", "libdmtx")
+# "incremental" appends the signature to the original, "rewrite" re-serializes the pdf
+signing_mode = os.getenv("SIGNING_MODE", "incremental")
+# corners that can hold the signature, in the order the "auto" location tries them
+signature_locations = ("bottom-right", "bottom-left", "top-right", "top-left")
+# /verify answers uploads identical to a /generate download from their hash alone
+verify_fast_path = os.getenv("VERIFY_FAST_PATH", "1") == "1"
+# /verify looks for the signature on the pages of SIGNATURE_SEARCH_PAGES (1-based, "2-"
+# is every page after the first) when the first page has none, decoding the candidate
+# images of the pages on SIGNATURE_SEARCH_THREADS threads and giving up after
+# SIGNATURE_SEARCH_BUDGET_MS
+signature_search = os.getenv("SIGNATURE_SEARCH", "0") == "1"
+signature_search_pages = os.getenv("SIGNATURE_SEARCH_PAGES", "2-")
+signature_search_threads = int(os.getenv("SIGNATURE_SEARCH_THREADS", "4"))
+signature_search_budget = float(os.getenv("SIGNATURE_SEARCH_BUDGET_MS", "2000")) / 1000
+# "vector" answers margin checks from the page's drawing commands where it can, "render"
+# always rasterizes the corner
+margin_check = os.getenv("MARGIN_CHECK", "vector")
+# directory of the temporary files that uploads and canonical rewrites are spooled to
+# (default: the system temporary directory)
+upload_spool_dir = os.getenv("UPLOAD_SPOOL_DIR") or None
+spool_block_size = 1 << 20
+_search_executor = None
+_search_executor_pid = None
+_search_executor_lock = threading.Lock()
+
+
+# checks the request file if it is a pdf. If it is, then it is spooled to disk and
+# opened from there for api manipulation. Also returns the sha256 of the uploaded bytes,
+# see get_hash_and_bytes_of_document for how it is used
 def initialize_request(req):
     # print("initialize_request")
+    result = spool_request(req)
+    if not result:
+        return False
+    (path, document_name, document_raw_hash) = result
+    return (open_spooled_document(path), document_name, document_raw_hash)
+
+
+# first half of initialize_request: checks the request file and spools it to disk
+# without parsing it. Returns (path, secure file name, sha256 of the upload) or False
+def spool_request(req):
+    # print("spool_request")
     file = req.files["file"]
     if (
         "file" not in req.files
@@ -31,9 +96,33 @@ def initialize_request(req):
         or not allowed_file(file.filename)
     ):
         return False
-    file_stream = file.read()
-    document = fitz.open(stream=file_stream, filetype="pdf")
-    return (document, secure_filename(file.filename))
+    (path, document_raw_hash) = spool_upload(file.stream)
+    return (path, secure_filename(file.filename), document_raw_hash)
+
+
+# second half of initialize_request: opens a spooled upload and removes its file. mupdf
+# keeps its own handle on the file, which stays readable until the document is closed
+@timed_stage("open")
+def open_spooled_document(path):
+    try:
+        return fitz.open(path, filetype="pdf")
+    finally:
+        os.remove(path)
+
+
+# utility function for initialize_request that copies an upload to a temporary file one
+# block at a time, hashing it on the way, so that the upload is never held in memory as
+# a whole. Returns (path, sha256 of the upload)
+def spool_upload(stream):
+    # print("spool_upload")
+    hasher = hashlib.sha256()
+    with tempfile.NamedTemporaryFile(
+        suffix=".pdf", dir=upload_spool_dir, delete=False
+    ) as spool:
+        for block in iter(lambda: stream.read(spool_block_size), b""):
+            hasher.update(block)
+            spool.write(block)
+    return (spool.name, hasher.hexdigest())
 
 
 # utility function for initialize_request_file which breaks down the name of a file
@@ -71,87 +160,342 @@ def check_document_dimensions(document):
     return True
 
 
-# reads the regular payload of the dm
+# reads the regular payload of the dm. Images that fail the cheap data matrix
+# prefilter are never handed to libdmtx
+@timed_stage("dm_decode")
 def read_dm_pylibdmtx(image):
     # print("read_dm_pylibdmtx")
     image_width, image_height = image.size
     if image_width > 350 and image_height > 350:
         return ""
-    result = pylibdmtx_decode(image)
+    hints = dm_decode_hints(image)
+    if hints is None:
+        return ""
+    result = pylibdmtx_decode(image, **hints)
     if not result:
         return ""
     (decoded, rect) = result[0]
     return decoded.decode("utf-8")
 
 
-# novel algorithm which reads 3.Sys steganography
+# colorspaces of the page's image list that tell whether the image decodes to cmyk
+# without decoding it. Others (ICCBased, Indexed, ...) need the pixmap to tell
+known_colorspaces_cmyk = {"DeviceCMYK": True, "DeviceRGB": False, "DeviceGray": False}
+
+
+# False when read_dm_pylibdmtx would reject an image of this size without decoding it
+def image_size_may_hold_dm(width, height):
+    if width > 350 and height > 350:
+        return False
+    return not dm_prefilter_enabled or near_square(width, height)
+
+
+# returns (images, has_images) of a page: the images that may be a dm, and whether the
+# page has any image that counts for the "images" trait. The size and colorspace of every
+# image are read from the page's image list first: an image that cannot be a dm is never
+# decoded, unless its pixels are needed to tell whether it counts
+def page_candidate_images(document, page):
+    # print("page_candidate_images")
+    images = []
+    has_images = False
+    for img in page.get_images():
+        (xref, width, height, colorspace) = (img[0], img[2], img[3], img[5])
+        candidate = image_size_may_hold_dm(width, height)
+        cmyk = known_colorspaces_cmyk.get(colorspace)
+        if not candidate and (has_images or cmyk is not None):
+            has_images = has_images or not cmyk
+            continue
+
+        pix = fitz.Pixmap(document, xref)
+
+        if pix.colorspace is None or pix.colorspace.name == "DeviceCMYK":
+            continue
+
+        has_images = True
+        if candidate:
+            images.append(image_from_pixmap(pix))
+    return (images, has_images)
+
+
+# parses a page selection of SIGNATURE_SEARCH_PAGES into (first, last) pairs: comma
+# separated 1-based pages and ranges, such as "2-10", "2-", "-1" or "-3-" (a negative
+# number counts from the last page, an open end runs to the first or last page). Raises
+# ValueError on anything else, at import time for the setting
+def parse_page_ranges(spec):
+    # print("parse_page_ranges")
+    ranges = []
+    for part in spec.replace(" ", "").split(","):
+        if not part:
+            continue
+        match = page_range_pattern.fullmatch(part)
+        if match is None:
+            raise ValueError(f"invalid page selection {part!r} in {spec!r}")
+        first = int(match["first"]) if match["first"] else None
+        if match["range"]:
+            last = int(match["last"]) if match["last"] else None
+        else:
+            last = first
+        if 0 in (first, last):
+            raise ValueError(f"invalid page selection {part!r} in {spec!r}")
+        ranges.append((first, last))
+    return ranges
+
+
+page_range_pattern = re.compile(r"(?P<first>-?\d+)?(?P<range>-(?P<last>-?\d+)?)?")
+signature_search_ranges = parse_page_ranges(signature_search_pages)
+
+
+# returns the 0-based numbers of the pages after the first that the (first, last)
+# ranges of parse_page_ranges select in a document of page_count pages
+def search_page_numbers(ranges, page_count):
+    # print("search_page_numbers")
+    def page_index(number, default):
+        if number is None:
+            return default
+        return page_count + number if number < 0 else number - 1
+
+    numbers = []
+    for (first, last) in ranges:
+        first = page_index(first, 1)
+        last = page_index(last, page_count - 1)
+        numbers.extend(range(max(first, 1), min(last, page_count - 1) + 1))
+    return list(dict.fromkeys(numbers))
+
+
+# decodes one candidate image of the page search, on a thread of the search pool.
+# libdmtx runs without the gil, so the decodes of several images overlap. Returns
+# (regular payload, steg message) with "" and False for what the image does not hold
+def classify_dm_image(image):
+    payload = read_dm_pylibdmtx(image)
+    if not payload:
+        return ("", False)
+    return (payload, read_steganography(image))
+
+
+# returns the page search pool of the current process, created after any fork
+def get_search_executor():
+    # print("get_search_executor")
+    global _search_executor, _search_executor_pid
+    with _search_executor_lock:
+        if _search_executor is None or _search_executor_pid != os.getpid():
+            _search_executor = ThreadPoolExecutor(
+                max_workers=signature_search_threads,
+                thread_name_prefix="threesys-search",
+            )
+            _search_executor_pid = os.getpid()
+    return _search_executor
+
+
+# wraps the samples of a pixmap in a PIL image, instead of encoding the pixmap to png
+# and decoding that again. Layouts other than gray or rgb (with or without alpha) still
+# go through png
+def image_from_pixmap(pix):
+    # print("image_from_pixmap")
+    mode = {(1, 0): "L", (2, 1): "LA", (3, 0): "RGB", (4, 1): "RGBA"}.get(
+        (pix.n, pix.alpha)
+    )
+    if mode is None:
+        return Image.open(io.BytesIO(pix.tobytes()))
+    return Image.frombuffer(
+        mode, (pix.width, pix.height), pix.samples, "raw", mode, pix.stride, 1
+    )
+
+
+# novel algorithm which reads 3.Sys steganography. v2 payloads are recognized by their
+# header, so images without one are rejected after a few pixels; anything else falls
+# back to the legacy "//3.sys//" trailer format
+@timed_stage("steg_read")
 def read_steganography(image):
     # print("read_steganography")
-    chunk_size = 2
-    width, height = image.size
-    image_map = image.load()
-    msg = []
-    byte = ""
-    for i in range(width):
-        for j in range(height):
-            (r, g, b) = image_map[i, j]
-            bin_r = format(r, "08b")
-            chunk = bin_r[-chunk_size:]
-            byte += chunk
-            if len(byte) == 8:
-                msg.append(chr(int(byte, 2)))
-                byte = ""
-    dirty_msg = "".join(msg)
-    marker_i = dirty_msg.find("//3.sys//")
-    if marker_i != -1:
-        return dirty_msg[:marker_i]
+    magic = read_steg_bytes(image, 0, len(steg_magic))
+    if magic == steg_magic:
+        return read_steganography_v2(image)
+    return read_steganography_legacy(image)
+
+
+# utility function for read_steganography that reads a v2 payload: magic, version,
+# payload length, payload and a crc32 of everything before it
+def read_steganography_v2(image):
+    # print("read_steganography_v2")
+    header_size = len(steg_magic) + 3
+    header = read_steg_bytes(image, 0, header_size)
+    if len(header) != header_size or header[len(steg_magic)] != 2:
+        return False
+    payload_size = int.from_bytes(header[-2:], "big")
+    body = read_steg_bytes(image, header_size, payload_size + 4)
+    if len(body) != payload_size + 4:
+        return False
+    payload, checksum = body[:-4], body[-4:]
+    if zlib.crc32(header + payload).to_bytes(4, "big") != checksum:
+        return False
+    return payload.decode("latin-1")
+
+
+# utility function for read_steganography that reads a legacy payload. Legacy payloads
+# are always a row id followed by the trailer, so only the first few bytes are decoded
+def read_steganography_legacy(image):
+    # print("read_steganography_legacy")
+    dirty_msg = read_steg_bytes(image, 0, legacy_steg_max_size).decode("latin-1")
+    steg_id = dirty_msg[: len(dirty_msg) - len(dirty_msg.lstrip("0123456789"))]
+    if dirty_msg.startswith("//3.sys//", len(steg_id)):
+        return steg_id
     return False
 
 
+# utility function for the read_steganography functions that decodes count bytes of the
+# hidden message starting at byte offset start. Only the pixel columns holding those
+# bytes are converted, so the cost follows the payload and not the image size
+def read_steg_bytes(image, start, count):
+    # print("read_steg_bytes")
+    width, height = image.size
+    first_pixel = start * chunks_per_byte
+    last_pixel = min((start + count) * chunks_per_byte, width * height)
+    if last_pixel <= first_pixel:
+        return b""
+    first_column = first_pixel // height
+    last_column = -(-last_pixel // height)
+    columns = image.crop((first_column, 0, last_column, height))
+    red = red_channel_column_major(columns)
+    offset = first_pixel - first_column * height
+    red = red[offset : offset + last_pixel - first_pixel]
+    red = red[: red.size - red.size % chunks_per_byte]
+    return chunks_to_bytes(red & chunk_mask)
+
+
 # saves the document to the origpdfs table in 3.Sys db and returns the
-# id of that generated row
-def save_orig_doc_to_db(document_hash, document_bytes):
+# id of that generated row, or None when the same document was signed in the meantime.
+# When a connection is given the insert joins its transaction and errors are left to
+# the caller
+def save_orig_doc_to_db(document_hash, document_bytes, connection=None):
     # print("save_orig_doc_to_db")
-    QUERY = "INSERT INTO origpdfs (orig_pdf_data, orig_pdf_hash) VALUES (%s, %s) RETURNING orig_id;"
+    storage = get_storage()
+    if connection is not None:
+        pdf_data = store_pdf_bytes(document_hash, document_bytes)
+        orig_id = storage.insert_orig(connection, document_hash, pdf_data)
+        signed_index.add(document_hash)
+        return orig_id
     try:
-        connection = psycopg2.connect(url)
-        with connection:
-            with connection.cursor() as cursor:
-                cursor.execute(QUERY, (document_bytes, document_hash))
-                return cursor.fetchone()[0]
+        with storage.transaction() as connection:
+            return save_orig_doc_to_db(document_hash, document_bytes, connection)
     except (Exception, Error) as error:
         return f"Error while connecting to PostgreSQL, {error}"
-    finally:
-        if connection:
-            cursor.close()
-            connection.close()
 
 
-# saves the modified document to the threesyspdf table in 3.Sys db
-def save_modified_doc_to_db(new_pdf_hash, new_pdf_bytes, steg_id):
+# saves the modified document to the threesyspdf table in 3.Sys db. When a
+# connection is given the insert joins its transaction and errors are left to the caller.
+# With SIGNED_PDF_STORAGE=delta and the original bytes at hand, only a delta against the
+# original is stored (always inline, deltas are small). dm_payload is the regular payload
+# of the signature, kept for the /verify fast path
+def save_modified_doc_to_db(
+    new_pdf_hash,
+    new_pdf_bytes,
+    steg_id,
+    connection=None,
+    orig_pdf_bytes=None,
+    dm_payload=None,
+):
     # print("save_modified_doc_to_db")
     # print(new_pdf_hash)
-    QUERY = (
-        "INSERT INTO threesyspdfs (pdf_hash, pdf_data, origpdfs_id) VALUES (%s,%s, %s);"
-    )
+    storage = get_storage()
+    if connection is not None:
+        (pdf_encoding, pdf_data) = encode_signed_pdf(
+            new_pdf_hash, new_pdf_bytes, orig_pdf_bytes
+        )
+        storage.insert_signed(
+            connection, new_pdf_hash, pdf_data, pdf_encoding, steg_id, dm_payload
+        )
+        return
     try:
-        connection = psycopg2.connect(url)
-        with connection:
-            with connection.cursor() as cursor:
-                cursor.execute(QUERY, (new_pdf_hash, new_pdf_bytes, steg_id))
+        with storage.transaction() as connection:
+            save_modified_doc_to_db(
+                new_pdf_hash,
+                new_pdf_bytes,
+                steg_id,
+                connection,
+                orig_pdf_bytes,
+                dm_payload,
+            )
     except (Exception, Error) as error:
         return f"Error while connecting to PostgreSQL, {error}"
-    finally:
-        if connection:
-            cursor.close()
-            connection.close()
 
 
-# generate a dm with the treepoem module
-def generate_dm(pdf_file):
+# returns (pdf_encoding, pdf_data) of a signed document as it is stored in threesyspdfs:
+# a delta against the original with SIGNED_PDF_STORAGE=delta and the original bytes at
+# hand, the full pdf otherwise (None when its bytes went to the blob store)
+def encode_signed_pdf(new_pdf_hash, new_pdf_bytes, orig_pdf_bytes=None):
+    # print("encode_signed_pdf")
+    if signed_pdf_storage == "delta" and orig_pdf_bytes is not None:
+        return ("delta", make_delta(orig_pdf_bytes, new_pdf_bytes))
+    return ("full", store_pdf_bytes(new_pdf_hash, new_pdf_bytes))
+
+
+# returns the stored hashes of the signed documents of many steg ids with one query, as a
+# dict of steg id to pdf_hash. Ids without a signed document are left out
+def lookup_signed_hashes(steg_ids):
+    # print("lookup_signed_hashes")
+    if not steg_ids:
+        return {}
+    return get_storage().signed_hashes(steg_ids)
+
+
+# loads the bytes of a signed document by its hash, rebuilding it from its original when
+# it was stored as a delta. Returns None when no such document exists
+def get_signed_pdf_bytes(pdf_hash):
+    # print("get_signed_pdf_bytes")
+    row = get_storage().signed_pdf_row(pdf_hash)
+    if not row:
+        return None
+    (pdf_data, pdf_encoding, orig_pdf_hash, orig_pdf_data) = row
+    if pdf_encoding != "delta":
+        return load_pdf_bytes(pdf_hash, pdf_data)
+    orig_pdf_bytes = load_pdf_bytes(orig_pdf_hash, orig_pdf_data)
+    return reconstruct_signed_pdf(orig_pdf_bytes, bytes(pdf_data), pdf_hash)
+
+
+# utility function for the save functions that moves the pdf bytes to the blob store when
+# one is configured. Returns what goes into the db data column: the bytes themselves, or
+# None when the blob store keeps them under the hash
+def store_pdf_bytes(pdf_hash, pdf_bytes):
+    # print("store_pdf_bytes")
+    blob_store = get_blob_store()
+    if blob_store is None:
+        return pdf_bytes
+    blob_store.put(pdf_hash, pdf_bytes)
+    return None
+
+
+# utility function that returns the pdf bytes of a db data column, reading them from
+# the blob store when the column was left empty
+def load_pdf_bytes(pdf_hash, pdf_data):
+    # print("load_pdf_bytes")
+    if pdf_data is not None:
+        return bytes(pdf_data)
+    return get_blob_store().get(pdf_hash)
+
+
+# generate a dm of the document's message. The dm is rendered in-process by libdmtx and
+# cached per message; treepoem (ghostscript) is used when DM_RENDERER=treepoem or when
+# the in-process renderer fails. The message defaults to the one of the document's metadata
+@timed_stage("dm_render")
+def generate_dm(pdf_file, message=None):
     # print("generate_dm")
-    metadata = pdf_file.metadata
-    message = generate_message(metadata)
+    if message is None:
+        message = generate_message(pdf_file.metadata)
+    if dm_renderer == "libdmtx":
+        try:
+            # the cached image is shared, steganography needs its own copy
+            return render_dm(message).copy()
+        except Exception as error:
+            log.warning(
+                "in-process dm rendering failed, falling back to treepoem",
+                extra={"fields": {"error": str(error)}},
+            )
+    return generate_dm_treepoem(message)
+
+
+# generate a dm with the treepoem module
+def generate_dm_treepoem(message):
+    # print("generate_dm_treepoem")
     return treepoem.generate_barcode(
         barcode_type="datamatrix",
         data=message,
@@ -175,49 +519,68 @@ def generate_message(metadata):
 
 
 # novel steganography function that uses LSB to hide the secret message in the last bits
-# (defined by chunk_size) of every pixel, red channel
-def steganography(image, secret):
+# (defined by chunk_size) of every pixel, red channel. version selects the payload
+# format, see msg_to_bytes
+@timed_stage("steg_write")
+def steganography(image, secret, version=None):
     # print("steganography")
-    chunk_size = 2
     # initialize necessary image components
     width, height = image.size
-    image_map = image.load()
-
-    # convert secret to workable binary stream
-    secret_ascii = msg_to_binary_stream(secret)
-    secret_chunks = chunkify(secret_ascii, chunk_size)
-
-    # loop that replaces the least significat n values of each R byte
-    # in each pixel with its corresponding secret message chunk of n bits
-    for i in range(width):
-        for j in range(height):
-            secret_chunks_index = i * height + j
-            if secret_chunks_index < len(secret_chunks):
-                secret_portion = secret_chunks[secret_chunks_index]
-                (r, g, b) = image_map[i, j]
-                bin_r = format(r, "08b")
-                new_bin_r = bin_r[:-chunk_size] + secret_portion
-                new_r = int(new_bin_r, 2)
-                image.putpixel((i, j), (new_r, g, b))
+    pixels = np.array(image.convert("RGB"))
+
+    # convert secret to workable stream of chunk_size bit chunks
+    secret_chunks = bytes_to_chunks(msg_to_bytes(secret, version))
+    secret_chunks = secret_chunks[: width * height]
+
+    # replaces the least significant chunk_size bits of each R byte with its
+    # corresponding secret message chunk. pixels are walked column by column,
+    # so chunk k lands on pixel (k // height, k % height) as in i * height + j
+    k = np.arange(secret_chunks.size)
+    red = pixels[k % height, k // height, 0]
+    pixels[k % height, k // height, 0] = (red & (0xFF ^ chunk_mask)) | secret_chunks
+    image.paste(Image.fromarray(pixels).convert(image.mode))
     return image
 
 
-# utility function for steganography that converts a string into a binary stream
-def msg_to_binary_stream(str):
-    # print("msg_to_binary_stream")
-    formatted_str = str + "//3.sys//"
-    ascii_str = "".join(format(ord(i), "08b") for i in formatted_str)
-    return ascii_str
+# utility function for steganography that converts a string into the bytes to be hidden.
+# version 1 is the legacy "<secret>//3.sys//" format, version 2 is a length prefixed
+# payload (magic, version, 2 byte length, secret, crc32 of the preceding bytes)
+def msg_to_bytes(str, version=None):
+    # print("msg_to_bytes")
+    version = version or steg_payload_version
+    if version == 1:
+        formatted_str = str + "//3.sys//"
+        return formatted_str.encode("latin-1")
+    payload = str.encode("latin-1")
+    header = steg_magic + bytes([2]) + len(payload).to_bytes(2, "big")
+    return header + payload + zlib.crc32(header + payload).to_bytes(4, "big")
+
+
+# utility function for steganography that splits the given bytes into chunk_size bit
+# chunks, most significant chunk first
+def bytes_to_chunks(msg_bytes):
+    # print("bytes_to_chunks")
+    msg = np.frombuffer(msg_bytes, dtype=np.uint8)
+    shifts = np.arange(8 - chunk_size, -1, -chunk_size, dtype=np.uint8)
+    return ((msg[:, None] >> shifts) & chunk_mask).astype(np.uint8).ravel()
+
 
+# utility function for read_steganography that packs chunk_size bit chunks back into
+# bytes, the inverse of bytes_to_chunks
+def chunks_to_bytes(chunks):
+    # print("chunks_to_bytes")
+    shifts = np.arange(8 - chunk_size, -1, -chunk_size, dtype=np.uint8)
+    grouped = chunks.reshape(-1, chunks_per_byte).astype(np.uint8) << shifts
+    return np.bitwise_or.reduce(grouped, axis=1).astype(np.uint8).tobytes()
 
-# utility function for steganography that splits the given binary_stream into chunk_size
-# define chunks
-def chunkify(binary_stream, chunk_size):
-    # print("chunkify")
-    return [
-        binary_stream[i: i + chunk_size]
-        for i in range(0, len(binary_stream), chunk_size)
-    ]
+
+# utility function for the steganography functions that returns the red channel of the
+# image flattened column by column, so index i * height + j is pixel (i, j)
+def red_channel_column_major(image):
+    # print("red_channel_column_major")
+    if image.mode != "RGB":
+        image = image.convert("RGB")
+    return np.asarray(image.getchannel("R")).T.ravel()
 
 
 # attaches generated steg dms to the specified location on the document
@@ -281,67 +644,193 @@ def put_steg_dm_in_pdf(pdf_file, steg_dm, dm_steg_location):
     return pdf_file
 
 
+# the area of the first page, padding included, that the margin check requires to be
+# clear for a signature at location
+def corner_rect(page, location):
+    page_width = page.rect.width
+    page_height = page.rect.height
+    match location:
+        case "top-left":
+            return fitz.Rect(0, 0, padded_dm, padded_dm)
+        case "top-right":
+            return fitz.Rect(page_width - padded_dm, 0, page_width, padded_dm)
+        case "bottom-left":
+            return fitz.Rect(0, page_height - padded_dm, padded_dm, page_height)
+        case "bottom-right":
+            return fitz.Rect(
+                page_width - padded_dm,
+                page_height - padded_dm,
+                page_width,
+                page_height,
+            )
+
+
+# bounding boxes of everything the page draws (text, paths, images and shadings) and of
+# its annotations and form fields. Returns None when they cannot be relied on, which
+# makes corner_is_clear render every corner
+def page_content_rects(page):
+    # print("page_content_rects")
+    if margin_check != "vector" or page.rotation:
+        return None
+    try:
+        rects = [
+            fitz.Rect(bbox)
+            for (kind, bbox) in page.get_bboxlog()
+            if kind.startswith(("fill", "stroke"))
+        ]
+    except Exception:
+        return None
+    rects += [annot.rect for annot in page.annots()]
+    rects += [widget.rect for widget in page.widgets()]
+    return rects
+
+
+# checks whether a corner of the page is a single colour. A corner that no content
+# bounding box reaches is clear without rendering anything; otherwise (content nearby
+# may still be white, clipped or outside its loose bounding box) the corner is rendered
+# and checked pixel by pixel as before
+def corner_is_clear(page, location, content_rects):
+    # print("corner_is_clear")
+    corner = corner_rect(page, location)
+    if content_rects is not None and not any(
+        rect.intersects(corner) for rect in content_rects
+    ):
+        return True
+    return page.get_pixmap(clip=corner).is_unicolor
+
+
 # checks if whether or not the input (unsigned) document has already been previously
-# signed by a 3.Sys signature.
+# signed by a 3.Sys signature. Goes through the in-process signed index when it is
+# enabled, which answers most lookups without a db round trip
+@timed_stage("already_signed")
 def check_if_doc_is_already_prev_signed(document_hash):
     # print("check_if_doc_is_already_prev_signed")
-    QUERY = "SELECT * FROM origpdfs WHERE orig_pdf_hash = (%s);"
+    if not signed_index.enabled:
+        return lookup_prev_signed_in_db(document_hash)
+    if signed_index.needs_refresh():
+        try:
+            storage = get_storage()
+            with storage.connection() as connection:
+                signed_index.refresh(storage, connection)
+        except (Exception, Error):
+            pass
+    return signed_index.contains(document_hash, lookup_prev_signed_in_db)
+
+
+# utility function for check_if_doc_is_already_prev_signed that asks the db
+def lookup_prev_signed_in_db(document_hash):
+    # print("lookup_prev_signed_in_db")
     try:
-        connection = psycopg2.connect(url)
-        with connection:
-            with connection.cursor() as cursor:
-                cursor.execute(QUERY, (document_hash,))
-                if cursor.rowcount > 0:
-                    (
-                        origpdf_id,
-                        origpdf_hash,
-                        origpdf_data,
-                    ) = cursor.fetchall()[0]
-        #             print("Db hash:", origpdf_hash)
-        # print("Curr hash:", document_hash)
-        # print("Sign status:", cursor.rowcount > 0)
-        return cursor.rowcount > 0
+        return get_storage().orig_exists(document_hash)
     except (Exception, Error) as error:
         return f"Error while connecting to PostgreSQL, {error}"
-    finally:
-        if connection:
-            cursor.close()
-            connection.close()
 
 
-# defines if whether or not the document has been modifed
-def check_if_document_is_modified(document_hash, dm_stegs):
+# defines if whether or not the document has been modifed. The stored hash may match
+# either the canonical hash or the hash of the uploaded bytes (raw_hash), see
+# get_hash_and_bytes_of_document
+@timed_stage("modified")
+def check_if_document_is_modified(document_hash, dm_stegs, raw_hash=None):
     # print("check_if_document_is_modified")
     if len(dm_stegs) != 1:
         return True
     dm_steg = dm_stegs[0]
     steg_msg = read_steganography(dm_steg)
-    QUERY = "SELECT * FROM threesyspdfs WHERE origpdfs_id = (%s);"
     try:
-        connection = psycopg2.connect(url)
-        with connection:
-            with connection.cursor() as cursor:
-                cursor.execute(QUERY, (steg_msg,))
-                if cursor.rowcount > 0:
-                    (
-                        rpdf_id,
-                        rpdf_hash,
-                        rpdf_data,
-                        rorigpdfs_id,
-                    ) = cursor.fetchall()[0]
-                    return not document_hash == rpdf_hash
-                else:
-                    return True
+        rpdf_hash = get_storage().signed_hash(steg_msg)
+        if rpdf_hash:
+            return rpdf_hash not in (document_hash, raw_hash)
+        else:
+            return True
     except (Exception, Error) as error:
         return f"Error while connecting to PostgreSQL, {error}"
-    finally:
-        if connection:
-            cursor.close()
-            connection.close()
 
 
+# /verify fast path: a document whose uploaded bytes are exactly what /generate returned
+# is answered from the stored payload of its signature, without parsing it. Returns a
+# stand-in for its TSdoc, with the traits the full verification would find, or None when
+# the hash is unknown (or predates stored payloads) and the document must be analyzed
+@timed_stage("fast_path")
+def verify_by_raw_hash(document_name, raw_hash):
+    # print("verify_by_raw_hash")
+    if not verify_fast_path:
+        return None
+    try:
+        dm_payload = get_storage().signed_payload(raw_hash)
+    except (Exception, Error):
+        return None
+    return fast_path_doc(document_name, raw_hash, dm_payload)
+
+
+# utility function for verify_by_raw_hash that builds the stand-in TSdoc from the stored
+# payload, or returns None without one
+def fast_path_doc(document_name, raw_hash, dm_payload):
+    if dm_payload is None:
+        return None
+    return SimpleNamespace(
+        document_name=document_name,
+        hash=raw_hash,
+        raw_hash=raw_hash,
+        traits={
+            "margins": True,
+            "images": True,
+            "dm_images": True,
+            "dm_steg": True,
+            "modified": False,
+        },
+        regular_dm_payload=dm_payload,
+    )
+
+
+# canonical hash of a document: the sha256 of its garbage=4, no_new_id rewrite, which
+# does not change when identical content is saved again. origpdfs.orig_pdf_hash is
+# always this hash. threesyspdfs.pdf_hash is the sha256 of the exact bytes /generate
+# returned: the rewrite itself for "rewrite" signing, the original rewrite plus an
+# incremental update for "incremental" signing. /verify therefore accepts a document
+# whose uploaded bytes or whose rewrite hash to pdf_hash
+@timed_stage("hash")
 def get_hash_and_bytes_of_document(document):
     # print("get_hash_of_document")
     document_bytes = document.tobytes(garbage=4, no_new_id=True)
     document_hash = hashlib.sha256(document_bytes).hexdigest()
     return (document_hash, document_bytes)
+
+
+# the hash of get_hash_and_bytes_of_document for callers that do not need the bytes
+# (/verify): the canonical rewrite is written to a temporary file and hashed from there
+# instead of being held in memory
+@timed_stage("hash")
+def get_hash_of_document(document):
+    # print("get_hash_of_document")
+    hasher = hashlib.sha256()
+    with tempfile.TemporaryDirectory(dir=upload_spool_dir) as directory:
+        path = os.path.join(directory, "canonical.pdf")
+        document.save(path, garbage=4, no_new_id=True)
+        with open(path, "rb") as file:
+            for block in iter(lambda: file.read(spool_block_size), b""):
+                hasher.update(block)
+    return hasher.hexdigest()
+
+
+# signs the document without rewriting it: the steg dm is appended to the canonical bytes
+# of the original as a pdf incremental update, and the result is read back and hashed.
+# Returns (hash, bytes) of the signed pdf, or None when the document cannot be updated
+# incrementally and has to be rewritten instead
+def sign_document_incrementally(document_bytes, steg_dm, dm_steg_location):
+    # print("sign_document_incrementally")
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "document.pdf")
+        with open(path, "wb") as file:
+            file.write(document_bytes)
+        document = fitz.open(path)
+        try:
+            if not document.can_save_incrementally():
+                return None
+            put_steg_dm_in_pdf(document, steg_dm, dm_steg_location)
+            document.saveIncr()
+        finally:
+            document.close()
+        # read back in one piece, the only copy of the signed pdf that is made
+        with open(path, "rb") as file:
+            signed_bytes = file.read()
+    return (hashlib.sha256(signed_bytes).hexdigest(), signed_bytes)
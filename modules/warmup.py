@@ -0,0 +1,60 @@
+import time
+import fitz
+from modules.threesys import *
+
+
+# runs every lazily initialized stage of /generate and /verify once, so that the first
+# real request does not pay for loading libdmtx, ghostscript, pymupdf and numpy. Called
+# in the gunicorn master before workers are forked, so the workers inherit the result.
+# Returns the seconds spent per stage
+def warm_up(app):
+    # print("warm_up")
+    timings = {}
+
+    started = time.perf_counter()
+    document = fitz.open()
+    page = document.new_page(width=612, height=792)
+    page.insert_text((72, 72), "3.Sys warm up")
+    (document_hash, document_bytes) = get_hash_and_bytes_of_document(document)
+    document = fitz.open(stream=document_bytes, filetype="pdf")
+    check_document_dimensions(document)
+    document[0].get_pixmap(clip=fitz.Rect(0, 0, padded_dm, padded_dm)).is_unicolor
+    timings["pdf"] = time.perf_counter() - started
+
+    started = time.perf_counter()
+    dm = generate_dm(document)
+    if dm_renderer == "treepoem":
+        # the in-process renderer is the fallback then, load it as well
+        render_dm("3.Sys warm up")
+    timings["dm_encode"] = time.perf_counter() - started
+
+    started = time.perf_counter()
+    steg_dm = steganography(dm, "1")
+    read_steganography(steg_dm)
+    timings["steganography"] = time.perf_counter() - started
+
+    started = time.perf_counter()
+    read_dm_pylibdmtx(steg_dm)
+    timings["dm_decode"] = time.perf_counter() - started
+
+    started = time.perf_counter()
+    put_steg_dm_in_pdf(document, steg_dm, "bottom-right")
+    get_hash_and_bytes_of_document(document)
+    timings["sign"] = time.perf_counter() - started
+
+    # the asgi app (asgi.py) has no test client, and sets up its pools per worker
+    if hasattr(app, "test_client"):
+        started = time.perf_counter()
+        app.test_client().get("/")
+        timings["request"] = time.perf_counter() - started
+    return timings
+
+
+# opens the db connection of a freshly forked worker, so that its first request does not
+# wait for the connection handshakes
+def warm_up_worker():
+    # print("warm_up_worker")
+    started = time.perf_counter()
+    with get_storage().connection():
+        pass
+    return time.perf_counter() - started